@@ -1,6 +1,7 @@
 import streamlit as st
 
 from src.instructions import instruction_panel
+from src.profiling import Profiler
 import src.single_dose_single_segm as sdss
 import src.single_dose_mult_segm as sdms
 import src.mult_dose_single_segm as mdss
@@ -39,5 +40,24 @@ page_names_to_funcs = {
     "Multiple Dose Plans, Multiple Segmentations": multiple_dose_multiple_segmentation,
 }
 
+def display_diagnostics(profiler):
+    # Timings of this run of the page, in the sidebar
+    st.sidebar.markdown("### Diagnostics")
+    st.sidebar.markdown(f"Page run: {profiler.seconds:.3f} s")
+    st.sidebar.dataframe(profiler.table(), hide_index=True)
+    st.sidebar.download_button(label="Download timings (JSON)", data=profiler.to_json(),
+                               file_name="profile.json", mime="application/json")
+
+
 task_selection = st.sidebar.selectbox("Choose a task:", page_names_to_funcs.keys())
-page_names_to_funcs[task_selection]()
\ No newline at end of file
+diagnostics = st.sidebar.toggle("Show diagnostics")
+trace_memory = diagnostics and st.sidebar.checkbox("Trace memory peaks (slower)")
+if diagnostics:
+    profiler = Profiler(task_selection, memory=trace_memory)
+    try:
+        with profiler:
+            page_names_to_funcs[task_selection]()
+    finally:
+        display_diagnostics(profiler)
+else:
+    page_names_to_funcs[task_selection]()
\ No newline at end of file
@@ -0,0 +1,70 @@
+import io
+import gzip
+
+import numpy as np
+import pandas as pd
+from nibabel import Nifti1Image
+
+GRID_SIZES = {
+    "128": (128, 128, 128),
+    "256": (256, 256, 256),
+    "512x300": (512, 512, 300),
+}
+
+
+def _ellipsoid(shape, center, radii):
+    # Only the bounding box of the ellipsoid is evaluated
+    mask = np.zeros(shape, dtype=np.uint8)
+    lo = [max(int(c - r), 0) for c, r in zip(center, radii)]
+    hi = [min(int(c + r) + 1, n) for c, r, n in zip(center, radii, shape)]
+    axes = np.ogrid[tuple(slice(a, b) for a, b in zip(lo, hi))]
+    inside = sum(((axis - c) / r) ** 2 for axis, c, r in zip(axes, center, radii)) <= 1
+    mask[tuple(slice(a, b) for a, b in zip(lo, hi))] = inside
+    return mask
+
+
+def dose_phantom(shape, seed=0, prescription=60.0):
+    # A smooth high-dose region around the centre plus a few low-dose lobes and some noise
+    rng = np.random.default_rng(seed)
+    axes = np.ogrid[tuple(slice(0, n) for n in shape)]
+    center = [n / 2 for n in shape]
+    dose = np.zeros(shape, dtype=np.float32)
+    dose += prescription * np.exp(-sum(((axis - c) / (0.2 * n)) ** 2 for axis, c, n in zip(axes, center, shape)))
+    for _ in range(3):
+        lobe = rng.uniform(0.2, 0.8, 3) * shape
+        dose += 15 * np.exp(-sum(((axis - c) / (0.1 * n)) ** 2 for axis, c, n in zip(axes, lobe, shape)))
+    dose += rng.normal(0, 0.5, shape).astype(np.float32)
+    np.clip(dose, 0, None, out=dose)
+    return dose
+
+
+def structure_phantoms(shape, n_structures, seed=0):
+    # A target in the high-dose region, a body outline and small to large ellipsoidal organs around them
+    rng = np.random.default_rng(seed)
+    center = [n / 2 for n in shape]
+    masks = {
+        "Target": _ellipsoid(shape, center, [0.12 * n for n in shape]),
+        "Body": _ellipsoid(shape, center, [0.48 * n for n in shape]),
+    }
+    for index in range(max(n_structures - 2, 0)):
+        radii = rng.uniform(0.01, 0.12) * np.asarray(shape) * rng.uniform(0.7, 1.3, 3)
+        organ_center = rng.uniform(0.2, 0.8, 3) * shape
+        masks[f"Organ_{index}"] = _ellipsoid(shape, organ_center, radii)
+    return dict(list(masks.items())[:n_structures])
+
+
+def nifti_gz(volume, name):
+    # In-memory .nii.gz upload, like the ones Streamlit hands to read_file
+    data = io.BytesIO(gzip.compress(Nifti1Image(volume, np.eye(4)).to_bytes(), compresslevel=1, mtime=0))
+    data.name = name
+    return data
+
+
+def protocol(structure_names, n_rows=100):
+    kinds = [("max", 54, None), ("mean", 30, None), ("min", 20, None), ("volume", 50, "V20"), ("dose", 45, "D0.03cc")]
+    rows = []
+    for index in range(n_rows):
+        kind, level, metric = kinds[index % len(kinds)]
+        rows.append({"Structure": structure_names[index % len(structure_names)], "Constraint Type": kind,
+                     "Level": level, "Metric": metric})
+    return pd.DataFrame(rows)
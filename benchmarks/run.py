@@ -0,0 +1,161 @@
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import subprocess
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from src import utils
+from benchmarks import legacy
+from benchmarks.phantoms import GRID_SIZES, dose_phantom, nifti_gz, protocol, structure_phantoms
+
+# Run this from >> python -m benchmarks.run --sizes 128 256 --structures 10 40 --out bench.json
+
+
+def measure(func, repeats):
+    # Best and median wall time over `repeats` calls, then one more call under tracemalloc for the peak
+    # of memory allocated by the call (NumPy reports its buffers to tracemalloc)
+    seconds = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - started)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"best_s": min(seconds), "median_s": float(np.median(seconds)), "peak_mb": peak / 2 ** 20}
+
+
+def benchmarks(dose, doses, masks, summary, constraint, voxel_cc):
+    # (function, implementation, callable) for every utils hot path
+    dose_file = nifti_gz(dose, "dose.nii.gz")
+
+    def read_with(read_file):
+        def read():
+            dose_file.seek(0)
+            return read_file(dose_file)
+        return read
+
+    organ = "Target"
+    metrics = list(utils.DEFAULT_METRICS) + utils.constraint_metrics(constraint)
+    legacy_summary = legacy.dose_summary(dose, masks)
+    return [
+        ("read_file", "current", read_with(utils.read_file)),
+        ("read_file", "legacy", read_with(legacy.read_file)),
+        ("compute_dvh", "current", lambda: utils.compute_dvh(dose, masks[organ], max_dose=70)),
+        ("compute_dvh", "legacy", lambda: legacy.compute_dvh(dose, masks[organ], max_dose=70)),
+        ("dvh_by_structure", "current", lambda: utils.dvh_by_structure(dose, masks)),
+        ("dvh_by_structure", "legacy", lambda: legacy.dvh_by_structure(dose, masks)),
+        ("dvh_by_dose", "current", lambda: utils.dvh_by_dose(doses, masks[organ], organ)),
+        ("dvh_by_dose", "legacy", lambda: legacy.dvh_by_dose(doses, masks[organ], organ)),
+        ("dose_summary", "current", lambda: utils.dose_summary(dose, masks, metrics=metrics, voxel_cc=voxel_cc)),
+        ("dose_summary", "legacy", lambda: legacy.dose_summary(dose, masks)),
+        ("check_compliance", "current", lambda: utils.check_compliance(summary, constraint)),
+        ("check_compliance", "legacy", lambda: legacy.check_compliance(legacy_summary, constraint)),
+    ]
+
+
+def run(sizes, structure_counts, n_plans=3, repeats=3, include_legacy=True, log=print):
+    results = []
+    for size in sizes:
+        shape = GRID_SIZES[size]
+        doses = {plan: dose_phantom(shape, seed=plan) for plan in range(1, n_plans + 1)}
+        dose = doses[1]
+        for n_structures in structure_counts:
+            masks = structure_phantoms(shape, n_structures)
+            constraint = protocol(list(masks))
+            voxel_cc = 0.001
+            summary = utils.dose_summary(dose, masks, metrics=list(utils.DEFAULT_METRICS) +
+                                         utils.constraint_metrics(constraint), voxel_cc=voxel_cc)
+            for function, implementation, call in benchmarks(dose, doses, masks, summary, constraint, voxel_cc):
+                if implementation == "legacy" and not include_legacy:
+                    continue
+                record = {"grid": size, "shape": list(shape), "structures": n_structures, "plans": n_plans,
+                          "function": function, "implementation": implementation, **measure(call, repeats)}
+                results.append(record)
+                log(f"{size:>8} {n_structures:>3} structures  {function:<17} {implementation:<8}"
+                    f"{record['best_s']:9.4f} s {record['peak_mb']:9.1f} MB")
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    # Current-implementation timings that got slower than the baseline run by more than `tolerance`
+    key = ("grid", "structures", "function", "implementation")
+    previous = {tuple(record[k] for k in key): record for record in baseline["results"]}
+    regressions = []
+    for record in results:
+        before = previous.get(tuple(record[k] for k in key))
+        if record["implementation"] == "current" and before is not None:
+            ratio = record["best_s"] / before["best_s"]
+            if ratio > 1 + tolerance:
+                regressions.append({**{k: record[k] for k in key}, "before_s": before["best_s"],
+                                    "after_s": record["best_s"], "ratio": ratio})
+    return regressions
+
+
+def speedups(results):
+    table = pd.DataFrame(results)
+    if "legacy" not in set(table["implementation"]):
+        return table.iloc[:0]
+    pivot = table.pivot_table(index=["grid", "structures", "function"], columns="implementation", values="best_s")
+    pivot["speedup"] = pivot["legacy"] / pivot["current"]
+    return pivot
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the utils hot paths on synthetic phantoms.")
+    parser.add_argument("--sizes", nargs="+", default=["128"], choices=list(GRID_SIZES))
+    parser.add_argument("--structures", nargs="+", type=int, default=[10])
+    parser.add_argument("--plans", type=int, default=3, help="Dose volumes for dvh_by_dose")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--no-legacy", action="store_true", help="Skip the pre-optimisation reference code")
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--baseline", help="Earlier JSON output to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.structures, args.plans, args.repeats, not args.no_legacy)
+    report = {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.platform(),
+        },
+        "results": results,
+    }
+    with open(args.out, "w") as out:
+        json.dump(report, out, indent=2)
+
+    table = speedups(results)
+    if len(table):
+        print(table.to_string(float_format=lambda value: f"{value:.4f}"))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", json.dumps(regression))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from src import utils
+from src.cache import LRUCache
+from src.metrics import DEFAULT_METRICS, parse_metric_list
+from src.parallel import set_threads
+from src.profiling import Profiler, profiled, stage
+from src.store import ResultStore
+
+# Run this from >> python -m src.batch DATA_DIR_OR_MANIFEST OUT_DIR --workers 8
+
+DONE_MARKER = "done.json"
+
+
+def _stem(path):
+    return Path(path).name.split(".")[0]
+
+
+def discover_cases(data_dir, dose_pattern="dose*.nii.gz", mask_pattern="*.nii.gz"):
+    # One sub-directory per patient. Every file matching `dose_pattern` in it is a plan and every
+    # sub-directory holding masks is a segmentation; each plan is evaluated against each segmentation.
+    patients = {}
+    for patient_dir in sorted(path for path in Path(data_dir).iterdir() if path.is_dir()):
+        doses = sorted(patient_dir.glob(dose_pattern))
+        segmentations = sorted(path for path in patient_dir.iterdir() if path.is_dir())
+        cases = []
+        for dose in doses:
+            for segmentation in segmentations:
+                masks = sorted(str(mask) for mask in segmentation.glob(mask_pattern))
+                if masks:
+                    cases.append({"plan": _stem(dose), "dose": str(dose),
+                                  "segmentation": segmentation.name, "masks": masks})
+        if cases:
+            patients[patient_dir.name] = cases
+    return patients
+
+
+def read_manifest(manifest_file, mask_pattern="*.nii.gz"):
+    # CSV with columns patient, dose, masks (a directory or a glob) and optionally plan, segmentation
+    manifest = pd.read_csv(manifest_file)
+    base_dir = Path(manifest_file).parent
+    patients = {}
+    for row in manifest.to_dict("records"):
+        masks = base_dir / str(row["masks"])
+        mask_paths = sorted(masks.glob(mask_pattern)) if masks.is_dir() else sorted(base_dir.glob(str(row["masks"])))
+        dose = base_dir / str(row["dose"])
+        patients.setdefault(str(row["patient"]), []).append({
+            "plan": str(row["plan"]) if pd.notna(row.get("plan")) else _stem(dose),
+            "dose": str(dose),
+            "segmentation": str(row["segmentation"]) if pd.notna(row.get("segmentation")) else masks.name,
+            "masks": [str(path) for path in mask_paths],
+        })
+    return patients
+
+
+def read_constraints(constraint_file=None):
+    if constraint_file is None:
+        return utils.get_default_constraints()
+    return pd.read_csv(constraint_file)
+
+
+@profiled
+def evaluate_case(dose_volume, structure_masks, constraint, metrics=DEFAULT_METRICS, voxel_cc=None,
+                  supersample=None):
+    label_map = utils.fuse_masks(structure_masks)
+    dvh = utils.dvh_by_structure(dose_volume, label_map, supersample=supersample)
+    metrics = list(dict.fromkeys(list(metrics) + utils.constraint_metrics(constraint)))
+    summary = utils.dose_summary(dose_volume, label_map, metrics=metrics, voxel_cc=voxel_cc, supersample=supersample)
+    compliance = utils.check_compliance(summary, constraint)
+    return dvh, summary, compliance
+
+
+def _open_all(paths):
+    return [open(path, "rb") for path in paths]
+
+
+def evaluate_patient(patient, cases, out_dir, constraint, metrics=DEFAULT_METRICS, supersample=None, store=None,
+                     profile=False, profile_memory=False):
+    # With `profile` the per-stage timings go to <patient>/profile.json and runs.jsonl; `profile_memory`
+    # adds the memory peaks, at the cost of slower (tracemalloc-traced) timings
+    if profile or profile_memory:
+        with Profiler(patient, memory=profile_memory) as profiler:
+            record = evaluate_patient(patient, cases, out_dir, constraint, metrics, supersample, store)
+        report = profiler.report()
+        (Path(out_dir) / patient / "profile.json").write_text(json.dumps(report, indent=1))
+        return dict(record, profile=report)
+    started = time.perf_counter()
+    out_dir = Path(out_dir)
+    work_dir = out_dir / f".{patient}.partial"
+    shutil.rmtree(work_dir, ignore_errors=True)
+    work_dir.mkdir(parents=True)
+
+    # Plans and segmentations are shared between the cases of a patient; decode each file once
+    volume_cache = LRUCache(max_bytes=4 << 30)
+    tables = {"dvh": [], "summary": [], "compliance": []}
+    for case in cases:
+        files = _open_all([case["dose"]] + case["masks"])
+        try:
+            dose_volume, dose_header = utils.read_dose(files[0], cache=volume_cache)
+            structure_masks = utils.read_masks(files[1:], compact=True, cache=volume_cache, dose_header=dose_header)
+        finally:
+            for file in files:
+                file.close()
+
+        dvh, summary, compliance = evaluate_case(dose_volume, structure_masks, constraint, metrics,
+                                                 utils.voxel_volume_cc(dose_header), supersample)
+        for name, table in zip(tables, (dvh, summary.rename_axis("Structure").reset_index(),
+                                        compliance.rename_axis("Structure").reset_index())):
+            table.insert(0, "Segmentation", case["segmentation"])
+            table.insert(0, "Plan", case["plan"])
+            tables[name].append(table)
+
+    with stage("write_tables"):
+        tables = {name: pd.concat(frames, ignore_index=True) for name, frames in tables.items()}
+        for name, table in tables.items():
+            table.to_csv(work_dir / f"{name}.csv", index=False)
+        if store is not None:
+            ResultStore(store).write_patient(patient, tables)
+    record = {"patient": patient, "cases": len(cases), "seconds": round(time.perf_counter() - started, 3)}
+    (work_dir / DONE_MARKER).write_text(json.dumps(record))
+
+    patient_dir = out_dir / patient
+    shutil.rmtree(patient_dir, ignore_errors=True)
+    os.replace(work_dir, patient_dir)
+    return record
+
+
+def is_done(out_dir, patient):
+    return (Path(out_dir) / patient / DONE_MARKER).exists()
+
+
+def run(patients, out_dir, constraint, workers=None, metrics=DEFAULT_METRICS, log=print, supersample=None,
+        store=None, profile=False, profile_memory=False):
+    # Patients already written by an earlier (possibly interrupted) run are skipped. Every finished
+    # patient is appended to runs.jsonl; failed patients are logged and retried on the next run.
+    # Given `store` (a directory), the tables also go to its Parquet datasets (see src.store).
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    pending = {patient: cases for patient, cases in patients.items() if not is_done(out_dir, patient)}
+    log(f"{len(patients) - len(pending)} of {len(patients)} patients already done, {len(pending)} to evaluate")
+
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_threads, initargs=(1,)) as executor, open(out_dir / "runs.jsonl", "a") as run_log:
+        futures = {executor.submit(evaluate_patient, patient, cases, out_dir, constraint, metrics, supersample,
+                                   store, profile, profile_memory): patient
+                   for patient, cases in pending.items()}
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+            except Exception as error:
+                failures += 1
+                record = {"patient": futures[future], "error": repr(error)}
+            run_log.write(json.dumps(record) + "\n")
+            run_log.flush()
+            log(json.dumps({key: value for key, value in record.items() if key != "profile"}))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate DVHs, dose summaries and compliance for a cohort.")
+    parser.add_argument("source", help="Directory with one sub-directory per patient, or a manifest CSV with "
+                                       "columns patient, dose, masks[, plan, segmentation] (relative paths)")
+    parser.add_argument("out_dir", help="Directory receiving <patient>/dvh.csv, summary.csv and compliance.csv")
+    parser.add_argument("--dose-pattern", default="dose*.nii.gz")
+    parser.add_argument("--mask-pattern", default="*.nii.gz")
+    parser.add_argument("--constraints", help="Constraint CSV (Structure, Constraint Type, Level[, Metric, Operator])")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--metrics", nargs="*", default=[],
+                        help="Dose-volume metrics added to D95/D50/D5, e.g. D2 D98 D0.03cc V20")
+    parser.add_argument("--supersample", type=int, nargs="?", const=utils.SUPERSAMPLING,
+                        help="Partial-volume DVHs with this many sub-samples per axis of a surface voxel")
+    parser.add_argument("--store", help="Also write the tables to Parquet datasets in this directory, partitioned "
+                                        "by patient")
+    parser.add_argument("--profile", action="store_true",
+                        help="Record per-stage timings of every patient (profile.json, runs.jsonl)")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="Also record per-stage memory peaks; tracing the allocations slows the timings down")
+    args = parser.parse_args(argv)
+
+    if Path(args.source).is_file():
+        patients = read_manifest(args.source, args.mask_pattern)
+    else:
+        patients = discover_cases(args.source, args.dose_pattern, args.mask_pattern)
+    metrics = list(DEFAULT_METRICS) + parse_metric_list(" ".join(args.metrics))
+    failures = run(patients, args.out_dir, read_constraints(args.constraints), args.workers, metrics,
+                   supersample=args.supersample, store=args.store, profile=args.profile,
+                   profile_memory=args.profile_memory)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
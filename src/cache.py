@@ -0,0 +1,250 @@
+import os
+import hashlib
+import weakref
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from src.histogram import DoseHistogram
+from src.structure import CompactMask, LabelMap
+
+
+def content_hash(byte_file, chunk_size=1 << 24):
+    digest = hashlib.blake2b(digest_size=16)
+    if hasattr(byte_file, "getbuffer"):
+        # In-memory uploads are hashed without copying their bytes
+        digest.update(byte_file.getbuffer())
+    else:
+        position = byte_file.tell()
+        byte_file.seek(0)
+        for chunk in iter(lambda: byte_file.read(chunk_size), b""):
+            digest.update(chunk)
+        byte_file.seek(position)
+    return digest.hexdigest()
+
+
+def nbytes(value):
+    if isinstance(value, (np.ndarray, CompactMask)):
+        return value.nbytes
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(nbytes(item) for item in value.values())
+    return 0
+
+
+class LRUCache:
+    # Least-recently-used cache bounded by the total size of its values and optionally by entry count.
+    # Safe to share between threads; values are computed outside the lock, so two threads missing
+    # the same key at once both compute it.
+
+    def __init__(self, max_bytes=2 << 30, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        size = nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                old_value, old_size = self._entries.pop(key)
+                self.current_bytes -= old_size
+                self._evicted(key, old_value)
+            if size > self.max_bytes:
+                # Never worth evicting everything else for a value that could not stay anyway
+                return value
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            self._evict()
+            return value
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._entries:
+                return self.get(key)
+            self.misses += 1
+        return self.put(key, compute())
+
+    def _evict(self):
+        while self._entries and (self.current_bytes > self.max_bytes or
+                                 (self.max_entries is not None and len(self._entries) > self.max_entries)):
+            key, (value, size) = self._entries.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+            self._evicted(key, value)
+
+    def _evicted(self, key, value):
+        pass
+
+    def clear(self):
+        with self._lock:
+            for key, (value, _) in self._entries.items():
+                self._evicted(key, value)
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Fingerprints of the volumes handed out by cached_read, derived from the bytes of their file so
+# that they never have to be hashed again. Entries disappear with the volume they describe.
+_known_fingerprints = {}
+
+
+def _remember_fingerprint(value, digest):
+    _known_fingerprints[id(value)] = digest
+    weakref.finalize(value, _known_fingerprints.pop, id(value), None)
+
+
+def _digest(*parts):
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part if isinstance(part, (bytes, memoryview)) else repr(part).encode())
+    return digest.hexdigest()
+
+
+# Values whose repr is their content
+PLAIN_TYPES = (bool, int, float, complex, str, bytes, np.generic)
+
+
+def fingerprint(value, known=None):
+    # Content key of an argument of a cached computation: volumes, masks, label maps, tables and plain values
+    if known is not None and id(value) in known:
+        return known[id(value)]
+    if id(value) in _known_fingerprints:
+        return _known_fingerprints[id(value)]
+    if isinstance(value, np.ndarray):
+        return _digest(value.dtype.str, value.shape, memoryview(np.ascontiguousarray(value)).cast("B"))
+    if isinstance(value, CompactMask):
+        stored = value._indices if value._indices is not None else value._packed
+        return _digest("mask", value.shape, value.box, memoryview(stored).cast("B"))
+    if isinstance(value, LabelMap):
+        return _digest("labels", value.names, value.shape,
+                       *(fingerprint(array) for array in (value.voxels, value.labels, value.membership)))
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        labels = list(value.columns) if isinstance(value, pd.DataFrame) else [value.name]
+        return _digest(type(value).__name__, list(value.index), labels,
+                       memoryview(pd.util.hash_pandas_object(value, index=True).to_numpy()).cast("B"))
+    if isinstance(value, dict):
+        return _digest("dict", *((key, fingerprint(item, known)) for key, item in value.items()))
+    if isinstance(value, (tuple, list)):
+        return _digest(type(value).__name__, *(fingerprint(item, known) for item in value))
+    if isinstance(value, DoseHistogram):
+        return _digest("histogram", fingerprint(value.bins), fingerprint(value.counts),
+                       value.count, value.sum, value.min, value.max)
+    if value is None or isinstance(value, PLAIN_TYPES):
+        return _digest(type(value).__name__, value)
+    # The repr of other objects holds their address, which is neither stable nor unique over time
+    raise TypeError(f"Cannot fingerprint a {type(value).__name__} argument")
+
+
+def _read_only(value):
+    # Cached arrays are shared between reruns, so nobody gets to modify them in place
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            _read_only(item)
+    return value
+
+
+def cached_read(cache, byte_file, reader, *key_parts):
+    # Decode `byte_file` with `reader` unless a file with the same bytes was decoded the same way before
+    if cache is None:
+        return reader(byte_file)
+    key = (content_hash(byte_file), reader.__name__) + key_parts
+
+    def read():
+        value = _read_only(reader(byte_file))
+        for position, item in enumerate(value):
+            if isinstance(item, (np.ndarray, CompactMask)):
+                _remember_fingerprint(item, _digest(*key, position))
+        return value
+
+    return cache.get_or_compute(key, read)
+
+
+class ResultCache(LRUCache):
+    # Memoizes derived results (DVH tables, summaries, compliance checks) on the fingerprints of their
+    # inputs, so a rerun that only changes what is displayed reuses them. A result returned from here
+    # is itself fingerprinted by the key that produced it, which makes chained calls cheap to key.
+
+    def __init__(self, max_bytes=256 << 20, max_entries=None):
+        super().__init__(max_bytes, max_entries)
+        self._result_fingerprints = {}
+
+    def key(self, func, *args, **kwargs):
+        return (func.__module__, func.__qualname__,
+                tuple(fingerprint(arg, self._result_fingerprints) for arg in args),
+                tuple(sorted((name, fingerprint(arg, self._result_fingerprints)) for name, arg in kwargs.items())))
+
+    def memoize(self, func, *args, **kwargs):
+        key = self.key(func, *args, **kwargs)
+        if key in self:
+            return self.get(key)
+        self.misses += 1
+        result = self.put(key, func(*args, **kwargs))
+        if key in self:
+            self._result_fingerprints[id(result)] = _digest(*key)
+        return result
+
+    def _evicted(self, key, value):
+        self._result_fingerprints.pop(id(value), None)
+
+
+def cache_limits(prefix, default_mb):
+    max_mb = os.environ.get(f"DOSE_EVALUATOR_{prefix}_CACHE_MB", str(default_mb))
+    max_entries = os.environ.get(f"DOSE_EVALUATOR_{prefix}_CACHE_ENTRIES")
+    return int(max_mb) << 20, int(max_entries) if max_entries else None
+
+
+def _session_cache(name, cache_class, prefix, default_mb):
+    import streamlit as st
+
+    if name not in st.session_state:
+        st.session_state[name] = cache_class(*cache_limits(prefix, default_mb))
+    return st.session_state[name]
+
+
+def session_volume_cache():
+    # One volume cache per Streamlit session, sized by DOSE_EVALUATOR_VOLUME_CACHE_MB/_ENTRIES
+    return _session_cache("volume_cache", LRUCache, "VOLUME", 2048)
+
+
+def session_result_cache():
+    # One result cache per Streamlit session, sized by DOSE_EVALUATOR_RESULT_CACHE_MB/_ENTRIES
+    return _session_cache("result_cache", ResultCache, "RESULT", 256)
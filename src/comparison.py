@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+
+from src import utils
+from src.parallel import thread_map
+from src.profiling import profiled
+from src.structure import CompactMask
+
+# Global gamma criteria: dose difference in % of the reference maximum, distance to agreement in mm, and
+# the dose (in % of the reference maximum) below which reference voxels are not evaluated
+GAMMA_DOSE_TOLERANCE = 3.0
+GAMMA_DISTANCE_MM = 3.0
+GAMMA_THRESHOLD = 10.0
+
+DIFFERENCE_COLUMNS = ["Mean Difference", "Min Difference", "Max Difference", "Mean Absolute Difference",
+                      "95% Absolute Difference"]
+
+
+def _compact(mask):
+    return mask if isinstance(mask, CompactMask) else CompactMask.from_dense(mask)
+
+
+def _slices(box):
+    return tuple(slice(start, stop) for start, stop in box)
+
+
+@profiled
+def difference_statistics(dose_volume, reference, structure_masks, step_size=utils.SUMMARY_STEP):
+    # Voxel-wise dose - reference per structure, from one gather of both doses on the fused label map.
+    # The signed and absolute differences are histogrammed together as two rows of the same pass.
+    label_map = utils.fuse_masks(structure_masks)
+    difference = (dose_volume.ravel()[label_map.voxels].astype(float)
+                  - reference.ravel()[label_map.voxels].astype(float))
+    extent = float(np.abs(difference).max()) if len(difference) else 0.0
+    edges = utils.auto_bins(extent, step_size)
+    bins = np.concatenate([-edges[:0:-1], edges])
+    signed, absolute = utils.row_histograms(np.stack([difference, np.abs(difference)]), label_map, bins)
+    rows = {}
+    for name in label_map.names:
+        if signed[name].count == 0:
+            rows[name] = dict.fromkeys(DIFFERENCE_COLUMNS, np.nan)
+            continue
+        rows[name] = dict(zip(DIFFERENCE_COLUMNS, [signed[name].mean, signed[name].min, signed[name].max,
+                                                   absolute[name].mean, float(absolute[name].percentile(95))]))
+    return pd.DataFrame.from_dict(rows, orient="index", columns=DIFFERENCE_COLUMNS)
+
+
+def difference_map(dose_volume, reference, mask):
+    # dose - reference over the bounding box of `mask`, NaN outside the structure; with the box
+    mask = _compact(mask)
+    box_mask = mask.box_mask()
+    difference = np.asarray(dose_volume[mask.slices], dtype=float) - np.asarray(reference[mask.slices], dtype=float)
+    return np.where(box_mask, difference, np.nan), mask.box
+
+
+def gamma_map(dose_volume, reference, box, spacing, dose_tolerance=GAMMA_DOSE_TOLERANCE,
+              distance_mm=GAMMA_DISTANCE_MM, normalization=None):
+    # Gamma index of the reference voxels in `box` against dose_volume, on the voxel grid: every shift
+    # of the evaluated dose within distance_mm is tried, one array pass per shift, and the smallest
+    # sqrt((dose difference / tolerance)^2 + (shift / distance)^2) is kept. Values up to 1 (a pass) are
+    # exact up to the grid spacing; above 1 they are an upper bound, since farther shifts cannot pass.
+    shape = dose_volume.shape
+    spacing = np.asarray(spacing, dtype=float)
+    radius = np.floor(distance_mm / spacing).astype(int)
+    normalization = float(np.max(reference)) if normalization is None else normalization
+    tolerance = dose_tolerance / 100 * normalization
+    reference_box = np.asarray(reference[_slices(box)], dtype=float)
+
+    # Evaluated dose over the box grown by the search radius; outside the grid nothing can match
+    grown = [(start - r, stop + r) for (start, stop), r in zip(box, radius)]
+    inside = [(max(start, 0), min(stop, size)) for (start, stop), size in zip(grown, shape)]
+    evaluated = np.full([stop - start for start, stop in grown], np.inf)
+    evaluated[tuple(slice(a - start, b - start) for (a, b), (start, _) in zip(inside, grown))] = \
+        np.asarray(dose_volume[_slices(inside)], dtype=float)
+
+    gamma = np.full(reference_box.shape, np.inf)
+    box_shape = reference_box.shape
+    for shift in np.ndindex(*(2 * radius + 1)):
+        offset = np.array(shift) - radius
+        distance = float(np.sum((offset * spacing) ** 2))
+        if distance > distance_mm ** 2:
+            continue
+        shifted = evaluated[tuple(slice(r + o, r + o + n) for r, o, n in zip(radius, offset, box_shape))]
+        np.minimum(gamma, ((shifted - reference_box) / tolerance) ** 2 + distance / distance_mm ** 2, out=gamma)
+    return np.sqrt(gamma)
+
+
+@profiled
+def gamma_pass_rates(dose_volume, reference, structure_masks, spacing, dose_tolerance=GAMMA_DOSE_TOLERANCE,
+                     distance_mm=GAMMA_DISTANCE_MM, threshold=GAMMA_THRESHOLD):
+    # Percentage of the structure voxels (with a reference dose above `threshold`) whose gamma is at most
+    # 1, and their mean gamma. Gamma is only evaluated over each structure's bounding box.
+    normalization = float(np.max(reference))
+    names = list(structure_masks)
+    masks = [_compact(structure_masks[name]) for name in names]
+
+    def structure_gamma(mask):
+        if mask.count() == 0:
+            return np.nan, np.nan
+        gamma = gamma_map(dose_volume, reference, mask.box, spacing, dose_tolerance, distance_mm, normalization)
+        reference_box = np.asarray(reference[mask.slices])
+        evaluated = mask.box_mask() & (reference_box >= threshold / 100 * normalization)
+        if not evaluated.any():
+            return np.nan, np.nan
+        return float(np.mean(gamma[evaluated] <= 1) * 100), float(np.mean(gamma[evaluated]))
+
+    rows = thread_map(structure_gamma, masks)
+    return pd.DataFrame(rows, index=names, columns=["Gamma Pass Rate (%)", "Mean Gamma"])
+
+
+@profiled
+def plan_comparison(dose_volume, reference, structure_masks, spacing, dose_tolerance=GAMMA_DOSE_TOLERANCE,
+                    distance_mm=GAMMA_DISTANCE_MM, threshold=GAMMA_THRESHOLD):
+    # difference_statistics and gamma_pass_rates of one plan against a reference plan, per structure
+    return difference_statistics(dose_volume, reference, structure_masks).join(
+        gamma_pass_rates(dose_volume, reference, structure_masks, spacing, dose_tolerance, distance_mm, threshold))
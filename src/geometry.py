@@ -0,0 +1,85 @@
+import numpy as np
+
+from src.profiling import profiled
+
+# Two grids are the same when their voxel-to-world affines agree to within this many mm
+GRID_TOLERANCE = 1e-3
+
+# Target z-planes resampled at a time, to bound the temporary coordinate arrays
+RESAMPLE_SLAB_SIZE = 16
+
+RESAMPLE_METHODS = ("nearest", "linear")
+
+
+def grid(header):
+    # (shape, affine) of the voxel grid a header describes
+    return tuple(int(n) for n in header.get_data_shape()[:3]), np.asarray(header.get_best_affine(), dtype=float)
+
+
+def same_grid(header, reference_header, tolerance=GRID_TOLERANCE):
+    shape, affine = grid(header)
+    reference_shape, reference_affine = grid(reference_header)
+    return shape == reference_shape and np.allclose(affine, reference_affine, rtol=0, atol=tolerance)
+
+
+def _target_box(inside, to_target, shape):
+    # Box of target voxels that can land inside the mask: its own bounding box, padded by a voxel
+    # and mapped to the target grid through its eight corners
+    bounds = [np.flatnonzero(inside.any(axis=tuple(a for a in range(3) if a != axis))) for axis in range(3)]
+    if any(len(b) == 0 for b in bounds):
+        return None
+    low = [b[0] - 1 for b in bounds]
+    high = [b[-1] + 1 for b in bounds]
+    corners = np.array([[x, y, z, 1] for x in (low[0], high[0]) for y in (low[1], high[1]) for z in (low[2], high[2])])
+    mapped = (to_target @ corners.T)[:3]
+    start = np.clip(np.floor(mapped.min(axis=1)).astype(int), 0, shape)
+    stop = np.clip(np.ceil(mapped.max(axis=1)).astype(int) + 1, 0, shape)
+    if np.any(start >= stop):
+        return None
+    return list(zip(start, stop))
+
+
+def _occupancy(inside, coords, method):
+    # Mask value at fractional voxel coordinates `coords` (3, ...) of `inside`; 0 outside the mask grid
+    if method == "nearest":
+        index = np.rint(coords).astype(np.intp)
+        valid = np.all((index >= 0) & (index < np.array(inside.shape)[:, None, None, None]), axis=0)
+        index = np.where(valid, index, 0)
+        return inside[index[0], index[1], index[2]] & valid
+
+    base = np.floor(coords).astype(np.intp)
+    fraction = coords - base
+    occupancy = np.zeros(coords.shape[1:])
+    for corner in np.ndindex(2, 2, 2):
+        index = base + np.array(corner)[:, None, None, None]
+        valid = np.all((index >= 0) & (index < np.array(inside.shape)[:, None, None, None]), axis=0)
+        index = np.where(valid, index, 0)
+        weight = np.prod([f if c else 1 - f for f, c in zip(fraction, corner)], axis=0)
+        occupancy += weight * (inside[index[0], index[1], index[2]] & valid)
+    return occupancy >= 0.5
+
+
+@profiled
+def resample_mask(mask, mask_affine, shape, affine, method="nearest", slab_size=RESAMPLE_SLAB_SIZE):
+    # Boolean mask on the grid (shape, affine). Each target voxel centre is mapped into the mask's voxel
+    # space and takes the nearest mask voxel, or the trilinear occupancy thresholded at one half.
+    # Only the target voxels around the mask's bounding box are computed, slab by slab.
+    if method not in RESAMPLE_METHODS:
+        raise ValueError(f"Unknown resampling method {method!r}, expected one of {RESAMPLE_METHODS}")
+    inside = np.asarray(mask) > 0
+    inside = inside.reshape(inside.shape[:3])
+    resampled = np.zeros(shape, dtype=bool)
+    to_source = np.linalg.inv(np.asarray(mask_affine, dtype=float)) @ np.asarray(affine, dtype=float)
+    box = _target_box(inside, np.linalg.inv(to_source), shape)
+    if box is None:
+        return resampled
+
+    (x0, x1), (y0, y1), (z0, z1) = box
+    i = np.arange(x0, x1)[:, None, None]
+    j = np.arange(y0, y1)[None, :, None]
+    for start in range(z0, z1, slab_size):
+        k = np.arange(start, min(start + slab_size, z1))[None, None, :]
+        coords = np.stack([to_source[axis, 0] * i + to_source[axis, 1] * j + to_source[axis, 2] * k
+                           + to_source[axis, 3] for axis in range(3)])
+        resampled[x0:x1, y0:y1, start:start + k.shape[2]] = _occupancy(inside, coords, method)
+    return resampled
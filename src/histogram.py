@@ -0,0 +1,196 @@
+import numpy as np
+
+
+def dvh_bins(max_dose, step_size=0.1):
+    return np.arange(0, max_dose, step_size)
+
+
+def auto_bins(max_dose, step_size=0.1):
+    # Edges up to one step past the maximum dose so every curve falls to 0%
+    n_bins = int(np.floor(max_dose / step_size)) + 2
+    return np.arange(n_bins) * step_size
+
+
+def bin_index(bins, dose_values):
+    # Same result as np.searchsorted(bins, dose_values, side="right"). Evenly spaced edges are located
+    # arithmetically and then nudged by one where float rounding put a value on the wrong side of its edge.
+    steps = np.diff(bins)
+    if len(bins) < 2 or not np.allclose(steps, steps[0]):
+        return np.searchsorted(bins, dose_values, side="right")
+
+    n_bins = len(bins)
+    index = np.floor((dose_values - bins[0]) / steps[0]).astype(np.intp)
+    index += 1
+    np.clip(index, 0, n_bins, out=index)
+    index -= (index > 0) & (dose_values < bins[np.maximum(index - 1, 0)])
+    index += (index < n_bins) & (dose_values >= bins[np.minimum(index, n_bins - 1)])
+    return index
+
+
+def histogram_counts(dose_values, bins, weights=None):
+    # counts[k] holds the voxels with bins[k-1] <= dose < bins[k]: counts[0] is everything below the
+    # first edge and counts[-1] everything at or above the last one, so len(counts) == len(bins) + 1.
+    return np.bincount(bin_index(bins, dose_values), weights=weights, minlength=len(bins) + 1)
+
+
+def cumulative_counts(counts):
+    # Number of voxels with dose >= bins[k], from the counts of histogram_counts
+    return np.cumsum(counts[::-1])[::-1][1:]
+
+
+class DoseHistogram:
+    # Running accumulator for one structure: dose bin counts plus the exact voxel count, dose sum, minimum
+    # and maximum. Voxels can be added (and removed again) in any number of pieces (slabs, scenarios,
+    # edits) and histograms of disjoint voxel sets over the same bins merge by addition. Counts are
+    # floats so that weighted samples (fractions of a voxel) accumulate the same way as whole voxels.
+
+    def __init__(self, bins):
+        self.bins = np.asarray(bins, dtype=float)
+        self.counts = np.zeros(len(self.bins) + 1)
+        self.count = 0.0
+        self.sum = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self._knots = None
+
+    @classmethod
+    def from_counts(cls, bins, counts, total, minimum, maximum):
+        histogram = cls(bins)
+        histogram.counts = np.asarray(counts, dtype=float)
+        histogram.count = float(histogram.counts.sum())
+        histogram.sum = float(total)
+        histogram.min = float(minimum)
+        histogram.max = float(maximum)
+        return histogram
+
+    def add(self, dose_values, weights=None):
+        dose_values = np.asarray(dose_values).ravel()
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float).ravel()
+            dose_values, weights = dose_values[weights > 0], weights[weights > 0]
+        if len(dose_values) == 0:
+            return self
+
+        self.counts += histogram_counts(dose_values, self.bins, weights)
+        if weights is None:
+            self.count += len(dose_values)
+            self.sum += float(np.sum(dose_values, dtype=np.float64))
+        else:
+            self.count += float(weights.sum())
+            self.sum += float(np.dot(dose_values.astype(np.float64), weights))
+        self.min = min(self.min, float(dose_values.min()))
+        self.max = max(self.max, float(dose_values.max()))
+        self._knots = None
+        return self
+
+    def remove(self, dose_values, weights=None):
+        # Inverse of add, for voxels that were added before. When a removed voxel held the minimum (or
+        # maximum), the new one is not known exactly any more; it falls back to the lower (upper) edge of
+        # the lowest (highest) bin still holding voxels, which never overstates the minimum nor
+        # understates the maximum and is at most one bin width off.
+        dose_values = np.asarray(dose_values).ravel()
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float).ravel()
+            dose_values, weights = dose_values[weights > 0], weights[weights > 0]
+        if len(dose_values) == 0:
+            return self
+
+        self.counts -= histogram_counts(dose_values, self.bins, weights)
+        # Weighted removals can leave rounding residue in emptied bins
+        self.counts[self.counts < 1e-9] = 0
+        if weights is None:
+            self.count -= len(dose_values)
+            self.sum -= float(np.sum(dose_values, dtype=np.float64))
+        else:
+            self.count -= float(weights.sum())
+            self.sum -= float(np.dot(dose_values.astype(np.float64), weights))
+        self._knots = None
+
+        occupied = np.flatnonzero(self.counts)
+        if len(occupied) == 0:
+            self.counts[:] = 0
+            self.count, self.sum, self.min, self.max = 0.0, 0.0, np.inf, -np.inf
+            return self
+        edges = np.concatenate([[-np.inf], self.bins, [np.inf]])
+        if dose_values.min() <= self.min:
+            self.min = max(float(edges[occupied[0]]), self.min)
+        if dose_values.max() >= self.max:
+            self.max = min(float(edges[occupied[-1] + 1]), self.max)
+        return self
+
+    def copy(self):
+        histogram = DoseHistogram.from_counts(self.bins, self.counts.copy(), self.sum, self.min, self.max)
+        histogram.count = self.count
+        return histogram
+
+    def merge(self, other):
+        if len(other.bins) != len(self.bins) or not np.array_equal(other.bins, self.bins):
+            raise ValueError("Histograms with different bins cannot be merged")
+        self.counts += other.counts
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._knots = None
+        return self
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else np.nan
+
+    def dvh(self, bins=None):
+        # Cumulative DVH in percent. Edges other than the histogram's own are located on its edges, which
+        # is exact when they are a subset of them and otherwise off by at most one bin width.
+        at_or_above = cumulative_counts(self.counts)
+        if bins is None:
+            bins = self.bins
+        else:
+            bins = np.asarray(bins, dtype=float)
+            # Edges that only differ by float rounding (3 * 0.1 and 30 * 0.01) are the same edge
+            tolerance = 1e-9 * max(float(np.abs(self.bins).max()), 1.0) if len(self.bins) else 0.0
+            positions = np.searchsorted(self.bins, bins - tolerance, side="left")
+            at_or_above = np.append(at_or_above, 0.0)[positions]
+        if self.count == 0:
+            return bins, np.zeros(len(bins))
+        return bins, at_or_above / self.count * 100
+
+    def _cdf_knots(self):
+        # Dose levels and the number of voxels below each, from the minimum (none below) through the
+        # bin edges inside the dose range to the maximum (all below). Built once, so every query after
+        # the first is a lookup on these knots.
+        if self._knots is None:
+            below = np.cumsum(self.counts)[:-1]
+            inside = (self.bins > self.min) & (self.bins < self.max)
+            doses = np.concatenate([[self.min], self.bins[inside], [self.max]])
+            counts_below = np.concatenate([[0.0], below[inside], [self.count]])
+            self._knots = doses, counts_below
+        return self._knots
+
+    def percentile(self, q):
+        # Same meaning as np.percentile of the voxel doses, assuming voxels spread evenly inside a bin:
+        # the error is at most one bin width
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan)
+        # np.percentile interpolates linearly between the two sorted voxels around rank q / 100 * (n - 1).
+        # Voxel i of the sorted doses fills the count range [i, i + 1] of the cumulative histogram, so its
+        # dose is read at the middle of that range, and the two neighbours are interpolated the same way.
+        doses, counts_below = self._cdf_knots()
+        ranks = np.asarray(q, dtype=float) / 100 * max(self.count - 1, 0)
+        lower = np.floor(ranks)
+        upper = np.minimum(lower + 1, max(self.count - 1, 0))
+        lower_dose = np.interp(lower + 0.5, counts_below, doses)
+        upper_dose = np.interp(upper + 0.5, counts_below, doses)
+        return lower_dose + (ranks - lower) * (upper_dose - lower_dose)
+
+    def count_at_or_above(self, dose):
+        if self.count == 0:
+            return np.zeros(np.shape(dose))
+        doses, counts_below = self._cdf_knots()
+        return self.count - np.interp(dose, doses, counts_below)
+
+    def dose_to_hottest(self, n_voxels):
+        # Lowest dose received by the hottest `n_voxels` voxels (fractions allowed)
+        if self.count == 0:
+            return np.full(np.shape(n_voxels), np.nan)
+        doses, counts_below = self._cdf_knots()
+        return np.interp(self.count - np.clip(n_voxels, 0, self.count), counts_below, doses)
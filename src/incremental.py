@@ -0,0 +1,118 @@
+import numpy as np
+
+from src import utils
+from src.histogram import DoseHistogram
+from src.metrics import DEFAULT_METRICS
+from src.structure import CompactMask
+
+
+def _flat_indices(voxels, shape):
+    # Flat voxel indices from a boolean/label volume, a CompactMask or an index array
+    if isinstance(voxels, CompactMask):
+        return voxels.indices()
+    voxels = np.asarray(voxels)
+    if voxels.shape == tuple(shape):
+        return np.flatnonzero(voxels > 0)
+    return voxels.ravel().astype(np.intp, copy=False)
+
+
+def _in_box(box_mask, box, outer):
+    # box_mask (over `box`) placed in a zero mask over `outer`, a box around it
+    placed = np.zeros([stop - start for start, stop in outer], dtype=bool)
+    if box_mask.size:
+        placed[tuple(slice(a - start, b - start) for (a, b), (start, _) in zip(box, outer))] = box_mask
+    return placed
+
+
+class IncrementalDVH:
+    # DVH and dose summary of one structure on one dose volume that follow edits of the structure's mask.
+    # An edit only touches the voxels it adds or removes: their doses are added to or removed from the
+    # running histogram, so updating costs time proportional to the edit, not to the structure. The
+    # structure's voxels are kept as a boolean mask over its bounding box, which grows with the edits.
+    # The histogram bins span the whole dose volume so that any voxel the structure grows into fits.
+
+    def __init__(self, dose_volume, mask, step_size=utils.SUMMARY_STEP, bins=None):
+        self.dose = np.asarray(dose_volume)
+        self.shape = self.dose.shape
+        if bins is None:
+            bins = utils.auto_bins(float(self.dose.max()) if self.dose.size else 0.0, step_size)
+        self.box = [(0, 0)] * self.dose.ndim
+        self.inside = np.zeros([0] * self.dose.ndim, dtype=bool)
+        self.histogram = DoseHistogram(bins)
+        self.set_mask(mask)
+
+    @property
+    def slices(self):
+        return tuple(slice(start, stop) for start, stop in self.box)
+
+    def _empty(self):
+        return any(start >= stop for start, stop in self.box)
+
+    def _grow_box(self, coords):
+        box = [(int(c.min()), int(c.max()) + 1) for c in coords]
+        if not self._empty():
+            box = [(min(a, c), max(b, d)) for (a, b), (c, d) in zip(self.box, box)]
+        if box != self.box:
+            self.inside = _in_box(self.inside, self.box, box)
+            self.box = box
+
+    def _local(self, coords):
+        return tuple(c - start for c, (start, _) in zip(coords, self.box))
+
+    def update(self, added=None, removed=None):
+        # `added` and `removed` are voxel masks or flat voxel indices. Voxels already in (or already out
+        # of) the structure are ignored, so an edit can be applied twice without harm.
+        if removed is not None:
+            coords = np.unravel_index(np.unique(_flat_indices(removed, self.shape)), self.shape)
+            within = np.logical_and.reduce([(c >= start) & (c < stop) for c, (start, stop) in zip(coords, self.box)])
+            coords = tuple(c[within] for c in coords)
+            coords = tuple(c[self.inside[self._local(coords)]] for c in coords)
+            if len(coords[0]):
+                self.inside[self._local(coords)] = False
+                self._remove(self.dose[coords])
+        if added is not None:
+            coords = np.unravel_index(np.unique(_flat_indices(added, self.shape)), self.shape)
+            if len(coords[0]):
+                self._grow_box(coords)
+                coords = tuple(c[~self.inside[self._local(coords)]] for c in coords)
+                self.inside[self._local(coords)] = True
+                self.histogram.add(self.dose[coords])
+        return self
+
+    def _remove(self, dose_values):
+        # The histogram alone only bounds a minimum or maximum that was removed; the remaining voxels of
+        # the box give it exactly
+        minimum, maximum = self.histogram.min, self.histogram.max
+        self.histogram.remove(dose_values)
+        if self.histogram.count and (dose_values.min() <= minimum or dose_values.max() >= maximum):
+            remaining = self.dose[self.slices][self.inside]
+            self.histogram.min, self.histogram.max = float(remaining.min()), float(remaining.max())
+
+    def set_mask(self, mask):
+        # Move to another version of the structure, applying only the difference to the current one.
+        # The comparison covers the bounding boxes of both versions, never the whole grid.
+        if not isinstance(mask, CompactMask):
+            mask = CompactMask.from_dense(mask)
+        if any(a >= b for a, b in mask.box):
+            return self.update(removed=self._flat(self.inside))
+        box = mask.box if self._empty() else [(min(a, c), max(b, d)) for (a, b), (c, d) in zip(self.box, mask.box)]
+        current = self.inside = _in_box(self.inside, self.box, box)
+        self.box = box
+        wanted = _in_box(mask.box_mask(), mask.box, box)
+        dose_box = self.dose[self.slices]
+        added, removed = wanted & ~current, current & ~wanted
+        self.inside = wanted
+        if removed.any():
+            self._remove(dose_box[removed])
+        self.histogram.add(dose_box[added])
+        return self
+
+    def _flat(self, box_mask):
+        offsets = np.array([start for start, _ in self.box])[:, None]
+        return np.ravel_multi_index(np.array(np.nonzero(box_mask)) + offsets, self.shape)
+
+    def dvh(self, bins=None):
+        return self.histogram.dvh(bins)
+
+    def summary(self, metrics=DEFAULT_METRICS, voxel_cc=None, structure=None, grid=None):
+        return utils.histogram_summary(self.histogram, metrics, voxel_cc, structure, grid)
@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import tempfile
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from src import utils
+from src.batch import discover_cases, read_constraints, read_manifest
+from src.cache import content_hash
+from src.histogram import DoseHistogram
+from src.metrics import DEFAULT_METRICS
+from src.parallel import set_threads
+
+# Run this from >> python -m src.index build DATA_DIR_OR_MANIFEST INDEX_DIR --workers 8
+#           then >> python -m src.index check INDEX_DIR protocol.csv compliance.csv
+
+MANIFEST = "cases.jsonl"
+
+CASE_COLUMNS = ["patient", "plan", "segmentation"]
+
+
+def _structure_name(mask_file):
+    return Path(mask_file.name).name.split(".")[0]
+
+
+def case_key(dose_file, mask_files, supersample=None, resample="nearest"):
+    # Content hash of a case: the bytes of its dose and masks (with the structure names) and the options
+    # that change its histograms. Renamed or moved files keep their key; edited ones get a new one.
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(content_hash(dose_file).encode())
+    for mask_file in sorted(mask_files, key=_structure_name):
+        digest.update(f"{_structure_name(mask_file)}:{content_hash(mask_file)}".encode())
+    digest.update(json.dumps([supersample, resample]).encode())
+    return digest.hexdigest()
+
+
+def save_histograms(path, histograms, voxel_cc):
+    # One compressed .npz per case. Each structure keeps only the bins from its lowest to its highest
+    # occupied one; all histograms of a case share the same edges.
+    names = list(histograms)
+    bins = next(iter(histograms.values())).bins if histograms else np.zeros(0)
+    starts, lengths, counts = [], [], []
+    for histogram in histograms.values():
+        occupied = np.flatnonzero(histogram.counts)
+        start, stop = (occupied[0], occupied[-1] + 1) if len(occupied) else (0, 0)
+        starts.append(start)
+        lengths.append(stop - start)
+        counts.append(histogram.counts[start:stop])
+    # Workers indexing cases with the same content race to write the same file: each writes its own
+    # temporary file next to it, and the last rename wins with identical bytes
+    file = tempfile.NamedTemporaryFile(dir=path.parent, prefix=f".{path.name}.", suffix=".partial", delete=False)
+    try:
+        with file:
+            np.savez_compressed(file, names=np.array(names, dtype=str), bins=bins,
+                                starts=np.array(starts, dtype=np.int64), lengths=np.array(lengths, dtype=np.int64),
+                                counts=np.concatenate(counts) if counts else np.zeros(0),
+                                sums=np.array([histogram.sum for histogram in histograms.values()]),
+                                mins=np.array([histogram.min for histogram in histograms.values()]),
+                                maxs=np.array([histogram.max for histogram in histograms.values()]),
+                                voxel_cc=np.array(np.nan if voxel_cc is None else voxel_cc))
+        os.replace(file.name, path)
+    except BaseException:
+        if os.path.exists(file.name):
+            os.remove(file.name)
+        raise
+
+
+def load_histograms(path, structures=None):
+    # ({structure: DoseHistogram}, voxel_cc) of a case, optionally only of the given structures
+    with np.load(path) as data:
+        names, bins, counts = list(data["names"]), data["bins"], data["counts"]
+        offsets = np.concatenate([[0], np.cumsum(data["lengths"])])
+        histograms = {}
+        for index, name in enumerate(names):
+            if structures is not None and name not in structures:
+                continue
+            full = np.zeros(len(bins) + 1)
+            start = data["starts"][index]
+            full[start:start + data["lengths"][index]] = counts[offsets[index]:offsets[index + 1]]
+            histograms[name] = DoseHistogram.from_counts(bins, full, data["sums"][index], data["mins"][index],
+                                                         data["maxs"][index])
+        voxel_cc = float(data["voxel_cc"])
+    return histograms, None if np.isnan(voxel_cc) else voxel_cc
+
+
+class DVHIndex:
+    # Directory of per-case dose histograms (SUMMARY_STEP bins, plus exact count, sum, min and max per
+    # structure) stored under the content hash of the case, and a manifest naming the cases
+    # (patient, plan, segmentation -> key). Every dose_summary metric, and so every constraint table,
+    # can be evaluated from these histograms without reading a voxel.
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key):
+        return self.root / key[:2] / f"{key}.npz"
+
+    def __contains__(self, key):
+        return self.path(key).exists()
+
+    def add(self, key, histograms, voxel_cc=None):
+        # A case some other writer stored in the meantime has the same content, so it is kept as it is
+        if key in self:
+            return key
+        self.path(key).parent.mkdir(exist_ok=True)
+        save_histograms(self.path(key), histograms, voxel_cc)
+        return key
+
+    def add_case(self, dose_file, mask_files, supersample=None, resample="nearest"):
+        # Key of a case, histogrammed unless the index already holds it
+        key = case_key(dose_file, mask_files, supersample, resample)
+        if key not in self:
+            dose_volume, dose_header = utils.read_dose(dose_file)
+            structure_masks = utils.read_masks(mask_files, compact=True, dose_header=dose_header, resample=resample)
+            histograms = utils.structure_dose_histograms(dose_volume, structure_masks, supersample=supersample)
+            self.add(key, histograms, utils.voxel_volume_cc(dose_header))
+        return key
+
+    def register(self, records):
+        # Appends manifest lines {"patient", "plan", "segmentation", "key"}; later lines win
+        with open(self.root / MANIFEST, "a") as manifest:
+            for record in records:
+                manifest.write(json.dumps(record) + "\n")
+
+    def cases(self):
+        path = self.root / MANIFEST
+        if not path.exists():
+            return pd.DataFrame(columns=["patient", "plan", "segmentation", "key"])
+        cases = pd.read_json(path, lines=True, dtype={"patient": str, "plan": str, "segmentation": str})
+        return cases.drop_duplicates(["patient", "plan", "segmentation"], keep="last").reset_index(drop=True)
+
+    def histograms(self, key, structures=None):
+        return load_histograms(self.path(key), structures)
+
+    def summary(self, metrics=DEFAULT_METRICS, structures=None):
+        # dose_summary of every indexed case as one long table (patient, plan, segmentation, Structure, ...).
+        # Only structure histograms are stored, so CIx (which needs the whole dose grid) comes back empty.
+        frames = []
+        for case in self.cases().to_dict("records"):
+            histograms, voxel_cc = self.histograms(case["key"], structures)
+            summary = pd.DataFrame.from_dict({name: utils.histogram_summary(histogram, metrics, voxel_cc, name)
+                                              for name, histogram in histograms.items()}).T
+            frames.append(summary.rename_axis("Structure").reset_index()
+                          .assign(patient=case["patient"], plan=case["plan"], segmentation=case["segmentation"]))
+        return _leading(pd.concat(frames, ignore_index=True) if frames else pd.DataFrame())
+
+    def check(self, constraint, metrics=()):
+        # check_compliance of every indexed case against a (new) constraint table. Only the structures and
+        # metrics the table names are evaluated.
+        metrics = list(dict.fromkeys(list(metrics) + utils.constraint_metrics(constraint)))
+        structures = set(constraint["Structure"].astype(str))
+        frames = []
+        for case in self.cases().to_dict("records"):
+            histograms, voxel_cc = self.histograms(case["key"], structures)
+            summary = pd.DataFrame.from_dict({name: utils.histogram_summary(histogram, metrics, voxel_cc, name)
+                                              for name, histogram in histograms.items()}).T
+            if summary.empty:
+                summary = pd.DataFrame(columns=list(utils.DOSE_STATISTICS) + metrics)
+            compliance = utils.check_compliance(summary, constraint)
+            frames.append(compliance.rename_axis("Structure").reset_index()
+                          .assign(patient=case["patient"], plan=case["plan"], segmentation=case["segmentation"]))
+        if not frames:
+            return pd.DataFrame(columns=CASE_COLUMNS + ["Structure", "Compliance", "Reason"])
+        return _leading(pd.concat(frames, ignore_index=True))
+
+
+def _leading(df, columns=tuple(CASE_COLUMNS)):
+    present = [column for column in columns if column in df]
+    return df[present + [column for column in df.columns if column not in present]]
+
+
+def index_patient(root, patient, cases, supersample=None):
+    # Histograms every case of a patient that the index does not hold yet; returns the manifest records
+    index = DVHIndex(root)
+    records = []
+    for case in cases:
+        files = [open(path, "rb") for path in [case["dose"]] + case["masks"]]
+        try:
+            key = index.add_case(files[0], files[1:], supersample)
+        finally:
+            for file in files:
+                file.close()
+        records.append({"patient": patient, "plan": case["plan"], "segmentation": case["segmentation"], "key": key})
+    return records
+
+
+def build(patients, root, workers=None, supersample=None, log=print):
+    # Cases already indexed (same content) cost one hash of their files
+    index = DVHIndex(root)
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_threads, initargs=(1,)) as executor:
+        futures = {executor.submit(index_patient, root, patient, cases, supersample): patient
+                   for patient, cases in patients.items()}
+        for future in as_completed(futures):
+            try:
+                index.register(future.result())
+                log(json.dumps({"patient": futures[future], "cases": len(patients[futures[future]])}))
+            except Exception as error:
+                failures += 1
+                log(json.dumps({"patient": futures[future], "error": repr(error)}))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index per-case dose histograms and re-score cohorts from them.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="Histogram every case of a cohort into the index")
+    build_parser.add_argument("source", help="Patient directory tree or manifest CSV, as for src.batch")
+    build_parser.add_argument("index_dir")
+    build_parser.add_argument("--dose-pattern", default="dose*.nii.gz")
+    build_parser.add_argument("--mask-pattern", default="*.nii.gz")
+    build_parser.add_argument("--workers", type=int, default=os.cpu_count())
+    build_parser.add_argument("--supersample", type=int, nargs="?", const=utils.SUPERSAMPLING)
+    check_parser = commands.add_parser("check", help="Check every indexed case against a constraint table")
+    check_parser.add_argument("index_dir")
+    check_parser.add_argument("constraints", nargs="?", help="Constraint CSV (the default protocol if omitted)")
+    check_parser.add_argument("out_file", nargs="?", help="CSV receiving the compliance of every case")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        if Path(args.source).is_file():
+            patients = read_manifest(args.source, args.mask_pattern)
+        else:
+            patients = discover_cases(args.source, args.dose_pattern, args.mask_pattern)
+        return 1 if build(patients, args.index_dir, args.workers, args.supersample) else 0
+
+    compliance = DVHIndex(args.index_dir).check(read_constraints(args.constraints))
+    if args.out_file:
+        compliance.to_csv(args.out_file, index=False)
+    if compliance.empty:
+        print(f"No indexed cases in {args.index_dir}; run the build command first")
+        return 0
+    failed = compliance[compliance["Compliance"] == "❌ No"]
+    print(f"{failed['patient'].nunique()} of {compliance['patient'].nunique()} patients violate a constraint")
+    if not failed.empty:
+        print(failed.to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
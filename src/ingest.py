@@ -0,0 +1,94 @@
+import os
+import zlib
+
+import numpy as np
+import nibabel as nib
+from nibabel import Nifti1Image
+
+from src.profiling import profiled
+
+DOSE_DTYPE = np.float32
+
+# zlib releases the GIL while inflating, so files decoded on separate threads (src.parallel.thread_map)
+# decompress in parallel
+INGEST_WORKERS = int(os.environ.get("DOSE_EVALUATOR_INGEST_WORKERS", min(8, os.cpu_count() or 1)))
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def disk_path(source):
+    # Path of a volume that lives on disk: a path, or a file opened from one. Uploads (in-memory
+    # files) have a `name` too, but it is not a path on this machine.
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    try:
+        source.fileno()
+    except (AttributeError, OSError):
+        return None
+    return source.name
+
+
+def file_bytes(source):
+    # Whole NIfTI file, gunzipped in one call instead of streamed through GzipFile
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as file:
+            data = file.read()
+    elif hasattr(source, "getbuffer"):
+        # In-memory uploads are decompressed straight from their buffer
+        data = source.getbuffer()
+    else:
+        position = source.tell()
+        source.seek(0)
+        data = source.read()
+        source.seek(position)
+    if data[:2] == GZIP_MAGIC:
+        # wbits=47 reads gzip members, concatenated ones included, like gzip.decompress
+        inflate = zlib.decompressobj(wbits=47)
+        chunks = [inflate.decompress(data)]
+        while inflate.eof and inflate.unused_data[:2] == GZIP_MAGIC:
+            remaining = inflate.unused_data
+            inflate = zlib.decompressobj(wbits=47)
+            chunks.append(inflate.decompress(remaining))
+        return b"".join(chunks) if len(chunks) > 1 else chunks[0]
+    return bytes(data)
+
+
+def load_image(source, mmap=True):
+    # Image and its stored (unscaled) voxel values. Uncompressed files on disk are memory-mapped;
+    # everything else is decompressed once and the values are a read-only view of those bytes.
+    path = disk_path(source)
+    if mmap and path is not None and not path.endswith(".gz"):
+        img = nib.load(path, mmap=True)
+        return img, img.dataobj.get_unscaled()
+    data = file_bytes(source)
+    img = Nifti1Image.from_bytes(data)
+    proxy = img.dataobj
+    return img, np.ndarray(proxy.shape, proxy.dtype, buffer=data, offset=proxy.offset, order="F")
+
+
+def dose_volume(img, raw, dtype=DOSE_DTYPE):
+    # Scaled values in `dtype`, converted in one pass
+    # nibabel moves the scaling from the header to the array proxy when it loads an image
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    volume = raw.astype(dtype, copy=False)
+    if slope != 1:
+        volume = volume * dtype(slope)
+    if inter != 0:
+        volume = volume + dtype(inter)
+    return volume
+
+
+def mask_volume(img, raw):
+    # Integer and boolean masks stay in their stored type; anything else becomes a boolean mask
+    # (every consumer only asks for `mask > 0`)
+    unscaled = img.dataobj.slope == 1 and img.dataobj.inter == 0
+    if unscaled and (raw.dtype == bool or np.issubdtype(raw.dtype, np.integer)):
+        return raw
+    return dose_volume(img, raw) > 0
+
+
+@profiled
+def read_volume(source, kind="dose"):
+    img, raw = load_image(source)
+    volume = dose_volume(img, raw) if kind == "dose" else mask_volume(img, raw)
+    return volume, img.header
@@ -0,0 +1,200 @@
+import re
+import math
+
+import numpy as np
+
+# Dose-volume metrics read off a DoseHistogram:
+#   Dx     the x-th percentile of the voxel doses, as in dose_summary's D95/D50/D5
+#   Dxcc   the lowest dose received by the hottest x cc
+#   Vx     the percentage of the structure receiving at least x Gy (also written VxGy)
+#   Vxcc   the volume in cc receiving at least x Gy
+# Every query is an interpolation on the structure's cumulative histogram, so its error is bounded by the
+# histogram's bin width (SUMMARY_STEP for dose_summary).
+#
+# Further metric families are registered with register_metric (see below): gEUD, NTCP, HI and CIx.
+DEFAULT_METRICS = ("D95", "D50", "D5")
+
+_METRIC_PATTERN = re.compile(r"^([DV])(\d+(?:\.\d*)?|\.\d+)(cc|Gy|%)?$")
+
+# Lyman-Kutcher-Burman parameters per organ (Burman et al. 1991): volume effect n (gEUD a = 1 / n),
+# slope m and TD50 in Gy. Targets only have a gEUD parameter. Structure names are matched on the
+# longest key their lower-cased letters start with, so "Lung_L", "SpinalCord" and "PTV_60" all resolve;
+# entries can be added or overridden here.
+ORGAN_PARAMETERS = {
+    "bladder": {"a": 1 / 0.5, "m": 0.11, "TD50": 80.0},
+    "brain": {"a": 1 / 0.25, "m": 0.15, "TD50": 60.0},
+    "brainstem": {"a": 1 / 0.16, "m": 0.14, "TD50": 65.0},
+    "chiasm": {"a": 1 / 0.25, "m": 0.14, "TD50": 65.0},
+    "opticchiasm": {"a": 1 / 0.25, "m": 0.14, "TD50": 65.0},
+    "esophagus": {"a": 1 / 0.06, "m": 0.11, "TD50": 68.0},
+    "femoralhead": {"a": 1 / 0.25, "m": 0.12, "TD50": 65.0},
+    "heart": {"a": 1 / 0.35, "m": 0.10, "TD50": 48.0},
+    "kidney": {"a": 1 / 0.7, "m": 0.10, "TD50": 28.0},
+    "larynx": {"a": 1 / 0.08, "m": 0.17, "TD50": 80.0},
+    "lens": {"a": 1 / 0.3, "m": 0.27, "TD50": 18.0},
+    "liver": {"a": 1 / 0.32, "m": 0.15, "TD50": 40.0},
+    "lung": {"a": 1 / 0.87, "m": 0.18, "TD50": 24.5},
+    "opticnerve": {"a": 1 / 0.25, "m": 0.14, "TD50": 65.0},
+    "parotid": {"a": 1 / 0.7, "m": 0.18, "TD50": 46.0},
+    "rectum": {"a": 1 / 0.12, "m": 0.15, "TD50": 80.0},
+    "retina": {"a": 1 / 0.2, "m": 0.19, "TD50": 65.0},
+    "spinalcord": {"a": 1 / 0.05, "m": 0.175, "TD50": 66.5},
+    "cord": {"a": 1 / 0.05, "m": 0.175, "TD50": 66.5},
+    "stomach": {"a": 1 / 0.15, "m": 0.14, "TD50": 65.0},
+    "target": {"a": -10.0},
+    "ptv": {"a": -10.0},
+    "ctv": {"a": -10.0},
+    "gtv": {"a": -10.0},
+}
+
+# Metric families beyond Dx/Vx: compiled name pattern -> (evaluator, needs_grid). The evaluator gets the
+# histogram, the pattern's parameter group (or None) and a context dict with "structure", "voxel_cc"
+# and "grid" (the histogram of the whole dose grid, only built for families that need it).
+METRIC_FAMILIES = {}
+
+
+def register_metric(pattern, needs_grid=False):
+    def decorator(evaluator):
+        METRIC_FAMILIES[re.compile(pattern)] = (evaluator, needs_grid)
+        return evaluator
+    return decorator
+
+
+def organ_parameters(structure):
+    key = re.sub(r"[^a-z]", "", str(structure).lower())
+    matches = [name for name in ORGAN_PARAMETERS if key.startswith(name)]
+    return ORGAN_PARAMETERS[max(matches, key=len)] if matches else {}
+
+
+def bin_doses(histogram):
+    # Dose standing for every entry of histogram.counts: the middle of its bin, clipped to the dose range
+    # (so the lowest and highest occupied bins are not read past the exact minimum and maximum)
+    bins = histogram.bins
+    middles = np.concatenate([bins[:1], (bins[:-1] + bins[1:]) / 2, bins[-1:]])
+    return np.clip(middles, histogram.min, histogram.max)
+
+
+def geud(counts, doses, a):
+    # Generalised equivalent uniform dose (sum_i v_i d_i^a)^(1/a) of one histogram per row of `counts`,
+    # each with the dose of its bins in `doses` and its own `a`, all rows at once. Doses are scaled by the
+    # row maximum first, so large |a| (serial organs) cannot overflow; a = 0 is the geometric mean.
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    doses = np.broadcast_to(np.atleast_2d(np.asarray(doses, dtype=float)), counts.shape)
+    a = np.broadcast_to(np.asarray(a, dtype=float), counts.shape[:1])[:, None]
+    occupied = counts > 0
+    totals = counts.sum(axis=1, keepdims=True)
+    scale = np.where(occupied, doses, 0.0).max(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        fractions = counts / totals
+        relative = doses / scale
+        powered = np.where(occupied, relative ** a, 0.0)
+        means = np.where(a != 0, (fractions * powered).sum(axis=1, keepdims=True) ** (1 / a),
+                         np.exp(np.where(occupied, fractions * np.log(relative), 0.0).sum(axis=1, keepdims=True)))
+        result = (means * scale)[:, 0]
+    result[(totals[:, 0] == 0) | np.isnan(a[:, 0])] = np.nan
+    result[(totals[:, 0] > 0) & (scale[:, 0] == 0)] = 0.0
+    return result
+
+
+def _family(name):
+    for pattern, (evaluator, needs_grid) in METRIC_FAMILIES.items():
+        match = pattern.match(name.strip())
+        if match is not None:
+            return evaluator, match.group(1) if pattern.groups else None, needs_grid
+    return None
+
+
+def parse_metric(name):
+    match = _METRIC_PATTERN.match(name.strip())
+    if match is None:
+        raise ValueError(f"Unknown metric {name!r}: expected Dx, Dxcc, Vx, Vxcc, gEUD, gEUDa, NTCP, HI or CIx")
+    kind, level, unit = match.groups()
+    if kind == "D" and unit not in (None, "%", "cc"):
+        raise ValueError(f"Unknown metric {name!r}: Dx takes a percentile or a volume in cc")
+    return kind, float(level), unit or ("%" if kind == "D" else "Gy")
+
+
+def validate_metric(name):
+    if _family(name) is None:
+        parse_metric(name)
+    return name
+
+
+def needs_voxel_volume(metrics):
+    return any(_family(name) is None and parse_metric(name)[2] == "cc" for name in metrics)
+
+
+def needs_grid(metrics):
+    # Whether any metric looks at doses outside its structure (see grid_histogram in utils)
+    return any(_family(name) is not None and _family(name)[2] for name in metrics)
+
+
+def metric_value(histogram, name, voxel_cc=None, structure=None, grid=None):
+    family = _family(name)
+    if family is not None:
+        evaluator, parameter, _ = family
+        if histogram.count == 0:
+            return np.nan
+        return float(evaluator(histogram, parameter, {"structure": structure, "voxel_cc": voxel_cc, "grid": grid}))
+    kind, level, unit = parse_metric(name)
+    if unit == "cc" and voxel_cc is None:
+        raise ValueError(f"{name} needs the voxel volume (voxel_cc)")
+    if kind == "D":
+        if unit == "cc":
+            return float(histogram.dose_to_hottest(level / voxel_cc))
+        return float(histogram.percentile(level))
+    n_voxels = float(histogram.count_at_or_above(level))
+    if histogram.count == 0:
+        return np.nan
+    return n_voxels * voxel_cc if unit == "cc" else n_voxels / histogram.count * 100
+
+
+def evaluate_metrics(histogram, metrics=DEFAULT_METRICS, voxel_cc=None, structure=None, grid=None):
+    return {name: metric_value(histogram, name, voxel_cc, structure, grid) for name in metrics}
+
+
+def parse_metric_list(text):
+    # "D2, D98 D0.03cc gEUD" -> ["D2", "D98", "D0.03cc", "gEUD"], validating every name
+    names = [name for name in re.split(r"[,\s]+", text) if name]
+    for name in names:
+        validate_metric(name)
+    return names
+
+
+# gEUD uses the organ's a from ORGAN_PARAMETERS, gEUD<a> (gEUD8, gEUD-10) an explicit one. Bin doses
+# stand in for voxel doses, so like Dx the error is within one bin width.
+@register_metric(r"^gEUD(-?\d+(?:\.\d*)?|-?\.\d+)?$")
+def _geud_metric(histogram, parameter, context):
+    a = float(parameter) if parameter is not None else organ_parameters(context["structure"]).get("a", np.nan)
+    return geud(histogram.counts, bin_doses(histogram), a)[0]
+
+
+# Lyman-Kutcher-Burman NTCP in %, from the gEUD with a = 1 / n and the organ's TD50 and m
+@register_metric(r"^NTCP$")
+def _ntcp_metric(histogram, parameter, context):
+    parameters = organ_parameters(context["structure"])
+    if "TD50" not in parameters:
+        return np.nan
+    eud = geud(histogram.counts, bin_doses(histogram), parameters["a"])[0]
+    t = (eud - parameters["TD50"]) / (parameters["m"] * parameters["TD50"])
+    return 50 * math.erfc(-t / math.sqrt(2))
+
+
+# ICRU 83 homogeneity index (D2% - D98%) / D50%, with D2% the dose to the hottest 2% of the structure:
+# the 98th percentile in the Dx naming above
+@register_metric(r"^HI$")
+def _homogeneity_metric(histogram, parameter, context):
+    d2, d50, d98 = histogram.percentile([98, 50, 2])
+    return (d2 - d98) / d50 if d50 else np.nan
+
+
+# Paddick conformity index at a prescription of x Gy: TV_PIV^2 / (TV * PIV), with TV the structure
+# volume, PIV the volume of the whole grid receiving x Gy and TV_PIV the part of the structure receiving it
+@register_metric(r"^CI(\d+(?:\.\d*)?|\.\d+)$", needs_grid=True)
+def _conformity_metric(histogram, parameter, context):
+    grid = context["grid"]
+    if grid is None:
+        return np.nan
+    covered = float(histogram.count_at_or_above(float(parameter)))
+    isodose = float(grid.count_at_or_above(float(parameter)))
+    return covered ** 2 / (histogram.count * isodose) if isodose else 0.0
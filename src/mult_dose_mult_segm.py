@@ -1,32 +1,132 @@
 import streamlit as st
-import plotly.express as px
 import pandas as pd
 
-from src import utils
+from src import comparison, plotting, utils
+from src.cache import session_result_cache, session_volume_cache
+from src.metrics import DEFAULT_METRICS, needs_grid, parse_metric_list
+from src.profiling import profiled
+from src.scenarios import evaluate_scenarios
 
 
-def display_summary(structure_mask, doses):
+# Dose step of the DVH curves on screen
+DVH_STEP = 0.1
 
-    summary_df = {}
-    for id in doses.keys():
-        st.markdown(f"## Summary of Dose volume: {id}")
 
-        df = utils.dvh_by_structure(doses[id], structure_mask)
-        fig = px.line(df, x="Dose", y="Volume", color="Structure")
-        fig.update_xaxes(showgrid=True)
-        fig.update_yaxes(showgrid=True)
-        st.plotly_chart(fig, use_container_width=True)
+class LazyCase:
+    # The uploaded plans and structures of the page, decoded the first time a view needs them. Every
+    # dose and mask goes through the session volume cache, so a rerun gets the ones it has seen before
+    # for free. All plans have to share the grid of the first one, onto which the masks are resampled.
 
-        summary_df[id] = utils.dose_summary(doses[id], structure_mask)
-        st.table(summary_df[id])
-        csv = summary_df[id].to_csv(index=False)
-        st.download_button(label="Download CSV", data=csv, file_name=f"dvh_data_{id}.csv", mime="text/csv")
+    def __init__(self, dose_files, mask_files):
+        self.dose_files = dose_files
+        self.mask_files = utils.structure_files(mask_files)
+        self.volume_cache = session_volume_cache()
+        self._doses = {}
+        self._masks = {}
+        self._header = None
+
+    @property
+    def plans(self):
+        return list(self.dose_files)
+
+    @property
+    def structures(self):
+        return list(self.mask_files)
+
+    @property
+    def dose_header(self):
+        if self._header is None:
+            first = self.plans[0]
+            self._doses[first], self._header = utils.read_dose(self.dose_files[first], cache=self.volume_cache)
+        return self._header
+
+    @property
+    def voxel_cc(self):
+        return utils.voxel_volume_cc(self.dose_header)
+
+    @property
+    def spacing(self):
+        return tuple(float(size) for size in self.dose_header.get_zooms()[:3])
+
+    def dose(self, id):
+        if id not in self._doses:
+            dose, header = utils.read_dose(self.dose_files[id], cache=self.volume_cache)
+            if not utils.same_grid(header, self.dose_header):
+                raise ValueError(f"Dose volume {id} is not on the grid of dose volume {self.plans[0]}")
+            self._doses[id] = dose
+        return self._doses[id]
+
+    def doses(self, ids):
+        return {id: self.dose(id) for id in ids}
+
+    def mask(self, structure):
+        if structure not in self._masks:
+            self._masks.update(utils.read_masks([self.mask_files[structure]], compact=True, cache=self.volume_cache,
+                                                dose_header=self.dose_header))
+        return self._masks[structure]
+
+    def masks(self, structures):
+        return {structure: self.mask(structure) for structure in structures}
+
+
+def structure_view(dose_volume, mask, structure, metrics=DEFAULT_METRICS, voxel_cc=None, grid=None):
+    # DVH curve (doses, volumes) and summary row of one structure in one plan, both from one histogram
+    histogram = utils.structure_dose_histograms(dose_volume, {structure: mask})[structure]
+    curve = histogram.dvh(utils.auto_bins(histogram.max if histogram.count else 0.0, DVH_STEP))
+    return curve, utils.histogram_summary(histogram, metrics, voxel_cc, structure, grid)
+
+
+def _dose_structure_view(dose_volume, mask, structure, metrics, voxel_cc):
+    # The grid histogram is derived from the dose, so the view is keyed on the dose alone
+    grid = session_result_cache().memoize(utils.grid_histogram, dose_volume) if needs_grid(metrics) else None
+    return structure_view(dose_volume, mask, structure, metrics, voxel_cc, grid)
+
+
+def _structure_view(case, id, structure, metrics):
+    return session_result_cache().memoize(_dose_structure_view, case.dose(id), case.mask(structure), structure,
+                                          metrics, case.voxel_cc)
 
-        st.divider()
 
+def structure_summaries(case, plans, structures, metrics=DEFAULT_METRICS):
+    # {plan: summary table} of the given plans and structures only
+    return {id: pd.DataFrame.from_dict({structure: _structure_view(case, id, structure, metrics)[1]
+                                        for structure in structures}, orient="index")
+            for id in plans}
+
+
+@profiled
+def display_summary(case, plans, structures, metrics=DEFAULT_METRICS):
+    # Only the selected plans and structures are evaluated, one structure at a time: the chart and the
+    # tables are redrawn as each structure comes in. Streamlit stops a run at its next element update
+    # once a widget changes, so a new selection cancels the structures still to come. The structures
+    # already done are memoized, so the next run shows them at once.
+    st.markdown(f"## DVH of the selected Dose volumes")
+    progress = st.progress(0.0)
+    chart = st.empty()
+    tables = {}
+    for id in plans:
+        st.markdown(f"## Summary of Dose volume: {id}")
+        tables[id] = st.empty()
+
+    curves, rows = {}, {id: {} for id in plans}
+    for index, structure in enumerate(structures):
+        for id in plans:
+            curves[id, structure], rows[id][structure] = _structure_view(case, id, structure, metrics)
+        # One chart for every dose volume: a colour per structure, a dash per dose volume
+        chart.plotly_chart(plotting.line_figure(curves), use_container_width=True)
+        for id in plans:
+            tables[id].table(pd.DataFrame.from_dict(rows[id], orient="index"))
+        progress.progress((index + 1) / len(structures), text=f"{index + 1} of {len(structures)} structures")
+    progress.empty()
+
+    summary_df = {id: pd.DataFrame.from_dict(rows[id], orient="index") for id in plans}
+    for id in plans:
+        st.download_button(label=f"Download CSV of Dose volume {id}", data=summary_df[id].to_csv(index=True),
+                           file_name=f"dvh_data_{id}.csv", mime="text/csv", key=f"summary_csv_{id}")
     return summary_df
 
 
+@profiled
 def compare_differences(summary_df, selected_structures, ref_id):
     for id in summary_df.keys():
         if id == ref_id:
@@ -39,14 +139,55 @@ def compare_differences(summary_df, selected_structures, ref_id):
         st.table(diff_table)
 
 
+@profiled
+def display_plan_comparison(doses, structure_mask, selected_structures, ref_id, spacing):
+    # Voxel-wise dose differences and gamma pass rates, within the bounding box of each structure
+    if len(doses) < 2 or not selected_structures:
+        return
+    results = session_result_cache()
+    masks = {structure: structure_mask[structure] for structure in selected_structures}
+    for id in doses.keys():
+        if id == ref_id:
+            continue
+
+        st.markdown(f"#### Voxel-wise comparison of Dose: {id} vs Reference: {ref_id} "
+                    f"(gamma {comparison.GAMMA_DOSE_TOLERANCE:g}% / {comparison.GAMMA_DISTANCE_MM:g} mm)")
+        st.table(results.memoize(comparison.plan_comparison, doses[id], doses[ref_id], masks, spacing))
+        structure = st.selectbox("Dose difference map of:", selected_structures, key=f"difference_map_{id}")
+        difference, _ = results.memoize(comparison.difference_map, doses[id], doses[ref_id], masks[structure])
+        st.plotly_chart(plotting.map_figure(difference, "Dose Difference"), use_container_width=True)
+
+
+@profiled
 def display_difference_dvh(doses, structure_mask, selected_structures, ref_id):
+    results = session_result_cache()
     for structure in selected_structures:
         st.markdown(f"#### DVH comparisons for {structure}")
-        df = utils.dvh_by_dose(doses, structure_mask[structure], structure)
-        fig = px.line(df, x="Dose", y="Volume", color="Structure")
-        fig.update_xaxes(showgrid=True)
-        fig.update_yaxes(showgrid=True)
-        st.plotly_chart(fig, use_container_width=True)
+        df = results.memoize(utils.dvh_by_dose, doses, structure_mask[structure], structure)
+        st.plotly_chart(plotting.line_figure(plotting.frame_curves(df)), use_container_width=True)
+
+        if len(doses) > 1:
+            st.markdown(f"#### DVH differences for {structure} vs Reference: {ref_id}")
+            df = results.memoize(utils.difference_dvh, doses, structure_mask[structure], structure, ref_id)
+            fig = plotting.line_figure(plotting.frame_curves(df, y="Volume Difference"), y_title="Volume Difference")
+            st.plotly_chart(fig, use_container_width=True)
+
+
+@profiled
+def display_scenario_bands(bands, constraint):
+    df = bands.bands()
+    # Min-max band, then the 5th-95th percentile band on top of it and the median curve
+    st.plotly_chart(plotting.band_figure(df), use_container_width=True)
+
+    st.markdown("#### Worst-case metrics over the scenarios")
+    st.table(bands.worst_case())
+    st.markdown("#### Worst-case compliance")
+    compliance = bands.compliance(constraint)
+    st.table(compliance)
+    st.download_button(label="Download band CSV", data=df.to_csv(index=False), file_name="dvh_bands.csv",
+                       mime="text/csv")
+    st.download_button(label="Download compliance CSV", data=compliance.to_csv(index=True),
+                       file_name="worst_case_compliance.csv", mime="text/csv")
 
 
 def panel():
@@ -54,14 +195,15 @@ def panel():
     step_1_complete = False
     step_2_complete = False
 
-    tab1, tab2, tab3 = st.tabs(["🗃️Upload Data", "📊 View Metrics", "🔍 Examine Differences"])
+    tab1, tab2, tab3, tab4 = st.tabs(["🗃️Upload Data", "📊 View Metrics", "🔍 Examine Differences",
+                                      "🎲 Scenario Bands"])
 
     with tab1:
         st.markdown(f"## Step 1: Upload dose distribution volume and mask files")
         st.markdown(
             f"Look [here](https://pyradise.readthedocs.io) to format your files into NIfTI format using Pyradise.")
 
-        max_compares = 5
+        max_compares = 30
         n_compares = st.number_input(f"Number of dose volumes to compare (maximum: {max_compares}):",
                                      min_value=1, max_value=max_compares, value="min", step=1)
 
@@ -78,23 +220,32 @@ def panel():
         mask_files = st.file_uploader("Upload mask volumes (in .nii.gz)", accept_multiple_files=True,
                                           type=['nii', 'gz'], key=0)
 
-        files_uploaded = (len(dose_files) > 0) and (len(mask_files) > 0)
+        files_uploaded = all(dose_files.values()) and (len(mask_files) > 0)
 
         if files_uploaded:
             st.markdown(f"Both dose and mask files are uploaded. Click the toggle button below to proceed.")
             step_1_complete = st.toggle("Compute")
-
-            structure_mask = utils.read_masks(mask_files)
-            doses = {}
-            for id in dose_files.keys():
-                doses[id], _ = utils.read_dose(dose_files[id])
+            # Nothing is decoded here: every dose and mask is read when a view first needs it
+            case = LazyCase(dose_files, mask_files)
         st.divider()
 
     with tab2:
         st.markdown(f"## Step 2: Dose Metrics")
         st.markdown(f"Complete Step 1 to view metrics.")
         if step_1_complete:
-            summary_df = display_summary(structure_mask, doses)
+            extra_metrics = st.text_input("Additional metrics (e.g. D2, V20, gEUD, gEUD-10, NTCP, HI, CI60):")
+            try:
+                metrics = list(DEFAULT_METRICS) + parse_metric_list(extra_metrics)
+            except ValueError as error:
+                st.error(str(error))
+                metrics = list(DEFAULT_METRICS)
+            plans = st.multiselect("Dose volumes to show:", case.plans, case.plans)
+            structures = st.multiselect("Structures to show:", case.structures, case.structures[:1])
+            try:
+                display_summary(case, plans, structures, metrics)
+            except ValueError as error:
+                st.error(str(error))
+                st.stop()
             step_2_complete = True
 
     with tab3:
@@ -103,13 +254,37 @@ def panel():
         if step_2_complete:
             ref_id = st.number_input("Choose reference dose: ", min_value=1, max_value=n_compares, value="min", step=1)
 
-            all_structures = list(structure_mask.keys())
+            all_structures = case.structures
             selected_structures = st.multiselect(
                 "Choose structures to compare:",
                 list(all_structures),
                 [],
             )
 
-            compare_differences(summary_df, selected_structures, ref_id)
-            display_difference_dvh(doses, structure_mask, selected_structures, ref_id)
-        st.divider()
\ No newline at end of file
+            if selected_structures:
+                try:
+                    doses = case.doses(case.plans)
+                except ValueError as error:
+                    st.error(str(error))
+                    st.stop()
+                structure_mask = case.masks(selected_structures)
+                summary_df = structure_summaries(case, case.plans, selected_structures, metrics)
+                compare_differences(summary_df, selected_structures, ref_id)
+                display_plan_comparison(doses, structure_mask, selected_structures, ref_id, case.spacing)
+                display_difference_dvh(doses, structure_mask, selected_structures, ref_id)
+        st.divider()
+
+    with tab4:
+        st.markdown(f"## Robustness: DVH bands over dose scenarios")
+        st.markdown(f"Upload any number of perturbed dose scenarios. They are evaluated one at a time against the "
+                    f"masks of Step 1, so only their DVH curves and worst-case metrics are kept.")
+        scenario_files = st.file_uploader("Upload scenario dose volumes (in .nii.gz)", accept_multiple_files=True,
+                                          type=['nii', 'gz'], key="scenarios")
+        constraint = st.data_editor(utils.get_default_constraints(), num_rows="dynamic", key="scenario_constraints")
+        if scenario_files and mask_files and st.button("Compute scenario bands"):
+            try:
+                bands = evaluate_scenarios(scenario_files, mask_files, constraint)
+            except ValueError as error:
+                st.error(str(error))
+                st.stop()
+            display_scenario_bands(bands, constraint)
@@ -1,23 +1,26 @@
 import streamlit as st
-import plotly.express as px
 import pandas as pd
 
-from src import utils
+from src import comparison, plotting, utils
+from src.cache import session_result_cache, session_volume_cache
+from src.metrics import DEFAULT_METRICS, parse_metric_list
+from src.profiling import profiled
 
 
-def display_summary(structure_mask, doses):
+@profiled
+def display_summary(structure_mask, doses, metrics=DEFAULT_METRICS, voxel_cc=None):
 
-    summary_df = {}
+    results = session_result_cache()
+    label_map = results.memoize(utils.fuse_masks, structure_mask)
+    # Every dose volume is evaluated in one batched pass
+    dvh_df = results.memoize(utils.dvh_by_plan, doses, label_map, voxel_cc=voxel_cc)
+    summary_df = results.memoize(utils.summary_by_plan, doses, label_map, metrics, voxel_cc)
+    # One chart for every dose volume: a colour per structure, a dash per dose volume
+    st.markdown(f"## DVH of all Dose volumes")
+    st.plotly_chart(plotting.line_figure(plotting.grouped_curves(dvh_df)), use_container_width=True)
     for id in doses.keys():
         st.markdown(f"## Summary of Dose volume: {id}")
 
-        df = utils.dvh_by_structure(doses[id], structure_mask)
-        fig = px.line(df, x="Dose", y="Volume", color="Structure")
-        fig.update_xaxes(showgrid=True)
-        fig.update_yaxes(showgrid=True)
-        st.plotly_chart(fig, use_container_width=True)
-
-        summary_df[id] = utils.dose_summary(doses[id], structure_mask)
         st.table(summary_df[id])
         csv = summary_df[id].to_csv(index=True)
         st.download_button(label="Download CSV", data=csv, file_name=f"dvh_data_{id}.csv", mime="text/csv")
@@ -27,6 +30,7 @@ def display_summary(structure_mask, doses):
     return summary_df
 
 
+@profiled
 def compare_differences(summary_df, selected_structures, ref_id):
     for id in summary_df.keys():
         if id == ref_id:
@@ -39,14 +43,38 @@ def compare_differences(summary_df, selected_structures, ref_id):
         st.table(diff_table)
 
 
-def display_difference_dvh(doses, structure_mask, selected_structures):
+@profiled
+def display_plan_comparison(doses, structure_mask, selected_structures, ref_id, spacing):
+    # Voxel-wise dose differences and gamma pass rates, within the bounding box of each structure
+    if len(doses) < 2 or not selected_structures:
+        return
+    results = session_result_cache()
+    masks = {structure: structure_mask[structure] for structure in selected_structures}
+    for id in doses.keys():
+        if id == ref_id:
+            continue
+
+        st.markdown(f"#### Voxel-wise comparison of Dose: {id} vs Reference: {ref_id} "
+                    f"(gamma {comparison.GAMMA_DOSE_TOLERANCE:g}% / {comparison.GAMMA_DISTANCE_MM:g} mm)")
+        st.table(results.memoize(comparison.plan_comparison, doses[id], doses[ref_id], masks, spacing))
+        structure = st.selectbox("Dose difference map of:", selected_structures, key=f"difference_map_{id}")
+        difference, _ = results.memoize(comparison.difference_map, doses[id], doses[ref_id], masks[structure])
+        st.plotly_chart(plotting.map_figure(difference, "Dose Difference"), use_container_width=True)
+
+
+@profiled
+def display_difference_dvh(doses, structure_mask, selected_structures, ref_id):
+    results = session_result_cache()
     for structure in selected_structures:
         st.markdown(f"#### DVH comparisons for {structure}")
-        df = utils.dvh_by_dose(doses, structure_mask[structure], structure)
-        fig = px.line(df, x="Dose", y="Volume", color="Structure")
-        fig.update_xaxes(showgrid=True)
-        fig.update_yaxes(showgrid=True)
-        st.plotly_chart(fig, use_container_width=True)
+        df = results.memoize(utils.dvh_by_dose, doses, structure_mask[structure], structure)
+        st.plotly_chart(plotting.line_figure(plotting.frame_curves(df)), use_container_width=True)
+
+        if len(doses) > 1:
+            st.markdown(f"#### DVH differences for {structure} vs Reference: {ref_id}")
+            df = results.memoize(utils.difference_dvh, doses, structure_mask[structure], structure, ref_id)
+            fig = plotting.line_figure(plotting.frame_curves(df, y="Volume Difference"), y_title="Volume Difference")
+            st.plotly_chart(fig, use_container_width=True)
 
 
 def panel():
@@ -61,7 +89,7 @@ def panel():
         st.markdown(
             f"Look [here](https://pyradise.readthedocs.io) to format your files into NIfTI format using Pyradise.")
 
-        max_compares = 5
+        max_compares = 30
         n_compares = st.number_input(f"Number of dose volumes to compare (maximum: {max_compares}):",
                                      min_value=1, max_value=max_compares, value="min", step=1)
 
@@ -84,17 +112,30 @@ def panel():
             st.markdown(f"Both dose and mask files are uploaded. Click the toggle button below to proceed.")
             step_1_complete = st.toggle("Compute")
 
-            structure_mask = utils.read_masks(mask_files)
+            volume_cache = session_volume_cache()
             doses = {}
+            dose_headers = {}
             for id in dose_files.keys():
-                doses[id], _ = utils.read_dose(dose_files[id])
+                doses[id], dose_headers[id] = utils.read_dose(dose_files[id], cache=volume_cache)
+            # Masks are resampled onto the grid of the first dose, which every other dose has to share
+            dose_header = next(iter(dose_headers.values()))
+            if not all(utils.same_grid(header, dose_header) for header in dose_headers.values()):
+                st.error("The dose volumes are not on the same grid. Please re-upload the dose files.")
+                st.stop()
+            structure_mask = utils.read_masks(mask_files, cache=volume_cache, dose_header=dose_header)
         st.divider()
 
     with tab2:
         st.markdown(f"## Step 2: Dose Metrics")
         st.markdown(f"Complete Step 1 to view metrics.")
         if step_1_complete:
-            summary_df = display_summary(structure_mask, doses)
+            extra_metrics = st.text_input("Additional metrics (e.g. D2, V20, gEUD, gEUD-10, NTCP, HI, CI60):")
+            try:
+                metrics = list(DEFAULT_METRICS) + parse_metric_list(extra_metrics)
+            except ValueError as error:
+                st.error(str(error))
+                metrics = list(DEFAULT_METRICS)
+            summary_df = display_summary(structure_mask, doses, metrics, utils.voxel_volume_cc(dose_header))
             step_2_complete = True
 
     with tab3:
@@ -111,5 +152,7 @@ def panel():
             )
 
             compare_differences(summary_df, selected_structures, ref_id)
-            display_difference_dvh(doses, structure_mask, selected_structures)
+            spacing = tuple(float(size) for size in dose_header.get_zooms()[:3])
+            display_plan_comparison(doses, structure_mask, selected_structures, ref_id, spacing)
+            display_difference_dvh(doses, structure_mask, selected_structures, ref_id)
         st.divider()
\ No newline at end of file
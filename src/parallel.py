@@ -0,0 +1,49 @@
+import os
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+# Threads for the per-structure / per-plan / per-chunk work inside one case. NumPy releases the GIL in
+# gathers, arithmetic and comparisons, so these run concurrently. 1 runs everything inline.
+THREADS = int(os.environ.get("DOSE_EVALUATOR_THREADS", os.cpu_count() or 1))
+
+# Voxels per chunk when one pass over a structure set is split between threads
+CHUNK_VOXELS = 1 << 20
+
+_worker = threading.local()
+
+
+def set_threads(threads):
+    # Process-wide default, e.g. 1 in the workers of a process pool that already fills every core
+    global THREADS
+    THREADS = max(1, int(threads))
+
+
+def thread_map(func, items, workers=None):
+    # [func(item) for item in items] on a bounded thread pool, results in item order. Runs inline for a
+    # single item or worker, and inside another thread_map's worker (nested pools would only
+    # oversubscribe the cores). Each item runs in a copy of the caller's context, so an active
+    # profiler (see src.profiling) sees the work of the threads, under the caller's current stage.
+    items = list(items)
+    workers = THREADS if workers is None else workers
+    if workers <= 1 or len(items) <= 1 or getattr(_worker, "active", False):
+        return [func(item) for item in items]
+
+    def run(context, item):
+        _worker.active = True
+        try:
+            return context.run(func, item)
+        finally:
+            _worker.active = False
+
+    contexts = [contextvars.copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(run, contexts, items))
+
+
+def chunks(n, workers=None, min_size=CHUNK_VOXELS):
+    # (start, stop) ranges splitting n items between the threads, none smaller than min_size
+    workers = THREADS if workers is None else workers
+    n_chunks = max(1, min(workers, n // max(min_size, 1)))
+    bounds = [n * index // n_chunks for index in range(n_chunks + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
@@ -0,0 +1,141 @@
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+
+from src.profiling import profiled
+
+# Largest vertical distance (in y units: % of volume for DVHs) between a drawn curve and the computed one
+DECIMATION_TOLERANCE = 0.1
+
+# Decimals sent to the browser; well below the decimation tolerance
+PAYLOAD_DECIMALS = 3
+
+COLORS = px.colors.qualitative.Plotly
+DASHES = ("solid", "dash", "dot", "dashdot", "longdash", "longdashdot")
+
+
+def _decimate(x, y, ends, tolerance):
+    # Ramer-Douglas-Peucker on the vertical distance over concatenated curves: points flagged in `ends`
+    # (the first and last point of every curve) are always kept, so no segment spans two curves
+    flat = np.zeros(len(x), dtype=bool)
+    flat[1:-1] = (y[1:-1] == y[:-2]) & (y[1:-1] == y[2:])
+    candidates = np.flatnonzero(ends | ~flat)
+    x, y, keep = x[candidates], y[candidates], ends[candidates].copy()
+
+    m = len(candidates)
+    index = np.arange(m)
+    while True:
+        left = np.maximum.accumulate(np.where(keep, index, 0))
+        right = np.minimum.accumulate(np.where(keep, index, m - 1)[::-1])[::-1]
+        run = x[right] - x[left]
+        slope = np.divide(y[right] - y[left], run, out=np.zeros(m), where=run != 0)
+        error = np.abs(y - y[left] - slope * (x - x[left]))
+        segment = np.cumsum(keep) - 1
+        worst = np.maximum.reduceat(error, np.flatnonzero(keep))
+        split = (error > tolerance) & (error == worst[segment])
+        if not split.any():
+            return candidates[keep]
+        keep |= split
+
+
+def decimate(x, y, tolerance=DECIMATION_TOLERANCE):
+    # Indices of the points to draw. Interior points of flat runs (the 100% and 0% plateaus of a DVH) go
+    # first; the rest is simplified by Ramer-Douglas-Peucker on the vertical distance, so the polyline
+    # through the kept points is within `tolerance` of every point left out. Every segment is split at
+    # its worst point in the same pass, so there is one array pass per level of the recursion.
+    return decimate_curves([(x, y)], tolerance)[0]
+
+
+def decimate_curves(curves, tolerance=DECIMATION_TOLERANCE):
+    # decimate for a list of (x, y) curves at once, in one set of array passes over all of them
+    lengths = np.array([len(x) for x, _ in curves], dtype=np.intp)
+    if lengths.sum() == 0:
+        return [np.arange(0) for _ in curves]
+    x = np.concatenate([np.asarray(x, dtype=float) for x, _ in curves])
+    y = np.concatenate([np.asarray(y, dtype=float) for _, y in curves])
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    ends = np.zeros(len(x), dtype=bool)
+    ends[offsets[:-1][lengths > 0]] = True
+    ends[offsets[1:][lengths > 0] - 1] = True
+    kept = _decimate(x, y, ends, tolerance)
+    bounds = np.searchsorted(kept, offsets)
+    return [kept[start:stop] - offset for start, stop, offset in zip(bounds[:-1], bounds[1:], offsets[:-1])]
+
+
+def frame_curves(df, x="Dose", y="Volume", color="Structure"):
+    # {name: (x, y)} arrays from a long table such as utils.dvh_frame's
+    return {name: (group[x].to_numpy(), group[y].to_numpy())
+            for name, group in df.groupby(color, sort=False, observed=True)}
+
+
+def grouped_curves(frames, x="Dose", y="Volume", color="Structure"):
+    # {(group, name): (x, y)} from a dict of long tables, e.g. one per plan or segmentation
+    return {(group, name): curve for group, df in frames.items()
+            for name, curve in frame_curves(df, x, y, color).items()}
+
+
+@profiled
+def line_figure(curves, x_title="Dose", y_title="Volume", tolerance=DECIMATION_TOLERANCE):
+    # One WebGL figure for a whole view. Curves keyed by name get a colour each; curves keyed by
+    # (group, name) get the colour of their name and the dash of their group (plan, segmentation), so
+    # every structure of every plan fits in one chart. Each curve is decimated before it is sent.
+    colors, dashes = {}, {}
+    traces = []
+    kept = decimate_curves(list(curves.values()), tolerance)
+    for (key, (x, y)), keep in zip(curves.items(), kept):
+        group, name = key if isinstance(key, tuple) else (None, key)
+        color = colors.setdefault(name, COLORS[len(colors) % len(COLORS)])
+        dash = dashes.setdefault(group, DASHES[len(dashes) % len(DASHES)])
+        traces.append(go.Scattergl(x=np.round(np.asarray(x, dtype=float)[keep], PAYLOAD_DECIMALS),
+                                   y=np.round(np.asarray(y, dtype=float)[keep], PAYLOAD_DECIMALS),
+                                   mode="lines", line=dict(color=color, dash=dash),
+                                   name=str(name) if group is None else f"{name} ({group})",
+                                   legendgroup=str(name)))
+    fig = go.Figure(data=traces)
+    fig.update_layout(xaxis_title=x_title, yaxis_title=y_title, legend_title_text="Structure")
+    fig.update_xaxes(showgrid=True)
+    fig.update_yaxes(showgrid=True)
+    return fig
+
+
+@profiled
+def band_figure(df, x="Dose", color="Structure", bands=(("Min", "Max", 0.15), ("P5", "P95", 0.3)), line="P50",
+                x_title="Dose", y_title="Volume", tolerance=DECIMATION_TOLERANCE):
+    # Shaded bands (e.g. min-max and 5th-95th percentile over scenarios) around a centre curve, per name
+    # in `color`. All curves of a name are drawn on the union of the points any of them needs.
+    columns = [column for low, high, _ in bands for column in (low, high)] + [line]
+    groups = list(df.groupby(color, sort=False, observed=True))
+    kept = decimate_curves([(group[x].to_numpy(), group[column].to_numpy())
+                            for _, group in groups for column in columns], tolerance)
+    traces = []
+    for index, (name, group) in enumerate(groups):
+        keep = np.unique(np.concatenate(kept[index * len(columns):(index + 1) * len(columns)]))
+        values = {column: np.round(group[column].to_numpy(dtype=float)[keep], PAYLOAD_DECIMALS)
+                  for column in [x] + columns}
+        curve_color = COLORS[index % len(COLORS)]
+        for low, high, opacity in bands:
+            traces.append(go.Scattergl(x=values[x], y=values[high], mode="lines",
+                                       line=dict(width=0, color=curve_color), legendgroup=str(name),
+                                       showlegend=False, hoverinfo="skip"))
+            traces.append(go.Scattergl(x=values[x], y=values[low], mode="lines", fill="tonexty", opacity=opacity,
+                                       line=dict(width=0, color=curve_color), legendgroup=str(name),
+                                       showlegend=False, name=f"{name} {low}-{high}"))
+        traces.append(go.Scattergl(x=values[x], y=values[line], mode="lines", line=dict(color=curve_color),
+                                   legendgroup=str(name), name=str(name)))
+    fig = go.Figure(data=traces)
+    fig.update_layout(xaxis_title=x_title, yaxis_title=y_title, legend_title_text="Structure")
+    fig.update_xaxes(showgrid=True)
+    fig.update_yaxes(showgrid=True)
+    return fig
+
+
+@profiled
+def map_figure(volume, title, axis=2):
+    # Middle slice of a 3-D map (e.g. comparison.difference_map, NaN outside the structure) as a heatmap
+    # on a colour scale centred on zero
+    image = np.take(volume, volume.shape[axis] // 2, axis=axis).T
+    limit = float(np.nanmax(np.abs(image))) if np.isfinite(image).any() else 1.0
+    fig = px.imshow(image, origin="lower", color_continuous_scale="RdBu_r", zmin=-limit, zmax=limit,
+                    labels=dict(color=title))
+    fig.update_layout(coloraxis_colorbar_title_text=title)
+    return fig
@@ -0,0 +1,136 @@
+import json
+import time
+import functools
+import threading
+import tracemalloc
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Profiler collecting the stages of the current case; None when nobody is profiling
+_active = contextvars.ContextVar("profiler", default=None)
+
+# Stages entered and not yet left, innermost last. A context variable rather than a thread-local, so
+# that work handed to worker threads in a copy of the caller's context (parallel.thread_map) records its
+# stages under the caller's.
+_stack = contextvars.ContextVar("stages", default=())
+
+
+def max_rss_mb():
+    # High-water mark of the process resident memory (never goes down)
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Profiler:
+    # Wall time, call count and memory high-water mark of every stage of one case (an upload, a patient).
+    # Stages nest and are recorded under their path, e.g. "dose_summary/structure_dose_histograms", so a
+    # stage's time includes the stages inside it. With memory=True tracemalloc follows every allocation
+    # (numpy buffers included) and each stage records how far its peak rose above the memory in use when
+    # it started; tracing slows the work down noticeably, so it is off by default. Stages entered on
+    # worker threads (see parallel.thread_map) are timed under the stage that started the threads, and
+    # their times add up over the threads.
+
+    def __init__(self, case=None, memory=False):
+        self.case = case
+        self.memory = memory
+        self.stages = {}
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+        self._token = None
+        self._stack_token = None
+        self._started = None
+        self._owns_tracing = False
+        self._thread = None
+
+    def __enter__(self):
+        self._token = _active.set(self)
+        self._stack_token = _stack.set(())
+        self._thread = threading.get_ident()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracing = True
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds += time.perf_counter() - self._started
+        if self._owns_tracing:
+            tracemalloc.stop()
+            self._owns_tracing = False
+        _stack.reset(self._stack_token)
+        _active.reset(self._token)
+        return False
+
+    @contextmanager
+    def stage(self, name):
+        stack = _stack.get()
+        path = "/".join([frame["path"] for frame in stack[-1:]] + [name])
+        traced = self.memory and tracemalloc.is_tracing() and threading.get_ident() == self._thread
+        frame = {"path": path, "current": 0, "peak": 0}
+        if traced:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+            frame["current"] = frame["peak"] = current
+        token = _stack.set(stack + (frame,))
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            _stack.reset(token)
+            peak_mb = None
+            if traced:
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, frame["peak"])
+                if stack:
+                    stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+                peak_mb = (peak - frame["current"]) / 2 ** 20
+            with self._lock:
+                record = self.stages.setdefault(path, {"stage": path, "calls": 0, "seconds": 0.0, "peak_mb": None})
+                record["calls"] += 1
+                record["seconds"] += seconds
+                if peak_mb is not None:
+                    record["peak_mb"] = max(record["peak_mb"] or 0.0, peak_mb)
+
+    def report(self):
+        return {"case": self.case, "seconds": round(self.seconds, 6), "max_rss_mb": max_rss_mb(),
+                "stages": [dict(record, seconds=round(record["seconds"], 6)) for record in self.stages.values()]}
+
+    def table(self):
+        return pd.DataFrame(self.report()["stages"], columns=["stage", "calls", "seconds", "peak_mb"])
+
+    def to_json(self):
+        return json.dumps(self.report())
+
+
+def active_profiler():
+    return _active.get()
+
+
+def stage(name):
+    # Times the enclosed block as a stage of the active profiler, if any
+    profiler = _active.get()
+    return nullcontext() if profiler is None else profiler.stage(name)
+
+
+def profiled(func):
+    # Records every call of `func` as a stage named after it while a Profiler is active. Without one
+    # the call goes straight through.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = _active.get()
+        if profiler is None:
+            return func(*args, **kwargs)
+        with profiler.stage(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,153 @@
+import sys
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src import utils
+from src.histogram import auto_bins
+from src.metrics import DEFAULT_METRICS, needs_grid, parse_metric_list
+
+# Run this from >> python -m src.scenarios SCENARIO_DIR MASK_DIR OUT_DIR
+
+# Percentiles over the scenarios drawn between the min and max of a band
+BAND_PERCENTILES = (5, 50, 95)
+
+BAND_COLUMNS = ["Min"] + [f"P{q:g}" for q in BAND_PERCENTILES] + ["Max"]
+
+
+class ScenarioBands:
+    # DVH bands and worst-case metrics over dose scenarios (setup/range perturbations of a plan) that are
+    # added one at a time. A scenario's dose is dropped once it is histogrammed: only its DVH curves
+    # (structures x bins) and the running lowest/highest value of every summary metric are kept. The
+    # curves share edges in `step_size` steps from 0 Gy, so a scenario with a higher maximum only
+    # extends the edges, beyond which the earlier curves are 0%.
+
+    def __init__(self, structure_masks, step_size=0.1, metrics=DEFAULT_METRICS, voxel_cc=None):
+        self.structure_masks = structure_masks
+        self.label_map = utils.fuse_masks(structure_masks)
+        self.names = self.label_map.names
+        self.step_size = step_size
+        self.metrics = metrics
+        self.voxel_cc = voxel_cc
+        self.scenarios = []
+        self.curves = []
+        self.lowest = None
+        self.highest = None
+
+    def add(self, scenario, dose_volume):
+        # Lazy doses are histogrammed slab by slab, so not even one whole scenario is held in memory
+        masks = self.structure_masks if utils.is_lazy(dose_volume) else self.label_map
+        histograms = utils.structure_dose_histograms(dose_volume, masks)
+        max_dose = max((histogram.max for histogram in histograms.values() if histogram.count), default=0.0)
+        bins = auto_bins(max_dose, self.step_size)
+        self.curves.append(np.array([histograms[name].dvh(bins)[1] for name in self.names], dtype=np.float32))
+
+        grid = utils.grid_histogram(dose_volume) if needs_grid(self.metrics) else None
+        summary = pd.DataFrame.from_dict({name: utils.histogram_summary(histograms[name], self.metrics, self.voxel_cc,
+                                                                        name, grid)
+                                          for name in self.names}).T
+        if self.lowest is None:
+            self.lowest, self.highest = summary, summary
+        else:
+            self.lowest = pd.DataFrame(np.fmin(self.lowest.to_numpy(float), summary.to_numpy(float)),
+                                       index=summary.index, columns=summary.columns)
+            self.highest = pd.DataFrame(np.fmax(self.highest.to_numpy(float), summary.to_numpy(float)),
+                                        index=summary.index, columns=summary.columns)
+        self.scenarios.append(scenario)
+        return self
+
+    def bins(self):
+        # Edges of the scenario reaching the highest dose; the others' are a prefix of them
+        n_bins = max((curves.shape[1] for curves in self.curves), default=0)
+        return np.arange(n_bins) * self.step_size
+
+    def bands(self):
+        # Long table (Dose, Structure, Min, P5, P50, P95, Max) of the volume (%) over the scenarios
+        bins = self.bins()
+        stack = np.zeros((len(self.curves), len(self.names), len(bins)), dtype=np.float32)
+        for row, curves in enumerate(self.curves):
+            stack[row, :, :curves.shape[1]] = curves
+        columns = [stack.min(axis=0)] + list(np.percentile(stack, BAND_PERCENTILES, axis=0)) + [stack.max(axis=0)]
+        df = pd.DataFrame({"Dose": np.tile(bins, len(self.names)),
+                           "Structure": np.repeat(self.names, len(bins))})
+        for name, values in zip(BAND_COLUMNS, columns):
+            df[name] = values.ravel()
+        return df
+
+    def worst_case(self):
+        # Lowest and highest value of every metric over the scenarios, one row per (structure, bound)
+        return pd.concat({"Lowest": self.lowest, "Highest": self.highest}, names=["Bound", "Structure"]) \
+            .swaplevel().sort_index(level=0, sort_remaining=False)
+
+    def compliance(self, constraint):
+        return utils.worst_case_compliance(self.lowest, self.highest, constraint)
+
+
+def scenario_files(scenario_dir, pattern="*.nii*"):
+    return sorted(Path(scenario_dir).glob(pattern))
+
+
+def evaluate_scenarios(dose_files, mask_files, constraint=None, step_size=0.1, metrics=DEFAULT_METRICS,
+                       lazy=False):
+    # Streams the scenario doses (paths or open files) through ScenarioBands one at a time. Masks are put
+    # on the grid of the first scenario, which every other scenario has to share.
+    bands = None
+    for dose_file in dose_files:
+        file = open(dose_file, "rb") if isinstance(dose_file, (str, Path)) else dose_file
+        try:
+            dose_volume, dose_header = utils.read_dose(file, lazy=lazy)
+            if bands is None:
+                reference_header = dose_header
+                structure_masks = utils.read_masks(mask_files, compact=not lazy, lazy=lazy, dose_header=dose_header)
+                if constraint is not None:
+                    metrics = list(dict.fromkeys(list(metrics) + utils.constraint_metrics(constraint)))
+                bands = ScenarioBands(structure_masks, step_size, metrics, utils.voxel_volume_cc(dose_header))
+            elif not utils.same_grid(dose_header, reference_header):
+                raise ValueError(f"Scenario {Path(file.name).name} is not on the grid of the first scenario")
+            bands.add(Path(file.name).name.split(".")[0], dose_volume)
+            del dose_volume
+        finally:
+            if file is not dose_file:
+                file.close()
+    if bands is None:
+        raise ValueError("No scenario doses given")
+    return bands
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DVH bands and worst-case compliance over dose scenarios.")
+    parser.add_argument("scenario_dir", help="Directory with one dose volume per scenario")
+    parser.add_argument("mask_dir", help="Directory with one mask volume per structure")
+    parser.add_argument("out_dir", help="Directory receiving bands.csv, worst_case.csv and compliance.csv")
+    parser.add_argument("--pattern", default="*.nii*", help="Scenario dose file pattern")
+    parser.add_argument("--mask-pattern", default="*.nii*")
+    parser.add_argument("--constraints", help="Constraint CSV (Structure, Constraint Type, Level[, Metric, Operator])")
+    parser.add_argument("--step-size", type=float, default=0.1)
+    parser.add_argument("--metrics", nargs="*", default=[],
+                        help="Dose-volume metrics added to D95/D50/D5, e.g. D2 D98 D0.03cc V20")
+    parser.add_argument("--lazy", action="store_true", help="Read every dose slab by slab (masks must be on its grid)")
+    args = parser.parse_args(argv)
+
+    constraint = pd.read_csv(args.constraints) if args.constraints else utils.get_default_constraints()
+    metrics = list(DEFAULT_METRICS) + parse_metric_list(" ".join(args.metrics))
+    mask_files = [open(path, "rb") for path in sorted(Path(args.mask_dir).glob(args.mask_pattern))]
+    try:
+        bands = evaluate_scenarios(scenario_files(args.scenario_dir, args.pattern), mask_files, constraint,
+                                   args.step_size, metrics, args.lazy)
+    finally:
+        for file in mask_files:
+            file.close()
+
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    bands.bands().to_csv(out_dir / "bands.csv", index=False)
+    bands.worst_case().to_csv(out_dir / "worst_case.csv")
+    bands.compliance(constraint).rename_axis("Structure").to_csv(out_dir / "compliance.csv")
+    print(f"{len(bands.scenarios)} scenarios, {len(bands.names)} structures written to {out_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
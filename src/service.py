@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import asyncio
+import hashlib
+import argparse
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src import utils
+from src.batch import evaluate_case, read_constraints
+from src.metrics import DEFAULT_METRICS, parse_metric_list
+from src.parallel import set_threads
+
+# Run this from >> python -m src.service --port 8765 --workers 4
+#
+#   POST /jobs            {"dose": "plan.nii.gz", "masks": ["Target.nii.gz", ...] or "mask_dir",
+#                          "metrics": ["D2", "V20"], "constraints": "protocol.csv", "supersample": 3}
+#                         -> 202 {"job": id, "status": "queued" | "running" | "done" | "failed"}
+#   GET  /jobs/<id>       -> status
+#   GET  /jobs/<id>/result -> 200 result, 202 while pending, 500 with the error of a failed job
+#   GET  /health          -> queue sizes
+
+# Jobs queued or running at once; beyond this, submissions get 503 and a Retry-After
+MAX_PENDING_JOBS = 64
+
+# Finished jobs whose results are kept for the results endpoint, oldest dropped first
+MAX_FINISHED_JOBS = 256
+
+MAX_REQUEST_BYTES = 1 << 20
+
+STATUS_TEXT = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+def _file_key(path):
+    # Identity of an input file without reading it: a rewritten file gets a new key
+    stat = os.stat(path)
+    return [str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns]
+
+
+def _is_text_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+def job_spec(request):
+    # Normalised job from a request body; raises ValueError on a bad one
+    if not isinstance(request, dict) or "dose" not in request or "masks" not in request:
+        raise ValueError("A job needs 'dose' and 'masks'")
+    if not isinstance(request["dose"], str):
+        raise ValueError("'dose' must be a file path")
+    masks = request["masks"]
+    if not isinstance(masks, str) and not _is_text_list(masks):
+        raise ValueError("'masks' must be a directory or a list of file paths")
+    metrics = request.get("metrics", [])
+    if not _is_text_list(metrics):
+        raise ValueError("'metrics' must be a list of metric names")
+    constraints = request.get("constraints")
+    if constraints is not None and not isinstance(constraints, str):
+        raise ValueError("'constraints' must be a file path")
+    supersample = request.get("supersample")
+    if supersample is not None and (not isinstance(supersample, int) or isinstance(supersample, bool)
+                                    or supersample < 1):
+        raise ValueError("'supersample' must be a positive number of sub-samples")
+    if isinstance(masks, str):
+        masks = sorted(str(path) for path in Path(masks).glob("*.nii*")) if Path(masks).is_dir() else [masks]
+    paths = [request["dose"], *masks] + ([constraints] if constraints else [])
+    missing = [path for path in paths if not os.path.isfile(path)]
+    if missing:
+        raise ValueError(f"Files not found: {', '.join(missing)}")
+    return {
+        "dose": request["dose"],
+        "masks": masks,
+        "metrics": list(DEFAULT_METRICS) + parse_metric_list(" ".join(metrics)),
+        "constraints": constraints,
+        "supersample": supersample,
+    }
+
+
+def job_key(spec):
+    # Identical (dose, masks, options) jobs share this key and are computed once
+    files = [_file_key(spec["dose"])] + [_file_key(path) for path in spec["masks"]]
+    if spec["constraints"]:
+        files.append(_file_key(spec["constraints"]))
+    payload = json.dumps([files, spec["metrics"], spec["supersample"]], sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def _records(df):
+    # JSON-safe rows (NaN becomes null)
+    return json.loads(df.to_json(orient="records"))
+
+
+def compute_job(spec):
+    # Runs in a worker process: DVH (one dose axis, one volume array per structure), summary and compliance
+    files = [open(path, "rb") for path in [spec["dose"], *spec["masks"]]]
+    try:
+        dose_volume, dose_header = utils.read_dose(files[0])
+        structure_masks = utils.read_masks(files[1:], compact=True, dose_header=dose_header)
+    finally:
+        for file in files:
+            file.close()
+    constraint = read_constraints(spec["constraints"])
+    dvh, summary, compliance = evaluate_case(dose_volume, structure_masks, constraint, spec["metrics"],
+                                             utils.voxel_volume_cc(dose_header), spec["supersample"])
+    curves = {name: group["Volume"].round(4).tolist() for name, group in dvh.groupby("Structure", sort=False)}
+    doses = dvh["Dose"].to_numpy()[:len(dvh) // max(len(curves), 1)]
+    return {
+        "dvh": {"dose": np.round(doses, 4).tolist(), "volume": curves},
+        "summary": _records(summary.rename_axis("Structure").reset_index()),
+        "compliance": _records(compliance.rename_axis("Structure").reset_index().dropna(subset=["Compliance"])),
+    }
+
+
+class Job:
+
+    def __init__(self, key, spec):
+        self.key = key
+        self.spec = spec
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.done = asyncio.Event()
+
+    def describe(self):
+        return {"job": self.key, "status": self.status, **({"error": self.error} if self.error else {})}
+
+
+class DVHService:
+    # Asyncio front end over a process pool. Submitting a job that is already queued, running or
+    # finished returns that job instead of computing it again. At most `max_pending` jobs wait or run
+    # at once; `max_finished` finished jobs stay available for their results. Jobs are handed to the
+    # pool one per free worker, so a job only shows as running once a worker has it.
+
+    def __init__(self, workers=None, max_pending=MAX_PENDING_JOBS, max_finished=MAX_FINISHED_JOBS, executor=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = executor or ProcessPoolExecutor(max_workers=self.workers, initializer=set_threads,
+                                                         initargs=(1,))
+        self.slots = asyncio.Semaphore(self.workers)
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.pending = {}
+        self.finished = OrderedDict()
+
+    def job(self, key):
+        return self.pending.get(key) or self.finished.get(key)
+
+    def submit(self, spec):
+        # The job for `spec`, new or coalesced; None when the queue is full
+        key = job_key(spec)
+        job = self.job(key)
+        if job is not None and job.status != "failed":
+            if key in self.finished:
+                self.finished.move_to_end(key)
+            return job
+        if len(self.pending) >= self.max_pending:
+            return None
+        self.finished.pop(key, None)
+        job = self.pending[key] = Job(key, spec)
+        asyncio.get_running_loop().create_task(self._run(job))
+        return job
+
+    async def _run(self, job):
+        try:
+            async with self.slots:
+                job.status = "running"
+                job.result = await asyncio.get_running_loop().run_in_executor(self.executor, compute_job, job.spec)
+            job.status = "done"
+        except Exception as error:
+            job.status, job.error = "failed", repr(error)
+        del self.pending[job.key]
+        self.finished[job.key] = job
+        while len(self.finished) > self.max_finished:
+            self.finished.popitem(last=False)
+        job.done.set()
+
+    async def result(self, spec):
+        # Submit and wait, for callers in the same process
+        job = self.submit(spec)
+        if job is None:
+            raise RuntimeError("Too many pending jobs")
+        await job.done.wait()
+        if job.status == "failed":
+            raise RuntimeError(job.error)
+        return job.result
+
+    def route(self, method, path, body):
+        # (status, payload) of one request
+        parts = [part for part in path.split("?")[0].split("/") if part]
+        if parts == ["health"] and method == "GET":
+            running = sum(job.status == "running" for job in self.pending.values())
+            return 200, {"queued": len(self.pending) - running, "running": running, "finished": len(self.finished),
+                         "max_pending": self.max_pending}
+        if parts == ["jobs"]:
+            if method != "POST":
+                return 405, {"error": "Use POST to submit a job"}
+            try:
+                spec = job_spec(json.loads(body or b"null"))
+            except ValueError as error:
+                return 400, {"error": str(error)}
+            job = self.submit(spec)
+            if job is None:
+                return 503, {"error": "Too many pending jobs, retry later"}
+            return 202, job.describe()
+        if len(parts) in (2, 3) and parts[0] == "jobs" and method == "GET":
+            job = self.job(parts[1])
+            if job is None:
+                return 404, {"error": f"Unknown job {parts[1]}"}
+            if len(parts) == 2:
+                return 200, job.describe()
+            if parts[2] != "result":
+                return 404, {"error": f"Unknown resource {parts[2]}"}
+            if job.status == "failed":
+                return 500, job.describe()
+            if job.status != "done":
+                return 202, job.describe()
+            return 200, {**job.describe(), "result": job.result}
+        return 404, {"error": f"Unknown resource {path}"}
+
+    async def handle(self, reader, writer):
+        # One HTTP/1.1 request per connection, JSON in and out
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            if len(request_line) < 2:
+                status, payload = 400, {"error": "Malformed request"}
+            elif length > MAX_REQUEST_BYTES:
+                status, payload = 413, {"error": f"Request body over {MAX_REQUEST_BYTES} bytes"}
+            else:
+                body = await reader.readexactly(length) if length else b""
+                status, payload = self.route(request_line[0].upper(), request_line[1], body)
+        except (ValueError, asyncio.IncompleteReadError) as error:
+            status, payload = 400, {"error": repr(error)}
+        except Exception as error:
+            # Whatever goes wrong, the client still gets an answer
+            status, payload = 500, {"error": repr(error)}
+        data = json.dumps(payload).encode()
+        head = [f"HTTP/1.1 {status} {STATUS_TEXT[status]}", "Content-Type: application/json",
+                f"Content-Length: {len(data)}", "Connection: close"]
+        if status == 503:
+            head.append("Retry-After: 1")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8765):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve DVHs, dose summaries and compliance over HTTP/JSON.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING_JOBS)
+    parser.add_argument("--max-finished", type=int, default=MAX_FINISHED_JOBS)
+    args = parser.parse_args(argv)
+
+    service = DVHService(args.workers, args.max_pending, args.max_finished)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
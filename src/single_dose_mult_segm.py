@@ -1,25 +1,27 @@
 import streamlit as st
-import plotly.express as px
 
-from src import utils
+from src import plotting, utils
+from src.cache import session_result_cache, session_volume_cache
+from src.profiling import profiled
+from src.variants import segmentation_dvhs, segmentation_summaries, variant_dvh, variant_overlap
 
 
-def display_summary(dose, structure_masks):
+@profiled
+def display_summary(dose, structure_masks, voxel_cc=None):
+    results = session_result_cache()
     struct_intersect = {}
-    summary_df = {}
+    # Versions of a structure from different segmentations are evaluated together (see src.variants)
+    summary_df = results.memoize(segmentation_summaries, dose, structure_masks, voxel_cc=voxel_cc)
+    dvh_df = results.memoize(segmentation_dvhs, dose, structure_masks)
+    # One chart for every segmentation: a colour per structure, a dash per segmentation
+    st.markdown(f"## DVH of all Segmentations")
+    st.plotly_chart(plotting.line_figure(plotting.grouped_curves(dvh_df)), use_container_width=True)
     for id in structure_masks.keys():
         st.markdown(f"## Summary of Segmentation: {id}")
         if len(struct_intersect) == 0:
             struct_intersect = set(structure_masks[id].keys())
         else:
             struct_intersect = struct_intersect.intersection(set(structure_masks[id].keys()))
-        summary_df[id] = utils.dose_summary(dose, structure_masks[id])
-
-        df = utils.dvh_by_structure(dose, structure_masks[id])
-        fig = px.line(df, x="Dose", y="Volume", color="Structure")
-        fig.update_xaxes(showgrid=True)
-        fig.update_yaxes(showgrid=True)
-        st.plotly_chart(fig, use_container_width=True)
 
         st.table(summary_df[id])
         csv = summary_df[id].to_csv(index=True)
@@ -28,6 +30,7 @@ def display_summary(dose, structure_masks):
     return summary_df, struct_intersect
 
 
+@profiled
 def compare_differences(summary_df, selected_structures, ref_id):
     for structure in selected_structures:
         st.markdown(f"### For structure: {structure}")
@@ -39,18 +42,26 @@ def compare_differences(summary_df, selected_structures, ref_id):
             st.table(diff)
 
 
+@profiled
+def display_overlap(structure_masks, selected_structures, ref_id, spacing):
+    results = session_result_cache()
+    for structure in selected_structures:
+        st.markdown(f"#### Overlap with Reference: {ref_id} for {structure}")
+        versions = {id: structure_masks[id][structure] for id in structure_masks.keys()}
+        st.table(results.memoize(variant_overlap, versions, reference=ref_id, spacing=spacing))
+
+
+@profiled
 def display_difference_dvh(dose, structure_masks, selected_structures):
+    results = session_result_cache()
     for structure in selected_structures:
         current_structure = {}
         for id in structure_masks.keys():
             current_structure[structure + "_" + str(id)] = structure_masks[id][structure]
 
         st.markdown(f"#### DVH comparisons for {structure}")
-        df = utils.dvh_by_structure(dose, current_structure)
-        fig = px.line(df, x="Dose", y="Volume", color="Structure")
-        fig.update_xaxes(showgrid=True)
-        fig.update_yaxes(showgrid=True)
-        st.plotly_chart(fig, use_container_width=True)
+        df = results.memoize(variant_dvh, dose, current_structure)
+        st.plotly_chart(plotting.line_figure(plotting.frame_curves(df)), use_container_width=True)
 
 
 def panel():
@@ -67,7 +78,7 @@ def panel():
 
         dose_file = st.file_uploader("Upload the unique dose distribution volume (in .nii.gz)", type=['nii', 'gz'])
 
-        max_compares = 5
+        max_compares = 10
         n_compares = st.number_input(f"Number of segmentations to compare (maximum: {max_compares}):",
                                      min_value=1, max_value=max_compares, value="min", step=1)
 
@@ -91,12 +102,14 @@ def panel():
         st.markdown(f"## Step 2: Dose Metrics")
         st.markdown(f"Complete step 1 to view metrics.")
         if step_1_complete:
-            dose, _ = utils.read_dose(dose_file)
+            volume_cache = session_volume_cache()
+            dose, dose_header = utils.read_dose(dose_file, cache=volume_cache)
             structure_masks = {}
             for id in mask_files.keys():
-                structure_masks[id] = utils.read_masks(mask_files[id])
+                structure_masks[id] = utils.read_masks(mask_files[id], compact=True, cache=volume_cache,
+                                                       dose_header=dose_header)
 
-            summary_df, struct_intersect = display_summary(dose, structure_masks)
+            summary_df, struct_intersect = display_summary(dose, structure_masks, utils.voxel_volume_cc(dose_header))
 
             st.divider()
 
@@ -120,4 +133,5 @@ def panel():
 
             ref_id = st.number_input("Choose reference segmentation: ", min_value=1, max_value=n_compares, value="min",
                                      step=1)
-            compare_differences(summary_df, selected_structures, ref_id)
\ No newline at end of file
+            compare_differences(summary_df, selected_structures, ref_id)
+            display_overlap(structure_masks, selected_structures, ref_id, tuple(dose_header.get_zooms()[:3]))
\ No newline at end of file
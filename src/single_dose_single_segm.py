@@ -1,6 +1,7 @@
 import streamlit as st
-import plotly.express as px
-from src import utils
+from src import plotting, store, utils
+from src.cache import session_result_cache, session_volume_cache
+from src.metrics import DEFAULT_METRICS, parse_metric_list
 
 
 def panel():
@@ -27,25 +28,39 @@ def panel():
     with tab2:
         st.markdown(f"## Step 2: Visualize DVH")
         if step_1_complete:
-            dose, structures = utils.read_dose_and_masks(dose_file, mask_files)
-            df = utils.dvh_by_structure(dose, structures)
-            fig = px.line(df, x="Dose", y="Volume", color="Structure")
-            fig.update_xaxes(showgrid=True)
-            fig.update_yaxes(showgrid=True)
+            volume_cache = session_volume_cache()
+            dose, dose_header = utils.read_dose(dose_file, cache=volume_cache)
+            structures = utils.read_masks(mask_files, cache=volume_cache, dose_header=dose_header)
+            voxel_cc = utils.voxel_volume_cc(dose_header)
+            results = session_result_cache()
+            structures = results.memoize(utils.fuse_masks, structures)
+            partial_volume = st.toggle("Partial-volume DVH (resolves voxels on structure surfaces, for small structures)")
+            supersample = utils.SUPERSAMPLING if partial_volume else None
+            dvh_df = results.memoize(utils.dvh_by_structure, dose, structures, voxel_cc=voxel_cc,
+                                     supersample=supersample)
+            fig = plotting.line_figure(plotting.frame_curves(dvh_df))
             st.plotly_chart(fig, use_container_width=True)
 
-            df = utils.dose_summary(dose, structures)
+            extra_metrics = st.text_input("Additional metrics (e.g. D2, D98, D0.03cc, V20, V20cc, gEUD, NTCP, HI, CI60):")
+            try:
+                metrics = list(DEFAULT_METRICS) + parse_metric_list(extra_metrics)
+            except ValueError as error:
+                st.error(str(error))
+                metrics = list(DEFAULT_METRICS)
+            df = results.memoize(utils.dose_summary, dose, structures, metrics=metrics, voxel_cc=voxel_cc,
+                                 supersample=supersample)
             st.table(df)
 
             st.markdown(f"Download the DVH data here.")
             csv = df.to_csv(index=True)
             st.download_button(label="Download CSV", data=csv, file_name="dvh_data.csv", mime="text/csv")
+            st.download_button(label="Download DVH curves (Parquet)", data=store.parquet_bytes(dvh_df, "dvh"),
+                               file_name="dvh_curves.parquet", mime="application/vnd.apache.parquet")
         st.divider()
 
     with tab3:
         st.markdown(f"## Step 3: Check Compliance")
         if step_1_complete:
-            df = utils.dose_summary(dose, structures)
             constraint = utils.get_default_constraints()
 
             edited_constraint = st.data_editor(
@@ -54,32 +69,44 @@ def panel():
                     "Structure": "Structure Name",
                     "Constraint Type": st.column_config.SelectboxColumn(
                                  "Constraint Type",
-                                       help="Type of constraint: max, min, mean, volume",
+                                       help="Type of constraint: max, min, mean, volume (Vx metric), dose (Dx metric)",
                                        options=[
                                             "max",
                                             "min",
                                             "mean",
                                             "volume",
+                                            "dose",
                                        ],
                                 required=True,
                     ),
                     "Level": st.column_config.NumberColumn(
                         "Constraint Limit",
-                        help="Limit in Gray",
-                        min_value=1,
-                        max_value=70,
+                        help="Limit in Gray, or in % / cc for volume constraints",
+                        min_value=0,
                         step=1,
-                        format="%d Gy",
                         required=True,
                     ),
+                    "Metric": st.column_config.TextColumn(
+                        "Metric",
+                        help="For volume and dose constraints: V20, V20cc, D95, D0.03cc, gEUD, NTCP, ...",
+                    ),
                 },
                 disabled=["Structure"],
                 hide_index=True,
             )
+            try:
+                constraint_metrics = utils.constraint_metrics(edited_constraint)
+                parse_metric_list(" ".join(constraint_metrics))
+            except ValueError as error:
+                st.error(str(error))
+                constraint_metrics = []
+            df = results.memoize(utils.dose_summary, dose, structures,
+                                 metrics=list(dict.fromkeys(metrics + constraint_metrics)), voxel_cc=voxel_cc,
+                                 supersample=supersample)
 
             update_compliance_check = st.button("Update Compliance Check")
             if update_compliance_check:
-                compliance = utils.check_compliance(df, edited_constraint)
+                compliance = results.memoize(utils.check_compliance, df, edited_constraint)
                 st.table(compliance)
                 csv = compliance.to_csv(index=True)
                 st.download_button(label="Download compliance CSV", data=csv, file_name="compliance.csv", mime="text/csv")
@@ -0,0 +1,88 @@
+import io
+import os
+import shutil
+from pathlib import Path
+from urllib.parse import quote
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+STORE_TABLES = ("dvh", "summary", "compliance")
+
+# Label columns repeated on many rows, stored as dictionaries (one copy of each distinct value)
+DICTIONARY_COLUMNS = ("Plan", "Segmentation", "Structure", "Compliance", "Reason")
+
+# Float type of the numeric columns of each table: DVH volumes (% and cc) and doses on 0.1 Gy edges
+# need no more than float32, metrics keep full precision
+FLOAT_TYPES = {"dvh": pa.float32(), "summary": pa.float64(), "compliance": pa.float64()}
+
+PARTITIONING = ds.partitioning(pa.schema([("patient", pa.string())]), flavor="hive")
+
+
+def to_arrow(df, float_type=pa.float64()):
+    columns = {}
+    for name in df.columns:
+        values = df[name]
+        if name in DICTIONARY_COLUMNS or values.dtype == object:
+            array = pa.array(values.to_numpy(dtype=object), type=pa.string(), from_pandas=True)
+            columns[str(name)] = array.dictionary_encode() if name in DICTIONARY_COLUMNS else array
+        else:
+            columns[str(name)] = pa.array(values.to_numpy(dtype=float), type=float_type, from_pandas=True)
+    return pa.table(columns)
+
+
+def parquet_bytes(df, table="dvh"):
+    # A result table as a Parquet file in memory, e.g. for a download button
+    buffer = io.BytesIO()
+    pq.write_table(to_arrow(df, FLOAT_TYPES.get(table, pa.float64())), buffer)
+    return buffer.getvalue()
+
+
+class ResultStore:
+    # Parquet datasets <root>/<table>/patient=<id>/part-0.parquet holding the DVH, summary and compliance
+    # tables of a cohort, one partition per patient. A patient is always written whole, into a hidden
+    # directory first, so a re-run replaces its results and readers never see half of them. Queries read
+    # only the columns (and, through the patient partitions and row-group statistics, the rows) they need.
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def write_patient(self, patient, tables):
+        # `tables`: {"dvh" | "summary" | "compliance": DataFrame with Plan/Segmentation/Structure columns}
+        for table, df in tables.items():
+            directory = self.root / table / f"patient={quote(str(patient), safe='')}"
+            partial = directory.with_name(f".{directory.name}.partial")
+            shutil.rmtree(partial, ignore_errors=True)
+            partial.mkdir(parents=True)
+            pq.write_table(to_arrow(df, FLOAT_TYPES.get(table, pa.float64())), partial / "part-0.parquet")
+            shutil.rmtree(directory, ignore_errors=True)
+            os.replace(partial, directory)
+
+    def dataset(self, table):
+        # Patients may carry different metric columns; those missing from a patient read as null
+        base_dir = self.root / table
+        paths = sorted(str(path) for path in base_dir.glob("patient=*/*.parquet"))
+        schema = pa.unify_schemas([pq.read_schema(path) for path in paths] + [PARTITIONING.schema])
+        return ds.dataset(paths, schema=schema, format="parquet", partitioning=PARTITIONING,
+                          partition_base_dir=str(base_dir))
+
+    def query(self, table, columns=None, **equals):
+        # Rows of `table` whose columns equal the keyword values, e.g. query("summary", ["D95"],
+        # Structure="Target"). Label columns come back as pandas categoricals.
+        condition = None
+        for name, value in equals.items():
+            term = ds.field(name) == value
+            condition = term if condition is None else condition & term
+        return self.dataset(table).to_table(columns=columns, filter=condition).to_pandas()
+
+    def metric(self, metric, structure=None, **equals):
+        # One metric (e.g. "D95") of one or all structures across the cohort
+        if structure is not None:
+            equals["Structure"] = structure
+        return self.query("summary", ["patient", "Plan", "Segmentation", "Structure", metric], **equals)
+
+    def dvh(self, structure=None, **equals):
+        if structure is not None:
+            equals["Structure"] = structure
+        return self.query("dvh", **equals)
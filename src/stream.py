@@ -0,0 +1,79 @@
+import os
+from gzip import GzipFile
+
+import numpy as np
+import nibabel as nib
+from nibabel import FileHolder, Nifti1Image
+from nibabel.arrayproxy import is_proxy
+
+from src.histogram import DoseHistogram, auto_bins
+from src.structure import CompactMask, LabelMap, split_label_map
+
+# Volumes are NIfTI, stored with the last (z) axis slowest, so a z-slab is one contiguous run of the
+# file and reading slab after slab decompresses the file exactly once.
+DEFAULT_SLAB_SIZE = 16
+
+
+def open_volume(source):
+    # Lazy volume (nibabel array proxy) and header for a file path or an uploaded gzip file
+    if isinstance(source, (str, os.PathLike)):
+        img = nib.load(source, keep_file_open=True)
+    else:
+        fh = FileHolder(fileobj=GzipFile(fileobj=source))
+        img = Nifti1Image.from_file_map({'header': fh, 'image': fh})
+    return img.dataobj, img.header
+
+
+def is_lazy(volume):
+    return is_proxy(volume)
+
+
+def iter_slabs(volume, slab_size=DEFAULT_SLAB_SIZE):
+    for start in range(0, volume.shape[2], slab_size):
+        stop = min(start + slab_size, volume.shape[2])
+        yield start, stop, np.asarray(volume[:, :, start:stop])
+
+
+def volume_max(volume, slab_size=DEFAULT_SLAB_SIZE):
+    if not is_lazy(volume):
+        return float(np.max(volume))
+    return max(float(slab.max()) for _, _, slab in iter_slabs(volume, slab_size))
+
+
+class _SlabMask:
+    # Per-slab view of a dense, lazy or compact structure mask
+
+    def __init__(self, mask):
+        self.mask = mask
+        if isinstance(mask, CompactMask):
+            # A compact mask only ever expands its bounding box
+            self.box_mask = mask.box_mask()
+
+    def sample(self, dose_slab, start, stop):
+        if not isinstance(self.mask, CompactMask):
+            return dose_slab[np.asarray(self.mask[:, :, start:stop]) > 0]
+        (x0, x1), (y0, y1), (z0, z1) = self.mask.box
+        lo, hi = max(start, z0), min(stop, z1)
+        if lo >= hi:
+            return dose_slab[:0, 0, 0]
+        return dose_slab[x0:x1, y0:y1, lo - start:hi - start][self.box_mask[:, :, lo - z0:hi - z0]]
+
+
+def stream_histograms(dose_volume, structure_masks, bins, slab_size=DEFAULT_SLAB_SIZE):
+    # One DoseHistogram per structure, accumulated slab by slab: only one slab of the dose and of each
+    # mask is in memory at a time. A fused LabelMap is split back into one compact mask per structure.
+    if isinstance(structure_masks, LabelMap):
+        structure_masks = split_label_map(structure_masks)
+    histograms = {name: DoseHistogram(bins) for name in structure_masks}
+    slab_masks = {name: _SlabMask(mask) for name, mask in structure_masks.items()}
+    for start, stop, dose_slab in iter_slabs(dose_volume, slab_size):
+        for name, slab_mask in slab_masks.items():
+            histograms[name].add(slab_mask.sample(dose_slab, start, stop))
+    return histograms
+
+
+def stream_bins(dose_volume, max_dose=None, step_size=0.1, slab_size=DEFAULT_SLAB_SIZE):
+    # Without a max_dose this costs one extra pass over the dose to find its maximum
+    if max_dose is None:
+        max_dose = volume_max(dose_volume, slab_size)
+    return auto_bins(max_dose, step_size)
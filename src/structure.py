@@ -0,0 +1,182 @@
+import numpy as np
+from typing import NamedTuple
+
+
+class LabelMap(NamedTuple):
+    # All structures of a segmentation fused into one labelling of the voxels they cover.
+    # Each covered voxel gets one label, and `membership[label]` lists the structures that voxel belongs to.
+    # When no structures overlap there is one label per structure.
+    names: list
+    shape: tuple
+    voxels: np.ndarray
+    labels: np.ndarray
+    membership: np.ndarray
+
+
+def _smallest_uint(n_values):
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if n_values <= np.iinfo(dtype).max:
+            return dtype
+    raise ValueError(f"Too many labels: {n_values}")
+
+
+class CompactMask:
+    # A structure mask kept as its bounding box plus whichever is smaller: the flat voxel indices into the
+    # full grid or a bit-packed copy of the mask inside the box. Small organs cost a few kB instead of a
+    # full-size array, and sampling a dose only touches the box.
+
+    def __init__(self, shape, box, indices=None, packed=None):
+        self.shape = tuple(shape)
+        self.box = tuple(box)
+        self._indices = indices
+        self._packed = packed
+
+    @classmethod
+    def from_dense(cls, mask):
+        inside = np.asarray(mask) > 0
+        coords = [np.flatnonzero(inside.any(axis=tuple(a for a in range(inside.ndim) if a != axis)))
+                  for axis in range(inside.ndim)]
+        if any(len(c) == 0 for c in coords):
+            return cls(inside.shape, [(0, 0)] * inside.ndim, indices=np.zeros(0, dtype=np.intp))
+        box = [(int(c[0]), int(c[-1]) + 1) for c in coords]
+        box_mask = inside[tuple(slice(start, stop) for start, stop in box)]
+
+        n_voxels = int(np.count_nonzero(box_mask))
+        index_dtype = np.int32 if inside.size <= np.iinfo(np.int32).max else np.int64
+        if n_voxels * np.dtype(index_dtype).itemsize < box_mask.size / 8:
+            return cls(inside.shape, box, indices=np.flatnonzero(inside).astype(index_dtype))
+        return cls(inside.shape, box, packed=np.packbits(box_mask, axis=None))
+
+    @classmethod
+    def from_indices(cls, indices, shape):
+        # From flat voxel indices into a grid of `shape`, e.g. one structure of a LabelMap
+        indices = np.asarray(indices)
+        if len(indices) == 0:
+            return cls(shape, [(0, 0)] * len(shape), indices=np.zeros(0, dtype=np.intp))
+        coords = np.unravel_index(indices, shape)
+        box = [(int(c.min()), int(c.max()) + 1) for c in coords]
+        index_dtype = np.int32 if int(np.prod(shape)) <= np.iinfo(np.int32).max else np.int64
+        return cls(shape, box, indices=np.sort(indices).astype(index_dtype))
+
+    @property
+    def slices(self):
+        return tuple(slice(start, stop) for start, stop in self.box)
+
+    @property
+    def box_shape(self):
+        return tuple(stop - start for start, stop in self.box)
+
+    @property
+    def nbytes(self):
+        return (self._indices if self._indices is not None else self._packed).nbytes
+
+    def box_mask(self):
+        if self._packed is not None:
+            n_box = int(np.prod(self.box_shape))
+            return np.unpackbits(self._packed, count=n_box).view(bool).reshape(self.box_shape)
+        box_mask = np.zeros(self.box_shape, dtype=bool)
+        coords = np.unravel_index(self._indices, self.shape)
+        box_mask[tuple(c - start for c, (start, _) in zip(coords, self.box))] = True
+        return box_mask
+
+    def indices(self):
+        # Flat indices into the full grid, in C order
+        if self._indices is not None:
+            return self._indices.astype(np.intp, copy=False)
+        coords = np.nonzero(self.box_mask())
+        return np.ravel_multi_index(tuple(c + start for c, (start, _) in zip(coords, self.box)), self.shape)
+
+    def count(self):
+        if self._indices is not None:
+            return len(self._indices)
+        return int(np.unpackbits(self._packed).sum())
+
+    def sample(self, volume):
+        # Values of `volume` inside the structure, in the same order as volume[mask > 0]
+        if self._indices is not None:
+            return volume.ravel()[self._indices]
+        return volume[self.slices][self.box_mask()]
+
+    def to_dense(self):
+        dense = np.zeros(self.shape, dtype=np.uint8)
+        dense[self.slices] = self.box_mask()
+        return dense
+
+
+def mask_indices(mask):
+    if isinstance(mask, CompactMask):
+        return mask.indices()
+    return np.flatnonzero(np.asarray(mask) > 0)
+
+
+def sample_mask(volume, mask):
+    if isinstance(mask, CompactMask):
+        return mask.sample(volume)
+    return volume[mask > 0]
+
+
+def _integer_label_volume(indices, shape):
+    # One integer label per voxel, or None as soon as two structures claim the same voxel
+    label_volume = np.zeros(int(np.prod(shape)), dtype=_smallest_uint(len(indices)))
+    for label, structure_indices in enumerate(indices, start=1):
+        if label_volume[structure_indices].any():
+            return None
+        label_volume[structure_indices] = label
+    return label_volume
+
+
+def _bit_packed_volumes(indices, shape):
+    # One bit per structure, packed 64 structures to a word volume
+    words = []
+    for start in range(0, len(indices), 64):
+        group = indices[start:start + 64]
+        word = np.zeros(int(np.prod(shape)), dtype=_smallest_uint(2 ** len(group) - 1))
+        for bit, structure_indices in enumerate(group):
+            word[structure_indices] |= word.dtype.type(1) << word.dtype.type(bit)
+        words.append(word)
+    return words
+
+
+def fuse_masks(structure_masks):
+    if isinstance(structure_masks, LabelMap):
+        return structure_masks
+
+    names = list(structure_masks.keys())
+    shape = structure_masks[names[0]].shape if names else ()
+    # Both dense and compact masks are written into the label volumes through their voxel indices,
+    # so a compact mask never has to be expanded to the full grid
+    indices = [mask_indices(structure_masks[name]) for name in names]
+
+    label_volume = _integer_label_volume(indices, shape)
+    if label_volume is not None:
+        voxels = np.flatnonzero(label_volume)
+        labels = label_volume[voxels] - 1
+        membership = np.eye(len(names), dtype=bool)
+        return LabelMap(names, shape, voxels, labels, membership)
+
+    # Structures overlap: every distinct combination of structure bits becomes a label
+    words = _bit_packed_volumes(indices, shape)
+    covered = words[0] > 0
+    for word in words[1:]:
+        covered |= word > 0
+    voxels = np.flatnonzero(covered)
+    del covered
+    codes = np.stack([word[voxels].astype(np.uint64) for word in words], axis=1)
+    del words
+    # Neighbouring voxels mostly share a code, so only the first voxel of each run goes into np.unique
+    run_starts = np.flatnonzero(np.concatenate([[True], (codes[1:] != codes[:-1]).any(axis=1)]))
+    combinations, run_labels = np.unique(codes[run_starts], axis=0, return_inverse=True)
+    labels = np.repeat(run_labels.reshape(-1), np.diff(np.append(run_starts, len(codes))))
+    labels = labels.astype(_smallest_uint(len(combinations)))
+
+    bits = np.arange(64, dtype=np.uint64)
+    membership = ((combinations[:, :, None] >> bits) & np.uint64(1)).astype(bool)
+    membership = membership.reshape(len(combinations), -1)[:, :len(names)]
+    return LabelMap(names, shape, voxels, labels, membership)
+
+
+def split_label_map(label_map: LabelMap):
+    # The structures of a LabelMap back as compact masks
+    return {name: CompactMask.from_indices(label_map.voxels[label_map.membership[label_map.labels, column]],
+                                           label_map.shape)
+            for column, name in enumerate(label_map.names)}
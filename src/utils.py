@@ -1,150 +1,590 @@
+import os
 import numpy as np
 import pandas as pd
 from numpy import ndarray
-from gzip import GzipFile
-from nibabel import FileHolder, Nifti1Image
 
-def read_file(byte_file):
-    # See https://stackoverflow.com/questions/62579425/simpleitk-read-io-byteio
-    fh = FileHolder(fileobj=GzipFile(fileobj=byte_file))
-    img = Nifti1Image.from_file_map({'header': fh, 'image': fh})
-    arr = np.array(img.dataobj)
-    return arr, img.header
+from src.cache import cached_read
+from src.geometry import grid, resample_mask, same_grid
+from src.histogram import (DoseHistogram, auto_bins, bin_index, cumulative_counts, dvh_bins,
+                           histogram_counts)
+from src.ingest import INGEST_WORKERS, read_volume
+from src.metrics import DEFAULT_METRICS, evaluate_metrics, needs_grid
+from src.parallel import chunks, thread_map
+from src.partial_volume import SUPERSAMPLING, partial_volume_masks, partial_volume_samples
+from src.profiling import profiled
+from src.stream import is_lazy, iter_slabs, open_volume, stream_bins, stream_histograms, volume_max
+from src.structure import CompactMask, LabelMap, fuse_masks, sample_mask
 
+DOSE_STATISTICS = ["Mean Dose", "Max Dose", "Min Dose"]
 
-def compute_dvh(_dose: np.ndarray, _struct_mask: np.ndarray, max_dose = 65, step_size = 0.1,
-    ) -> tuple[ndarray, ndarray]:
+# Bin width (Gy) of the histograms dose_summary reads its metrics from
+SUMMARY_STEP = 0.01
 
-    dose_in_oar = _dose[_struct_mask > 0]
-    bins = np.arange(0, max_dose, step_size)
-    total_voxels = len(dose_in_oar)
-    values = []
+# Dose values gathered at a time when several plans are histogrammed together
+PLAN_BATCH_VALUES = 1 << 24
+
+# Dose values binned at a time, into a structure histogram or the label counts of a label map: the index
+# temporaries stay in cache
+HISTOGRAM_CHUNK_VALUES = 1 << 16
+
+
+@profiled
+def read_file(byte_file, lazy=False, kind="dose", copy=True):
+    # With lazy=True the volume stays in the file and is read slab by slab by the streaming backend.
+    # Otherwise doses come back as float32 and masks in their stored integer (or a boolean) type, as
+    # writable arrays of their own. copy=False skips the copy where the decoder allows it: the volume
+    # may then be a read-only view of the decompressed bytes, or a memory map of an uncompressed .nii
+    # file on disk.
+    if lazy:
+        return open_volume(byte_file)
+    volume, header = read_volume(byte_file, kind)
+    if copy and (not volume.flags.writeable or isinstance(volume, np.memmap)):
+        volume = np.array(volume)
+    return volume, header
+
+
+def read_dose_file(byte_file, copy=True):
+    return read_file(byte_file, kind="dose", copy=copy)
+
+
+def read_mask_file(byte_file, copy=True):
+    return read_file(byte_file, kind="mask", copy=copy)
+
+
+# Readers for the volume cache: what it hands out is read-only anyway (see cache.cached_read), so
+# decoded volumes are kept without the copy
+def read_dose_view(byte_file):
+    return read_dose_file(byte_file, copy=False)
+
+
+def read_mask_view(byte_file):
+    return read_mask_file(byte_file, copy=False)
+
+
+def _reader(cache, reader, view):
+    return reader if cache is None else view
+
+
+@profiled
+def compute_dvh(_dose: np.ndarray, _struct_mask: np.ndarray, max_dose=65, step_size=0.1, bins=None,
+                supersample=None) -> tuple[ndarray, ndarray]:
+    # Single pass over the structure voxels: every voxel is dropped into its bin once and the cumulative
+    # DVH is the reverse cumulative sum of the bin counts. The comparison is the same `dose >= bin` the
+    # per-bin loop used, so the values match it exactly (up to float rounding of the final percentage).
+    # `bins` takes arbitrary increasing edges; with `max_dose=None` the edges run past the maximum dose
+    # found in the structure instead of stopping at a fixed level.
+    # Lazy volumes (read_file(..., lazy=True)) are streamed in z-slabs instead of being loaded.
+    # `supersample` (sub-samples per axis, e.g. SUPERSAMPLING) switches to the partial-volume DVH of
+    # src.partial_volume, which resolves the voxels on the structure's surface.
+
+    if is_lazy(_dose) or is_lazy(_struct_mask):
+        if supersample:
+            raise ValueError("The partial-volume DVH needs the dose and mask in memory")
+        if bins is None:
+            bins = stream_bins(_dose, step_size=step_size) if max_dose is None else dvh_bins(max_dose, step_size)
+        return stream_histograms(_dose, {"structure": _struct_mask}, bins)["structure"].dvh()
+
+    weights = None
+    if supersample:
+        dose_in_oar, weights = partial_volume_samples(_dose, _struct_mask, supersample)
+        total_voxels = weights.sum()
+    else:
+        dose_in_oar = sample_mask(_dose, _struct_mask)
+        total_voxels = len(dose_in_oar)
+
+    if bins is None:
+        if max_dose is None:
+            bins = auto_bins(dose_in_oar.max() if total_voxels else 0, step_size)
+        else:
+            bins = dvh_bins(max_dose, step_size)
+    bins = np.asarray(bins)
 
     if total_voxels == 0:
         # There's no voxels in the mask
         values = np.zeros(len(bins))
     else:
-        for bin in bins:
-            number = (dose_in_oar >= bin).sum()
-            value = (number / total_voxels) * 100
-            values.append(value)
-        values = np.asarray(values)
+        counts = histogram_counts(dose_in_oar, bins, weights)
+        values = cumulative_counts(counts) / total_voxels * 100
 
     return bins, values
 
 
-def read_dose(dose_file):
-    dose_volume, dose_header = read_file(dose_file)
+def voxel_volume_cc(header):
+    return float(np.prod(header.get_zooms()[:3])) / 1000
+
+
+def read_compact_mask(byte_file):
+    mask_volume, mask_header = read_mask_view(byte_file)
+    return CompactMask.from_dense(mask_volume), mask_header
+
+
+@profiled
+def read_dose(dose_file, cache=None, lazy=False):
+    # `cache` (an LRUCache) skips decoding files whose bytes were already decoded
+    if lazy:
+        return read_file(dose_file, lazy=True)
+    dose_volume, dose_header = cached_read(cache, dose_file, _reader(cache, read_dose_file, read_dose_view))
     return dose_volume, dose_header
 
 
-def read_masks(mask_files):
+def _on_dose_grid(mask_file, mask_volume, mask_header, dose_header, compact=False, cache=None,
+                  resample="nearest"):
+    # A mask on another grid than the dose is resampled onto the dose grid. The resampled mask is
+    # cached like a decoded file, so each (mask, dose grid) pair is resampled once per cache.
+    if dose_header is None or same_grid(mask_header, dose_header):
+        return mask_volume, mask_header
+    shape, affine = grid(dose_header)
+
+    def read_resampled_mask(byte_file):
+        mask_volume, mask_header = read_mask_view(byte_file)
+        mask_volume = resample_mask(mask_volume, grid(mask_header)[1], shape, affine, resample)
+        return (CompactMask.from_dense(mask_volume) if compact else mask_volume), dose_header
+
+    return cached_read(cache, mask_file, read_resampled_mask, compact, resample, shape, affine.tobytes())
+
+
+def _read_mask(mask_file, compact=False, cache=None, lazy=False, dose_header=None, resample="nearest"):
+    if lazy:
+        mask_volume, mask_header = read_file(mask_file, lazy=True)
+        if dose_header is not None and not same_grid(mask_header, dose_header):
+            raise ValueError(f"{mask_file.name} is not on the dose grid, which lazy masks require")
+        return mask_volume, mask_header
+    mask_volume, mask_header = cached_read(cache, mask_file, read_compact_mask if compact else
+                                           _reader(cache, read_mask_file, read_mask_view))
+    return _on_dose_grid(mask_file, mask_volume, mask_header, dose_header, compact, cache, resample)
+
+
+def _structure_name(mask_file):
+    return os.path.basename(mask_file.name).split(".")[0]
+
+
+def structure_files(mask_files):
+    # {structure name: mask file}, the names read_masks gives the masks, without decoding anything
+    return {_structure_name(mask_file): mask_file for mask_file in mask_files}
+
+
+@profiled
+def read_masks(mask_files, compact=False, cache=None, lazy=False, dose_header=None, resample="nearest"):
+    # With compact=True each mask is kept as a CompactMask (bounding box + indices or packed bits).
+    # Given the dose header, masks on a different grid are resampled onto the dose grid ("nearest" or
+    # "linear"). The files are decoded concurrently.
     structure_masks = {}
-    for mask_file in mask_files:
-        mask_volume, mask_header = read_file(mask_file)
-        struct_name = mask_file.name.split(".")[0]
-        structure_masks[struct_name] = mask_volume
+    mask_volumes = thread_map(lambda mask_file: _read_mask(mask_file, compact, cache, lazy, dose_header, resample),
+                              mask_files, INGEST_WORKERS)
+    for mask_file, (mask_volume, mask_header) in zip(mask_files, mask_volumes):
+        structure_masks[_structure_name(mask_file)] = mask_volume
     return structure_masks
 
 
-def read_dose_and_masks(dose_file, mask_files):
-    dose_volume, dose_header = read_dose(dose_file)
-    structure_masks = read_masks(mask_files)
+@profiled
+def read_dose_and_masks(dose_file, mask_files, cache=None, resample="nearest"):
+    # Dose and masks are decoded concurrently, then masks off the dose grid are resampled onto it
+    readers = ([_reader(cache, read_dose_file, read_dose_view)]
+               + [_reader(cache, read_mask_file, read_mask_view)] * len(mask_files))
+    volumes = thread_map(lambda job: cached_read(cache, job[1], job[0]), zip(readers, [dose_file, *mask_files]),
+                         INGEST_WORKERS)
+    dose_volume, dose_header = volumes[0]
+    structure_masks = {}
+    for mask_file, (mask_volume, mask_header) in zip(mask_files, volumes[1:]):
+        structure_masks[_structure_name(mask_file)], _ = _on_dose_grid(mask_file, mask_volume, mask_header,
+                                                                       dose_header, cache=cache, resample=resample)
 
     return dose_volume, structure_masks
 
 
-def dvh_by_structure(dose_volume, structure_masks):
+def shared_bins(dose_volumes, max_dose=None, step_size=0.1, bins=None):
+    # One set of edges for every curve of a chart, running past the highest dose of all volumes
+    if bins is not None:
+        return np.asarray(bins)
+    if max_dose is None:
+        return auto_bins(max(volume_max(dose) for dose in dose_volumes), step_size)
+    return dvh_bins(max_dose, step_size)
 
-    dvh_data = {}
-    max_dose = 70
-    step_size = 0.1
-    dvh_data["Dose"] = np.arange(0, max_dose, step_size)
 
-    for structure in structure_masks.keys():
-        bins, values = compute_dvh(dose_volume, structure_masks[structure], max_dose, step_size)
-        dvh_data[structure] = values
+def label_histograms(dose_volume, label_map: LabelMap, bins):
+    # Bin counts (structures x bins) of a fused label map, from the chunked label statistics
+    dose_values = dose_volume.ravel()[label_map.voxels]
+    return _chunked_statistics(dose_values[None], label_map, np.asarray(bins))[0][0]
 
-    df = pd.DataFrame.from_dict(dvh_data)
-    df = pd.melt(df, id_vars=['Dose'], value_vars=structure_masks.keys(),
-                 var_name='Structure', value_name='Volume')
-    return df
+
+def _streamed(dose_volume, structure_masks):
+    # Lazy volumes are histogrammed slab by slab instead of being gathered
+    return is_lazy(dose_volume) or (isinstance(structure_masks, dict) and
+                                    any(is_lazy(mask) for mask in structure_masks.values()))
 
 
-def dvh_by_dose(dose_volumes, structure_mask, structure_name):
+def dvh_frame(bins, names, counts, voxel_cc=None):
+    # Long DVH table (Dose, Structure, Volume in %) from per-structure bin counts over `bins`. Given the
+    # voxel volume, the absolute volume at each dose is added as "Volume (cc)".
     dvh_data = {}
-    max_dose = 70
-    step_size = 0.1
-    dvh_data["Dose"] = np.arange(0, max_dose, step_size)
+    dvh_data["Dose"] = bins
 
-    dose_id = []
-    for id in dose_volumes.keys():
-        bins, values = compute_dvh(dose_volumes[id], structure_mask, max_dose, step_size)
-        dose_id.append(structure_name + "_" + str(id))
-        dvh_data[structure_name + "_" + str(id)] = values
+    for structure, structure_counts in zip(names, counts):
+        total_voxels = structure_counts.sum()
+        if total_voxels == 0:
+            dvh_data[structure] = np.zeros(len(bins))
+        else:
+            dvh_data[structure] = cumulative_counts(structure_counts) / total_voxels * 100
 
     df = pd.DataFrame.from_dict(dvh_data)
-    df = pd.melt(df, id_vars=['Dose'], value_vars=dose_id,
+    df = pd.melt(df, id_vars=['Dose'], value_vars=names,
                  var_name='Structure', value_name='Volume')
+    if voxel_cc is not None:
+        structure_cc = {name: float(np.sum(structure_counts)) * voxel_cc for name, structure_counts in zip(names, counts)}
+        df["Volume (cc)"] = df["Volume"] / 100 * df["Structure"].map(structure_cc)
     return df
 
 
-def dose_summary(dose_volume, structure_masks):
-    dose_metrics = {}
-    for structure in structure_masks.keys():
-        dose_in_structure = dose_volume[structure_masks[structure] > 0]
-        dose_metrics[structure] = {
-            "Mean Dose": np.mean(dose_in_structure),
-            "Max Dose": np.max(dose_in_structure),
-            "Min Dose": np.min(dose_in_structure),
-            "D95": np.percentile(dose_in_structure, 95),
-            "D50": np.percentile(dose_in_structure, 50),
-            "D5": np.percentile(dose_in_structure, 5),
-        }
+@profiled
+def dvh_by_structure(dose_volume, structure_masks, max_dose=None, step_size=0.1, bins=None, voxel_cc=None,
+                     supersample=None):
+    # `supersample` switches to partial-volume DVHs (see compute_dvh)
+    bins = shared_bins([dose_volume], max_dose, step_size, bins)
+    histograms = structure_dose_histograms(dose_volume, structure_masks, bins, supersample=supersample)
+    return dvh_frame(bins, list(histograms), [histogram.counts for histogram in histograms.values()], voxel_cc)
+
+
+@profiled
+def dvh_by_dose(dose_volumes, structure_mask, structure_name, max_dose=None, step_size=0.1, bins=None):
+    # One curve per dose volume, named <structure>_<plan>
+    bins = shared_bins(dose_volumes.values(), max_dose, step_size, bins)
+    histograms = plan_dose_histograms(dose_volumes, {structure_name: structure_mask}, bins)
+    names = [structure_name + "_" + str(id) for id in histograms]
+    return dvh_frame(bins, names, [plan_histograms[structure_name].counts for plan_histograms in histograms.values()])
+
+
+@profiled
+def difference_dvh(dose_volumes, structure_mask, structure_name, reference, max_dose=None, step_size=0.1, bins=None):
+    # DVH of every other plan minus the DVH of the `reference` plan, in % of the structure volume
+    df = dvh_by_dose(dose_volumes, structure_mask, structure_name, max_dose, step_size, bins)
+    reference_name = structure_name + "_" + str(reference)
+    reference_volume = df.loc[df["Structure"] == reference_name, "Volume"].to_numpy()
+    df = df[df["Structure"] != reference_name].copy()
+    n_bins = len(reference_volume)
+    df["Volume Difference"] = df["Volume"].to_numpy() - np.tile(reference_volume, len(df) // n_bins if n_bins else 0)
+    return df.drop(columns="Volume").reset_index(drop=True)
+
+
+@profiled
+def partial_volume_histograms(dose_volume, structure_masks, bins=None, step_size=SUMMARY_STEP,
+                              factor=SUPERSAMPLING):
+    # One weighted DoseHistogram per structure from its partial-volume samples
+    masks = partial_volume_masks(structure_masks)
+    samples = dict(zip(masks, thread_map(lambda mask: partial_volume_samples(dose_volume, mask, factor),
+                                         masks.values())))
+    if bins is None:
+        bins = auto_bins(max((float(doses.max()) for doses, _ in samples.values() if len(doses)), default=0.0),
+                         step_size)
+    return {name: DoseHistogram(bins).add(doses, weights) for name, (doses, weights) in samples.items()}
+
+
+@profiled
+def structure_dose_histograms(dose_volume, structure_masks, bins=None, step_size=SUMMARY_STEP, supersample=None):
+    # One DoseHistogram per structure, all on the same bins. By default they run in `step_size` steps
+    # past the highest covered dose. In memory each structure's doses are gathered through its own mask
+    # (only the bounding box of a compact mask is touched); a LabelMap that is already fused is
+    # histogrammed in one 2-D pass. Lazy volumes go through the streaming backend. `supersample` gives
+    # partial-volume histograms.
+    if supersample:
+        return partial_volume_histograms(dose_volume, structure_masks, bins, step_size, supersample)
+    if _streamed(dose_volume, structure_masks):
+        if bins is None:
+            bins = stream_bins(dose_volume, step_size=step_size)
+        return stream_histograms(dose_volume, structure_masks, bins)
+    if isinstance(structure_masks, LabelMap):
+        return _label_map_histograms(dose_volume, structure_masks, bins, step_size)
+
+    names = list(structure_masks)
+    samples = thread_map(lambda name: sample_mask(dose_volume, structure_masks[name]), names)
+    if bins is None:
+        bins = auto_bins(max((float(values.max()) for values in samples if len(values)), default=0.0), step_size)
+    bins = np.asarray(bins)
+    return dict(zip(names, thread_map(lambda values: _sample_histogram(values, bins), samples)))
+
+
+def _sample_histogram(dose_values, bins):
+    histogram = DoseHistogram(bins)
+    for start in range(0, len(dose_values), HISTOGRAM_CHUNK_VALUES):
+        histogram.add(dose_values[start:start + HISTOGRAM_CHUNK_VALUES])
+    return histogram
+
+
+def _label_map_histograms(dose_volume, label_map: LabelMap, bins, step_size):
+    dose_values = dose_volume.ravel()[label_map.voxels]
+    if bins is None:
+        bins = auto_bins(float(dose_values.max()) if len(dose_values) else 0.0, step_size)
+    bins = np.asarray(bins)
+
+    counts, sums, mins, maxs = _chunked_statistics(dose_values[None], label_map, bins)
+    return {name: DoseHistogram.from_counts(bins, counts[0, index], sums[0, index], mins[0, index], maxs[0, index])
+            for index, name in enumerate(label_map.names)}
+
+
+def _label_statistics(dose_rows, labels, n_labels, bins):
+    # Bin counts, dose sums, minima and maxima per plan and label of the doses of several plans gathered on
+    # labelled voxels: dose_rows is a (plans, voxels) matrix. The counts only span the labels present and
+    # the bins between the lowest and highest dose of the chunk: (present labels, first bin, counts of
+    # plans x present labels x occupied bins), which keeps the bincount to about the size of the chunk.
+    n_plans = len(dose_rows)
+    labels = labels.astype(np.intp)
+    present = np.flatnonzero(np.bincount(labels, minlength=n_labels))
+    local = np.zeros(n_labels, dtype=np.intp)
+    local[present] = np.arange(len(present))
+
+    cells = bin_index(bins, dose_rows)
+    first = int(cells.min())
+    n_range = int(cells.max()) - first + 1
+    cells -= first
+    cells += local[labels] * n_range
+    cells += (np.arange(n_plans) * (len(present) * n_range))[:, None]
+    counts = np.bincount(cells.ravel(), minlength=n_plans * len(present) * n_range)
+    counts = counts.reshape(n_plans, len(present), n_range)
+    del cells
+
+    plan_labels = (labels + (np.arange(n_plans) * n_labels)[:, None]).ravel()
+    sums = np.bincount(plan_labels, weights=dose_rows.ravel(), minlength=n_plans * n_labels).reshape(n_plans, n_labels)
+
+    # Labels come in long runs along the voxel order: reduce each run, then the (few) runs per label
+    mins = np.full((n_plans, n_labels), np.inf)
+    maxs = np.full((n_plans, n_labels), -np.inf)
+    run_starts = np.flatnonzero(np.concatenate([[True], labels[1:] != labels[:-1]]))
+    order = np.argsort(labels[run_starts], kind="stable")
+    run_labels = labels[run_starts][order]
+    label_starts = np.flatnonzero(np.concatenate([[True], run_labels[1:] != run_labels[:-1]]))
+    run_min = np.minimum.reduceat(dose_rows, run_starts, axis=1)[:, order]
+    run_max = np.maximum.reduceat(dose_rows, run_starts, axis=1)[:, order]
+    mins[:, present] = np.minimum.reduceat(run_min, label_starts, axis=1)
+    maxs[:, present] = np.maximum.reduceat(run_max, label_starts, axis=1)
+    return (present, first, counts), sums, mins, maxs
+
+
+def _plan_statistics(dose_rows, labels, n_labels, bins):
+    # _label_statistics of a span of voxels, accumulated chunk by chunk into (plans x labels x bins) counts
+    # and (plans x labels) sums, minima and maxima
+    n_plans = len(dose_rows)
+    counts = np.zeros((n_plans, n_labels, len(bins) + 1), dtype=np.int64)
+    sums = np.zeros((n_plans, n_labels))
+    mins = np.full((n_plans, n_labels), np.inf)
+    maxs = np.full((n_plans, n_labels), -np.inf)
+    step = max(1, HISTOGRAM_CHUNK_VALUES // max(n_plans, 1))
+    for start in range(0, dose_rows.shape[1] if n_plans else 0, step):
+        (present, first, part), part_sums, part_mins, part_maxs = _label_statistics(
+            dose_rows[:, start:start + step], labels[start:start + step], n_labels, bins)
+        counts[:, present, first:first + part.shape[2]] += part
+        sums += part_sums
+        np.minimum(mins, part_mins, out=mins)
+        np.maximum(maxs, part_maxs, out=maxs)
+    return counts, sums, mins, maxs
+
+
+@profiled
+def _chunked_statistics(dose_rows, label_map: LabelMap, bins):
+    # Bin counts (plans x structures x bins), dose sums, minima and maxima (plans x structures) of the
+    # doses of several plans gathered on the label map's voxels. The label statistics of voxel spans are
+    # computed on the thread pool and merged, then summed up per structure.
+    membership = label_map.membership
+    parts = thread_map(lambda span: _plan_statistics(dose_rows[:, span[0]:span[1]], label_map.labels[span[0]:span[1]],
+                                                     len(membership), bins),
+                       chunks(dose_rows.shape[1]))
+    label_counts = sum(part[0] for part in parts)
+    label_sums = sum(part[1] for part in parts)
+    label_min = np.minimum.reduce([part[2] for part in parts])
+    label_max = np.maximum.reduce([part[3] for part in parts])
+
+    counts = membership.T.astype(np.int64) @ label_counts
+    sums = label_sums @ membership.astype(float)
+    mins = np.where(membership, label_min[:, :, None], np.inf).min(axis=1, initial=np.inf)
+    maxs = np.where(membership, label_max[:, :, None], -np.inf).max(axis=1, initial=-np.inf)
+    return counts, sums, mins, maxs
+
+
+def plan_dose_histograms(dose_volumes, structure_masks, bins=None, step_size=SUMMARY_STEP):
+    # {plan: {structure: DoseHistogram}} for many dose volumes (plans, iterations, scenarios) on one
+    # structure set. The structure voxels are located once; the doses of a batch of plans are gathered
+    # into one (plans, voxels) matrix and histogrammed together. By default the bins run in `step_size`
+    # steps past the highest dose of all plans.
+    label_map = fuse_masks(structure_masks)
+    plans = list(dose_volumes)
+    bins = shared_bins(dose_volumes.values(), step_size=step_size, bins=bins)
+    batch = max(1, PLAN_BATCH_VALUES // max(len(label_map.voxels), 1))
+
+    histograms = {}
+    for start in range(0, len(plans), batch):
+        batch_plans = plans[start:start + batch]
+        dose_rows = np.stack(thread_map(lambda plan: dose_volumes[plan].ravel()[label_map.voxels], batch_plans))
+        histograms.update(zip(batch_plans, row_histograms(dose_rows, label_map, bins)))
+    return histograms
+
+
+def row_histograms(value_rows, label_map: LabelMap, bins):
+    # [{structure: DoseHistogram}] of every row of a (rows, voxels) matrix of values gathered on the
+    # label map's voxels (plan doses, dose differences), all rows in one pass
+    counts, sums, mins, maxs = _chunked_statistics(value_rows, label_map, bins)
+    return [{name: DoseHistogram.from_counts(bins, counts[row, index], sums[row, index], mins[row, index],
+                                             maxs[row, index])
+             for index, name in enumerate(label_map.names)}
+            for row in range(len(value_rows))]
+
+
+@profiled
+def summary_by_plan(dose_volumes, structure_masks, metrics=DEFAULT_METRICS, voxel_cc=None):
+    # dose_summary of every plan, from plan_dose_histograms
+    histograms = plan_dose_histograms(dose_volumes, structure_masks)
+    grids = {plan: grid_histogram(dose_volumes[plan]) if needs_grid(metrics) else None for plan in histograms}
+    return {plan: pd.DataFrame.from_dict({name: histogram_summary(histogram, metrics, voxel_cc, name, grids[plan])
+                                          for name, histogram in plan_histograms.items()}).T
+            for plan, plan_histograms in histograms.items()}
+
+
+@profiled
+def dvh_by_plan(dose_volumes, structure_masks, max_dose=None, step_size=0.1, bins=None, voxel_cc=None):
+    # dvh_by_structure of every plan, all on the same dose axis
+    bins = shared_bins(dose_volumes.values(), max_dose, step_size, bins)
+    histograms = plan_dose_histograms(dose_volumes, structure_masks, bins)
+    return {plan: dvh_frame(bins, list(plan_histograms), [histogram.counts for histogram in plan_histograms.values()],
+                            voxel_cc)
+            for plan, plan_histograms in histograms.items()}
+
+
+@profiled
+def grid_histogram(dose_volume, step_size=SUMMARY_STEP):
+    # Histogram of every voxel of the dose grid, for metrics that look outside their structure (the
+    # prescription isodose volume of CIx). Only built when such a metric is asked for.
+    bins = stream_bins(dose_volume, step_size=step_size)
+    if not is_lazy(dose_volume):
+        return DoseHistogram(bins).add(dose_volume)
+    histogram = DoseHistogram(bins)
+    for _, _, slab in iter_slabs(dose_volume):
+        histogram.add(slab)
+    return histogram
+
+
+def histogram_summary(histogram, metrics=DEFAULT_METRICS, voxel_cc=None, structure=None, grid=None):
+    # With the voxel volume the structure volume is reported too, as "Volume (cc)". The structure name
+    # picks organ parameters (gEUD, NTCP) and `grid` is the grid_histogram CIx needs.
+    volume = {} if voxel_cc is None else {"Volume (cc)": histogram.count * voxel_cc}
+    if histogram.count == 0:
+        return {**dict.fromkeys(DOSE_STATISTICS, np.nan), **volume, **dict.fromkeys(metrics, np.nan)}
+    return {
+        "Mean Dose": histogram.mean,
+        "Max Dose": histogram.max,
+        "Min Dose": histogram.min,
+        **volume,
+        **evaluate_metrics(histogram, metrics, voxel_cc, structure, grid),
+    }
+
+
+@profiled
+def dose_summary(dose_volume, structure_masks, metrics=DEFAULT_METRICS, voxel_cc=None, supersample=None):
+    # Mean, max and min are exact. The Dx/Vx/Dcc metrics (see src.metrics; D2, D98, D0.03cc, V20, ...)
+    # are all read from one cumulative histogram per structure with SUMMARY_STEP bins, which bounds their
+    # error to SUMMARY_STEP Gy. Dcc and Vcc metrics need the voxel volume in cc. With `supersample` the
+    # summary comes from partial-volume histograms (see compute_dvh), mean, max and min included.
+    # gEUD, NTCP, HI and CIx come from the same histograms; CIx adds one pass over the whole grid.
+    histograms = structure_dose_histograms(dose_volume, structure_masks, supersample=supersample)
+    grid = grid_histogram(dose_volume) if needs_grid(metrics) else None
+    dose_metrics = {name: histogram_summary(histogram, metrics, voxel_cc, name, grid)
+                    for name, histogram in histograms.items()}
 
     df = pd.DataFrame.from_dict(dose_metrics).T
     return df
 
 
+# Summary column each constraint type limits and the default direction of the limit. "volume" (Vx, Vxcc)
+# and "dose" (Dx, Dxcc) constraints name the dose_summary metric they limit in the "Metric" column, and
+# an optional "Operator" column ("<=" or ">=") overrides the direction, e.g. for target coverage.
+CONSTRAINT_TYPES = {
+    "max": ("Max Dose", "<="),
+    "min": ("Min Dose", ">="),
+    "mean": ("Mean Dose", "<="),
+    "volume": (None, "<="),
+    "dose": (None, "<="),
+}
+
+
+def _constraint_columns(constraint):
+    kind = constraint["Constraint Type"].astype(str).to_numpy()
+    metric = np.array([CONSTRAINT_TYPES.get(k, (None, None))[0] for k in kind], dtype=object)
+    if "Metric" in constraint:
+        given = constraint["Metric"].to_numpy(dtype=object)
+        metric = np.where(pd.isna(metric), given, metric)
+    operator = np.array([CONSTRAINT_TYPES.get(k, (None, None))[1] for k in kind], dtype=object)
+    if "Operator" in constraint:
+        given = constraint["Operator"].to_numpy(dtype=object)
+        operator = np.where(pd.isna(given), operator, given)
+    return kind, metric, operator
+
+
+def constraint_metrics(constraint):
+    # The Dx/Vx metrics a constraint table needs from dose_summary
+    _, metric, _ = _constraint_columns(constraint)
+    return [name for name in dict.fromkeys(metric) if isinstance(name, str) and name not in DOSE_STATISTICS]
+
+
+def _unknown_reason(kind, metric, operator, level, value):
+    # Why a constraint of a structure in the summary could not be evaluated
+    if not isinstance(metric, str) or not metric:
+        return f"No metric given for {kind} constraint"
+    if operator not in ("<=", ">="):
+        return f"Unknown operator {operator} for {metric}"
+    if np.isnan(level):
+        return f"No level given for {metric}"
+    return f"Metric {metric} not available"
+
+
+@profiled
 def check_compliance(df, constraint):
-
-    compliance_df = pd.DataFrame()
-    for structure in constraint["Structure"]:
-        if structure not in df.index:
-            compliance_df.loc[structure] = np.nan
+    # Every constraint row is looked up in the summary table by (structure, metric) at once and compared
+    # in one vectorised step. Rows of structures missing from the summary come back empty.
+    constraint = constraint.reset_index(drop=True)
+    structures = constraint["Structure"].to_numpy(dtype=object)
+    kind, metric, operator = _constraint_columns(constraint)
+    level = pd.to_numeric(constraint["Level"], errors="coerce").to_numpy(dtype=float)
+
+    rows = df.index.get_indexer(structures)
+    columns = df.columns.get_indexer(pd.Index(metric, dtype=object))
+    table = df.to_numpy(dtype=float)
+    found = (rows >= 0) & (columns >= 0)
+    value = np.full(len(constraint), np.nan)
+    value[found] = table[rows[found], columns[found]]
+
+    upper = operator == "<="
+    passed = np.where(upper, value <= level, value >= level)
+    known = ~np.isnan(value) & ~np.isnan(level) & np.isin(operator, ["<=", ">="])
+
+    level_text = [f"{limit:g}" if float(limit).is_integer() else f"{limit}" for limit in level]
+    legacy_names = {"max": "Max dose", "min": "Min dose", "mean": "Mean dose"}
+    reasons = []
+    for k, name, op, limit, amount, ok, upper_limit in zip(kind, metric, operator, level_text, value, passed, upper):
+        label = legacy_names.get(k, name)
+        if ok:
+            reasons.append(f"{label} is within constraint! ")
+        elif k in legacy_names:
+            reasons.append(f"{label} constraint: {limit} {'exceeded' if upper_limit else 'not met'}: {amount}")
         else:
-            if constraint.loc[constraint["Structure"] == structure, "Constraint Type"].values[0] == "max":
-                if df.loc[structure, "Max Dose"] > constraint.loc[constraint["Structure"] == structure, "Level"].values[0]:
-                    compliance_df.loc[structure, "Compliance"] = "❌ No"
-                    compliance_df.loc[structure, "Reason"] = (f"Max dose constraint: "
-                                                              f"{constraint.loc[constraint['Structure'] == structure, 'Level'].values[0]}"
-                                                              f" exceeded: {df.loc[structure, 'Max Dose']}")
-                else:
-                    compliance_df.loc[structure, "Compliance"] = "✅ Yes"
-                    compliance_df.loc[structure, "Reason"] = (f"Max dose is within constraint! ")
-            elif constraint.loc[constraint["Structure"] == structure, "Constraint Type"].values[0] == "min":
-                if df.loc[structure, "Min Dose"] < constraint.loc[constraint["Structure"] == structure, "Level"].values[0]:
-                    compliance_df.loc[structure, "Compliance"] = "❌ No"
-                    compliance_df.loc[structure, "Reason"] = (f"Min dose constraint: "
-                                                              f"{constraint.loc[constraint['Structure'] == structure, 'Level'].values[0]}"
-                                                              f" not met: {df.loc[structure, 'Min Dose']}")
-                else:
-                    compliance_df.loc[structure, "Compliance"] = "✅ Yes"
-                    compliance_df.loc[structure, "Reason"] = (f"Min dose is within constraint! ")
-            elif constraint.loc[constraint["Structure"] == structure, "Constraint Type"].values[0] == "mean":
-                if df.loc[structure, "Mean Dose"] > constraint.loc[constraint["Structure"] == structure, "Level"].values[0]:
-                    compliance_df.loc[structure, "Compliance"] = "❌ No"
-                    compliance_df.loc[structure, "Reason"] = (f"Mean dose constraint: "
-                                                              f"{constraint.loc[constraint['Structure'] == structure, 'Level'].values[0]}"
-                                                              f" exceeded: {df.loc[structure, 'Mean Dose']}")
-                else:
-                    compliance_df.loc[structure, "Compliance"] = "✅ Yes"
-                    compliance_df.loc[structure, "Reason"] = (f"Mean dose is within constraint! ")
-            elif constraint.loc[constraint["Structure"] == structure, "Constraint Type"].values[0] == "volume":
-                compliance_df.loc[structure, "Compliance"] = "✅ Yes"
-                compliance_df.loc[structure, "Reason"] = (f"Volume dose is within constraint! ")
-
-    return compliance_df
+            reasons.append(f"{label} constraint: {op} {limit} not met: {amount}")
+
+    compliance = np.where(passed, "✅ Yes", "❌ No").astype(object)
+    reasons = np.array(reasons, dtype=object)
+    compliance[~known] = np.nan
+    reasons[~known] = np.nan
+    unknown = (rows >= 0) & ~known
+    reasons[unknown] = [_unknown_reason(k, name, op, limit, amount) for k, name, op, limit, amount in
+                        zip(kind[unknown], metric[unknown], operator[unknown], level[unknown], value[unknown])]
+
+    return pd.DataFrame({"Compliance": compliance, "Reason": reasons}, index=pd.Index(structures, name=None))
+
+
+@profiled
+def worst_case_compliance(lowest, highest, constraint):
+    # Compliance in the worst of several scenarios, from the lowest and highest value of every metric
+    # over them: upper limits ("<=") are checked on the highest value, lower limits on the lowest
+    constraint = constraint.reset_index(drop=True)
+    _, _, operator = _constraint_columns(constraint)
+    upper = check_compliance(highest, constraint)
+    lower = check_compliance(lowest, constraint)
+    return pd.DataFrame(np.where((operator == "<=")[:, None], upper.to_numpy(), lower.to_numpy()),
+                        index=upper.index, columns=upper.columns)
 
 
 def get_default_constraints():
@@ -166,7 +606,8 @@ def get_default_constraints():
             {"Structure": "OpticNerve_R", "Constraint Type": "max", "Level": 54},
             {"Structure": "Pituitary", "Constraint Type": "mean", "Level": 45},
             {"Structure": "Target", "Constraint Type": "min", "Level": 60},
-        ]
+        ],
+        columns=["Structure", "Constraint Type", "Level", "Metric"],
     )
 
     return constraint_df
@@ -0,0 +1,220 @@
+import numpy as np
+import pandas as pd
+
+from src import utils
+from src.incremental import IncrementalDVH
+from src.metrics import DEFAULT_METRICS, needs_grid
+from src.parallel import thread_map
+from src.profiling import profiled
+from src.structure import CompactMask
+
+# First search radius (mm) of the surface distance transform; doubled until every distance is resolved
+SURFACE_DISTANCE_RADIUS = 16.0
+
+OVERLAP_METRICS = ["Volume (cc)", "Volume Difference (cc)", "Volume Difference (%)", "Dice",
+                   "Hausdorff (mm)", "HD95 (mm)", "Mean Surface Distance (mm)"]
+
+
+def _union_box(masks):
+    boxes = []
+    for mask in masks:
+        box = mask.box if isinstance(mask, CompactMask) else CompactMask.from_dense(mask).box
+        if all(start < stop for start, stop in box):
+            boxes.append(box)
+    if not boxes:
+        return None
+    return [(min(a for a, _ in axis), max(b for _, b in axis)) for axis in zip(*boxes)]
+
+
+def _box_masks(masks, box):
+    # Every mask as a boolean array over `box`
+    shape = [stop - start for start, stop in box]
+    box_masks = []
+    for mask in masks:
+        if isinstance(mask, CompactMask):
+            box_mask = np.zeros(shape, dtype=bool)
+            if all(start < stop for start, stop in mask.box):
+                box_mask[tuple(slice(a - start, b - start) for (a, b), (start, _) in zip(mask.box, box))] = \
+                    mask.box_mask()
+        else:
+            box_mask = np.asarray(mask)[tuple(slice(start, stop) for start, stop in box)] > 0
+        box_masks.append(box_mask)
+    return box_masks
+
+
+def variant_histograms(dose_volume, variants, bins=None, step_size=utils.SUMMARY_STEP):
+    # Histograms of several versions of one structure (e.g. the same organ from different segmentations).
+    # The first version is histogrammed in full and an IncrementalDVH then moves from each version to the
+    # next, so every version past the first costs about its disagreement with the one before.
+    if bins is None:
+        box = _union_box(variants.values())
+        if box is None:
+            bins = utils.auto_bins(0.0, step_size)
+        else:
+            union = np.logical_or.reduce(_box_masks(variants.values(), box))
+            dose_box = np.asarray(dose_volume[tuple(slice(start, stop) for start, stop in box)])
+            bins = utils.auto_bins(float(dose_box[union].max()), step_size)
+    histograms = {}
+    tracker = None
+    for name, mask in variants.items():
+        tracker = IncrementalDVH(dose_volume, mask, bins=bins) if tracker is None else tracker.set_mask(mask)
+        histograms[name] = tracker.histogram.copy()
+    return histograms
+
+
+@profiled
+def variant_dvh(dose_volume, variants, max_dose=None, step_size=0.1, bins=None, voxel_cc=None):
+    # Same table as utils.dvh_by_structure, for versions of one structure
+    bins = utils.shared_bins([dose_volume], max_dose, step_size, bins)
+    histograms = variant_histograms(dose_volume, variants, bins)
+    return utils.dvh_frame(bins, list(histograms), [histogram.counts for histogram in histograms.values()], voxel_cc)
+
+
+def variant_summary(dose_volume, variants, metrics=DEFAULT_METRICS, voxel_cc=None, structure=None, grid=None):
+    # Same table as utils.dose_summary, for versions of one structure (named `structure`, for its organ
+    # parameters)
+    histograms = variant_histograms(dose_volume, variants)
+    return pd.DataFrame.from_dict({name: utils.histogram_summary(histogram, metrics, voxel_cc, structure, grid)
+                                   for name, histogram in histograms.items()}).T
+
+
+def _shared_structures(segmentations):
+    # Structures found in at least two of the segmentations
+    seen = {}
+    for structure_masks in segmentations.values():
+        for name in structure_masks:
+            seen[name] = seen.get(name, 0) + 1
+    return [name for name, count in seen.items() if count > 1]
+
+
+@profiled
+def segmentation_summaries(dose_volume, segmentations, metrics=DEFAULT_METRICS, voxel_cc=None):
+    # utils.dose_summary of every segmentation ({id: {structure: mask}}), with the versions of a structure
+    # that appears in several segmentations evaluated together by variant_summary
+    shared = _shared_structures(segmentations)
+    grid = utils.grid_histogram(dose_volume) if needs_grid(metrics) else None
+    rows = {}
+    versions = {name: {id: masks[name] for id, masks in segmentations.items() if name in masks} for name in shared}
+    for name, summary in zip(shared, thread_map(lambda name: variant_summary(dose_volume, versions[name], metrics,
+                                                                             voxel_cc, name, grid), shared)):
+        for id, row in summary.iterrows():
+            rows[id, name] = row
+    summaries = {}
+    for id, structure_masks in segmentations.items():
+        others = {name: mask for name, mask in structure_masks.items() if name not in shared}
+        rest = utils.dose_summary(dose_volume, others, metrics, voxel_cc) if others else None
+        summaries[id] = pd.DataFrame([rows[id, name] if name in shared else rest.loc[name]
+                                      for name in structure_masks], index=list(structure_masks))
+    return summaries
+
+
+@profiled
+def segmentation_dvhs(dose_volume, segmentations, max_dose=None, step_size=0.1, voxel_cc=None):
+    # utils.dvh_by_structure of every segmentation, sharing the work between versions of a structure
+    bins = utils.shared_bins([dose_volume], max_dose, step_size)
+    shared = _shared_structures(segmentations)
+    counts = {}
+    versions = [{id: masks[name] for id, masks in segmentations.items() if name in masks} for name in shared]
+    for name, histograms in zip(shared, thread_map(lambda variants: variant_histograms(dose_volume, variants, bins),
+                                                   versions)):
+        for id, histogram in histograms.items():
+            counts[id, name] = histogram.counts
+    dvhs = {}
+    for id, structure_masks in segmentations.items():
+        others = {name: mask for name, mask in structure_masks.items() if name not in shared}
+        if others:
+            histograms = utils.structure_dose_histograms(dose_volume, others, bins)
+            counts.update({(id, name): histogram.counts for name, histogram in histograms.items()})
+        names = list(structure_masks)
+        dvhs[id] = utils.dvh_frame(bins, names, [counts[id, name] for name in names], voxel_cc)
+    return dvhs
+
+
+def _shift_min(squared, axis, radius, spacing):
+    # min over |d| <= radius voxels of squared[i + d] + (d * spacing)^2 along `axis`
+    squared = np.moveaxis(squared, axis, 0)
+    result = squared.copy()
+    n = squared.shape[0]
+    for d in range(1, min(radius, n - 1) + 1):
+        cost = np.float32((d * spacing) ** 2)
+        np.minimum(result[:n - d], squared[d:] + cost, out=result[:n - d])
+        np.minimum(result[d:], squared[:n - d] + cost, out=result[d:])
+    return np.moveaxis(result, 0, axis)
+
+
+def distance_to(features, spacing, radius):
+    # Euclidean distance (mm) from every voxel to the nearest feature voxel, exact up to `radius` mm;
+    # larger distances are only known to exceed `radius` and come back as inf. The first axis is solved
+    # exactly by running the last/next feature index along it; the other two take the lower envelope of
+    # the shifted squared distances within the radius, one axis at a time.
+    n = features.shape[0]
+    index = np.arange(n, dtype=np.float32).reshape(-1, 1, 1)
+    last = np.maximum.accumulate(np.where(features, index, -np.inf), axis=0)
+    following = np.minimum.accumulate(np.where(features, index, np.inf)[::-1], axis=0)[::-1]
+    squared = (np.minimum(index - last, following - index) * np.float32(spacing[0])) ** 2
+    for axis in (1, 2):
+        squared = _shift_min(squared, axis, int(np.ceil(radius / spacing[axis])), spacing[axis])
+    distance = np.sqrt(squared)
+    distance[distance > radius] = np.inf
+    return distance
+
+
+def _surface(mask):
+    # Mask voxels with at least one face neighbour outside the mask
+    padded = np.pad(mask, 1)
+    interior = mask.copy()
+    for axis in range(3):
+        for step in (-1, 1):
+            interior &= np.roll(padded, step, axis=axis)[1:-1, 1:-1, 1:-1]
+    return mask & ~interior
+
+
+def surface_distances(mask, reference, spacing=(1.0, 1.0, 1.0), radius=SURFACE_DISTANCE_RADIUS):
+    # Distances (mm) from each surface voxel of `mask` to the surface of `reference` and back, both as
+    # boolean arrays on one grid. The distance transform is truncated at `radius` and the radius is
+    # doubled until every surface voxel has its distance.
+    surface, reference_surface = _surface(mask), _surface(reference)
+    if not surface.any() or not reference_surface.any():
+        return np.zeros(0), np.zeros(0)
+    limit = np.linalg.norm(np.array(mask.shape) * np.asarray(spacing, dtype=float))
+    while True:
+        to_reference = distance_to(reference_surface, spacing, radius)[surface]
+        to_mask = distance_to(surface, spacing, radius)[reference_surface]
+        if (np.isfinite(to_reference).all() and np.isfinite(to_mask).all()) or radius > limit:
+            return to_reference, to_mask
+        radius *= 2
+
+
+@profiled
+def variant_overlap(variants, reference=None, spacing=(1.0, 1.0, 1.0)):
+    # Overlap of every version of a structure with the reference version (the first by default): volume,
+    # volume difference, Dice and the Hausdorff, 95th percentile Hausdorff and mean surface distances.
+    # All masks are compared inside the box around them.
+    names = list(variants)
+    reference = names[0] if reference is None else reference
+    voxel_cc = float(np.prod(spacing)) / 1000
+    box = _union_box(variants.values())
+    if box is None:
+        return pd.DataFrame(np.nan, index=names, columns=OVERLAP_METRICS)
+    box_masks = dict(zip(names, _box_masks(variants.values(), box)))
+    reference_mask = box_masks[reference]
+    reference_voxels = int(reference_mask.sum())
+
+    # The distance transforms of the versions are independent: one thread each
+    distances = thread_map(lambda box_mask: surface_distances(box_mask, reference_mask, spacing), box_masks.values())
+    rows = {}
+    for (name, box_mask), (to_reference, to_mask) in zip(box_masks.items(), distances):
+        voxels = int(box_mask.sum())
+        both = voxels + reference_voxels
+        row = {
+            "Volume (cc)": voxels * voxel_cc,
+            "Volume Difference (cc)": (voxels - reference_voxels) * voxel_cc,
+            "Volume Difference (%)": (voxels - reference_voxels) / reference_voxels * 100 if reference_voxels else np.nan,
+            "Dice": 2 * int((box_mask & reference_mask).sum()) / both if both else np.nan,
+        }
+        if len(to_reference):
+            row["Hausdorff (mm)"] = max(to_reference.max(), to_mask.max())
+            row["HD95 (mm)"] = max(np.percentile(to_reference, 95), np.percentile(to_mask, 95))
+            row["Mean Surface Distance (mm)"] = (to_reference.sum() + to_mask.sum()) / (len(to_reference) + len(to_mask))
+        rows[name] = row
+    return pd.DataFrame.from_dict(rows, orient="index").reindex(columns=OVERLAP_METRICS)
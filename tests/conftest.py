@@ -0,0 +1,32 @@
+import numpy as np
+import nibabel as nib
+import pytest
+
+from benchmarks.phantoms import dose_phantom, structure_phantoms
+
+# Small enough for every test to run in well under a second, large enough for several slabs
+SHAPE = (40, 40, 36)
+SPACING = (2.0, 2.0, 2.5)
+
+
+@pytest.fixture
+def dose():
+    return dose_phantom(SHAPE, seed=1)
+
+
+@pytest.fixture
+def masks():
+    return structure_phantoms(SHAPE, 6)
+
+
+@pytest.fixture
+def case_files(tmp_path, dose, masks):
+    # The phantom case as NIfTI files: (dose path, [mask paths])
+    affine = np.diag([*SPACING, 1.0])
+    nib.save(nib.Nifti1Image(dose, affine), tmp_path / "dose.nii.gz")
+    (tmp_path / "masks").mkdir()
+    mask_paths = []
+    for name, mask in masks.items():
+        mask_paths.append(tmp_path / "masks" / f"{name}.nii.gz")
+        nib.save(nib.Nifti1Image(mask, affine), mask_paths[-1])
+    return tmp_path / "dose.nii.gz", mask_paths
@@ -0,0 +1,53 @@
+import pandas as pd
+
+from benchmarks import legacy
+from benchmarks.phantoms import protocol
+from src import utils
+
+LEVELS = [0, 10, 30, 45, 54, 70]
+
+
+def _legacy_constraints(names):
+    # max, min and mean limits at levels both sides of every structure's dose, and a structure without a mask
+    rows = [{"Structure": name, "Constraint Type": kind, "Level": level}
+            for kind in ("max", "min", "mean") for name in names for level in LEVELS]
+    rows.append({"Structure": "Missing", "Constraint Type": "max", "Level": 54})
+    return pd.DataFrame(rows)
+
+
+def test_check_compliance_matches_the_reference(dose, masks):
+    summary = utils.dose_summary(dose, masks)
+    constraint = _legacy_constraints(list(masks))
+    result = utils.check_compliance(summary, constraint)
+    assert set(result["Compliance"].dropna()) == {"✅ Yes", "❌ No"}
+    # The reference keeps one row per structure, so it checks the constraints one at a time
+    for position in range(len(constraint)):
+        expected = legacy.check_compliance(summary, constraint.iloc[[position]]).iloc[0]
+        assert result.iloc[position].fillna("").tolist() == expected.fillna("").tolist()
+
+def test_dvh_point_constraints(dose, masks):
+    summary = utils.dose_summary(dose, masks, ["V20", "D2", "D0.03cc"], voxel_cc=0.01)
+    constraint = pd.DataFrame([
+        {"Structure": "Target", "Constraint Type": "volume", "Level": 95, "Metric": "V20", "Operator": ">="},
+        {"Structure": "Body", "Constraint Type": "volume", "Level": 1, "Metric": "V20", "Operator": None},
+        {"Structure": "Body", "Constraint Type": "dose", "Level": 80, "Metric": "D2", "Operator": None},
+        {"Structure": "Body", "Constraint Type": "dose", "Level": 45, "Metric": "D0.03cc", "Operator": None},
+        {"Structure": "Body", "Constraint Type": "dose", "Level": 45, "Metric": "D50", "Operator": None},
+        {"Structure": "Body", "Constraint Type": "dose", "Level": 45, "Metric": "D2", "Operator": "<"},
+    ])
+    result = utils.check_compliance(summary, constraint)
+    expected = [summary.loc["Target", "V20"] >= 95, summary.loc["Body", "V20"] <= 1,
+                summary.loc["Body", "D2"] <= 80, summary.loc["Body", "D0.03cc"] <= 45]
+    assert result["Compliance"].iloc[:4].tolist() == ["✅ Yes" if ok else "❌ No" for ok in expected]
+    assert result["Reason"].iloc[4] == "Metric D50 not available"
+    assert result["Reason"].iloc[5] == "Unknown operator < for D2"
+    assert result["Compliance"].iloc[4:].isna().all()
+
+
+def test_protocol_rows_are_checked_in_order(dose, masks):
+    constraint = protocol(list(masks) + ["Missing"], n_rows=40)
+    summary = utils.dose_summary(dose, masks, utils.constraint_metrics(constraint), voxel_cc=0.01)
+    result = utils.check_compliance(summary, constraint)
+    assert result.index.tolist() == constraint["Structure"].tolist()
+    assert result.loc["Missing"].isna().all().all()
+    assert result.drop(index="Missing")["Compliance"].isin(["✅ Yes", "❌ No"]).all()
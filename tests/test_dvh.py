@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+from benchmarks import legacy
+from src import utils
+from src.structure import CompactMask, fuse_masks
+
+LEGACY_BINS = np.arange(0, 70, 0.1)
+
+
+def test_compute_dvh_matches_the_per_bin_loop(dose, masks):
+    for mask in masks.values():
+        bins, values = utils.compute_dvh(dose, mask, max_dose=65, step_size=0.1)
+        legacy_bins, legacy_values = legacy.compute_dvh(dose, mask, max_dose=65, step_size=0.1)
+        np.testing.assert_array_equal(bins, legacy_bins)
+        np.testing.assert_allclose(values, legacy_values, rtol=1e-12, atol=1e-9)
+
+
+def test_compute_dvh_of_an_empty_mask(dose):
+    bins, values = utils.compute_dvh(dose, np.zeros(dose.shape, dtype=np.uint8), max_dose=65)
+    assert len(values) == len(bins) and not values.any()
+
+
+def test_dvh_by_structure_matches_the_per_bin_loop(dose, masks):
+    df = utils.dvh_by_structure(dose, masks, bins=LEGACY_BINS)
+    expected = legacy.dvh_by_structure(dose, masks)
+    pd.testing.assert_frame_equal(df[["Dose", "Structure"]], expected[["Dose", "Structure"]])
+    np.testing.assert_allclose(df["Volume"], expected["Volume"], rtol=1e-12, atol=1e-9)
+
+
+def test_dvh_by_structure_is_the_same_for_every_mask_form(dose, masks):
+    df = utils.dvh_by_structure(dose, masks, voxel_cc=0.01)
+    compact = {name: CompactMask.from_dense(mask) for name, mask in masks.items()}
+    pd.testing.assert_frame_equal(utils.dvh_by_structure(dose, compact, voxel_cc=0.01), df)
+    pd.testing.assert_frame_equal(utils.dvh_by_structure(dose, fuse_masks(masks), voxel_cc=0.01), df)
+    assert df.groupby("Structure", sort=False)["Volume (cc)"].first().to_dict() == {
+        name: mask.sum() * 0.01 for name, mask in masks.items()}
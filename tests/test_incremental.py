@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from src import utils
+from src.incremental import IncrementalDVH
+from src.structure import CompactMask
+from src.variants import segmentation_summaries, variant_histograms
+from benchmarks.phantoms import dose_phantom, structure_phantoms
+
+SHAPE = (48, 48, 40)
+
+
+@pytest.fixture
+def dose():
+    return dose_phantom(SHAPE, seed=1)
+
+
+def _assert_same(histogram, expected):
+    assert np.array_equal(histogram.counts, expected.counts)
+    assert histogram.count == expected.count
+    assert histogram.sum == pytest.approx(expected.sum, rel=1e-9)
+    assert (histogram.min, histogram.max) == (expected.min, expected.max)
+
+
+def test_edits_match_a_full_recompute(dose):
+    rng = np.random.default_rng(0)
+    mask = structure_phantoms(SHAPE, 3)["Organ_0"] > 0
+    tracker = IncrementalDVH(dose, mask)
+    for _ in range(10):
+        # Edits near the structure: voxels removed from it and grown next to it
+        added = np.zeros(SHAPE, dtype=bool)
+        added[CompactMask.from_dense(mask).slices] = rng.random(CompactMask.from_dense(mask).box_shape) < 0.05
+        removed = mask & (rng.random(SHAPE) < 0.2)
+        tracker.update(added=added, removed=np.flatnonzero(removed))
+        mask = (mask & ~removed) | added
+        _assert_same(tracker.histogram, utils.DoseHistogram(tracker.histogram.bins).add(dose[mask]))
+    # Membership is kept over the structure's bounding box, not the grid
+    assert tracker.box == [tuple(axis) for axis in CompactMask.from_dense(mask).box]
+    assert tracker.inside.size < mask.size
+
+
+def test_set_mask_moves_between_versions(dose):
+    masks = structure_phantoms(SHAPE, 4)
+    tracker = IncrementalDVH(dose, masks["Target"])
+    for name in ["Body", "Organ_1", "Target", "Organ_0"]:
+        tracker.set_mask(CompactMask.from_dense(masks[name]))
+        _assert_same(tracker.histogram, utils.DoseHistogram(tracker.histogram.bins).add(dose[masks[name] > 0]))
+    tracker.set_mask(np.zeros(SHAPE, dtype=bool))
+    assert tracker.histogram.count == 0
+
+
+def test_variants_match_the_dose_summary(dose):
+    base = structure_phantoms(SHAPE, 5)
+    segmentations = {id: {name: np.roll(mask, id, axis=0) for name, mask in base.items()} for id in range(3)}
+    bins = utils.auto_bins(float(dose.max()), 0.1)
+    histograms = variant_histograms(dose, {id: masks["Organ_2"] for id, masks in segmentations.items()}, bins)
+    for id, masks in segmentations.items():
+        _assert_same(histograms[id], utils.DoseHistogram(bins).add(dose[masks["Organ_2"] > 0]))
+
+    summaries = segmentation_summaries(dose, segmentations, voxel_cc=0.001)
+    for id, masks in segmentations.items():
+        expected = utils.dose_summary(dose, masks, voxel_cc=0.001)
+        np.testing.assert_allclose(summaries[id].astype(float), expected.astype(float), rtol=1e-9)
@@ -0,0 +1,55 @@
+import pandas as pd
+
+from benchmarks.phantoms import protocol
+from src import index, utils
+from src.index import DVHIndex
+
+
+def test_check_on_an_empty_index(tmp_path, capsys):
+    report = DVHIndex(tmp_path / "index").check(utils.get_default_constraints())
+    assert report.empty
+    assert list(report.columns) == ["patient", "plan", "segmentation", "Structure", "Compliance", "Reason"]
+
+    assert index.main(["check", str(tmp_path / "index")]) == 0
+    assert "No indexed cases" in capsys.readouterr().out
+
+
+def _index_case(root, case_files, plan="A"):
+    dose_file, mask_files = case_files
+    records = index.index_patient(root, "P1", [{"plan": plan, "segmentation": "S", "dose": dose_file,
+                                                "masks": mask_files}])
+    DVHIndex(root).register(records)
+    return records[0]["key"]
+
+
+def _direct_summary(case_files, metrics):
+    dose_file, mask_files = case_files
+    dose_volume, header = utils.read_dose(dose_file)
+    return utils.dose_summary(dose_volume, utils.read_masks(mask_files), metrics, utils.voxel_volume_cc(header))
+
+
+def test_check_matches_direct_compliance(tmp_path, case_files, masks):
+    root = tmp_path / "index"
+    key = _index_case(root, case_files)
+    # The same content gets the same key, and is not histogrammed again
+    assert _index_case(root, case_files, plan="B") == key
+    constraint = protocol(list(masks) + ["Missing"], n_rows=30)
+    expected = utils.check_compliance(_direct_summary(case_files, utils.constraint_metrics(constraint)), constraint)
+
+    report = DVHIndex(root).check(constraint)
+    assert report["plan"].unique().tolist() == ["A", "B"]
+    for _, case in report.groupby("plan"):
+        assert case["Structure"].tolist() == expected.index.tolist()
+        assert case["Compliance"].fillna("").tolist() == expected["Compliance"].fillna("").tolist()
+        assert case["Reason"].fillna("").tolist() == expected["Reason"].fillna("").tolist()
+
+
+def test_summary_matches_dose_summary(tmp_path, case_files):
+    root = tmp_path / "index"
+    _index_case(root, case_files)
+    metrics = ["D95", "D2", "V20", "D0.03cc", "gEUD"]
+    expected = _direct_summary(case_files, metrics)
+    summary = DVHIndex(root).summary(metrics).set_index("Structure")
+    assert summary[["patient", "plan", "segmentation"]].drop_duplicates().values.tolist() == [["P1", "A", "S"]]
+    pd.testing.assert_frame_equal(summary[expected.columns].astype(float), expected.astype(float),
+                                  check_names=False, rtol=1e-9)
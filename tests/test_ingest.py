@@ -0,0 +1,62 @@
+import io
+import gzip
+
+import numpy as np
+import nibabel as nib
+
+from benchmarks import legacy
+from benchmarks.phantoms import nifti_gz
+from src import utils
+
+
+def _scaled_upload(dose):
+    # Dose stored as int16 with a scale factor, as many planning systems export it
+    img = nib.Nifti1Image(np.round(dose * 100).astype(np.int16), np.eye(4))
+    img.header.set_slope_inter(0.01, 0)
+    upload = io.BytesIO(gzip.compress(img.to_bytes(), mtime=0))
+    upload.name = "dose.nii.gz"
+    return upload
+
+
+def test_dose_is_float32_and_matches_the_reference(dose):
+    for upload in (nifti_gz(dose, "dose.nii.gz"), _scaled_upload(dose)):
+        volume, header = utils.read_dose_file(upload)
+        upload.seek(0)
+        expected, _ = legacy.read_file(upload)
+        assert volume.dtype == np.float32 and volume.flags.writeable
+        np.testing.assert_allclose(volume, expected, rtol=1e-6, atol=1e-6)
+        assert header.get_data_shape() == dose.shape
+
+
+def test_masks_keep_their_stored_type(masks):
+    mask = masks["Target"]
+    volume, _ = utils.read_mask_file(nifti_gz(mask, "Target.nii.gz"))
+    assert volume.dtype == np.uint8 and volume.flags.writeable
+    np.testing.assert_array_equal(volume, mask)
+    # Non-integer masks become boolean
+    volume, _ = utils.read_mask_file(nifti_gz(mask.astype(np.float32) * 0.5, "Target.nii.gz"))
+    assert volume.dtype == bool
+    np.testing.assert_array_equal(volume, mask > 0)
+
+
+def test_views_are_read_only(dose):
+    volume, _ = utils.read_dose_view(nifti_gz(dose, "dose.nii.gz"))
+    assert not volume.flags.writeable
+    np.testing.assert_array_equal(volume, dose)
+
+
+def test_uncompressed_files_are_memory_mapped(tmp_path, dose):
+    nib.save(nib.Nifti1Image(dose, np.eye(4)), tmp_path / "dose.nii")
+    view, _ = utils.read_dose_view(tmp_path / "dose.nii")
+    assert isinstance(view, np.memmap)
+    volume, _ = utils.read_dose_file(tmp_path / "dose.nii")
+    assert not isinstance(volume, np.memmap) and volume.flags.writeable
+    np.testing.assert_array_equal(volume, dose)
+
+
+def test_concatenated_gzip_members(dose):
+    data = nib.Nifti1Image(dose, np.eye(4)).to_bytes()
+    middle = len(data) // 2
+    upload = io.BytesIO(gzip.compress(data[:middle]) + gzip.compress(data[middle:]))
+    volume, _ = utils.read_dose_file(upload)
+    np.testing.assert_array_equal(volume, dose)
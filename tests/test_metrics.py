@@ -0,0 +1,78 @@
+import math
+
+import numpy as np
+import pytest
+
+from src import metrics, utils
+from src.histogram import DoseHistogram, auto_bins
+
+STEP = utils.SUMMARY_STEP
+VOXEL_CC = 0.01
+
+
+def _histograms(dose, masks):
+    return {name: (dose[mask > 0], histogram)
+            for (name, mask), histogram in zip(masks.items(), utils.structure_dose_histograms(dose, masks).values())}
+
+
+def _geud(values, a):
+    # A zero dose with a < 0 drives the mean to infinity and the gEUD to 0, as for the histogram
+    with np.errstate(divide="ignore"):
+        return np.mean(values.astype(float) ** a) ** (1 / a)
+
+
+def test_geud_matches_the_voxel_doses(dose, masks):
+    for name, (values, histogram) in _histograms(dose, masks).items():
+        for a in (1, 4, 12, -10):
+            assert metrics.metric_value(histogram, f"gEUD{a}") == pytest.approx(_geud(values, a), abs=STEP)
+        assert metrics.metric_value(histogram, "gEUD1") == pytest.approx(values.mean(), abs=STEP / 2)
+    target_values, target = _histograms(dose, masks)["Target"]
+    assert metrics.metric_value(target, "gEUD", structure="Target") == pytest.approx(_geud(target_values, -10),
+                                                                                     abs=STEP)
+
+
+def test_geud_of_many_histograms_at_once(dose, masks):
+    histograms = [histogram for _, histogram in _histograms(dose, masks).values()]
+    counts = np.array([histogram.counts for histogram in histograms])
+    doses = np.array([metrics.bin_doses(histogram) for histogram in histograms])
+    a = np.array([0, -10, 4, 1, 8, 2])
+    expected = [metrics.geud(row_counts, row_doses, row_a)[0] for row_counts, row_doses, row_a in zip(counts, doses, a)]
+    np.testing.assert_allclose(metrics.geud(counts, doses, a), expected, rtol=1e-12)
+    # a = 0 is the geometric mean; an empty histogram has no gEUD
+    values, _ = _histograms(dose, masks)["Target"]
+    assert expected[0] == pytest.approx(np.exp(np.mean(np.log(values.astype(float)))), abs=STEP)
+    assert np.isnan(metrics.geud(np.zeros(5), np.arange(5.0), 2)[0])
+
+
+def test_ntcp_follows_the_lkb_model(dose, masks):
+    values, _ = _histograms(dose, masks)["Body"]
+    histogram = DoseHistogram(auto_bins(float(values.max()), STEP)).add(values)
+    parameters = metrics.ORGAN_PARAMETERS["spinalcord"]
+    t = (_geud(values, parameters["a"]) - parameters["TD50"]) / (parameters["m"] * parameters["TD50"])
+    expected = 50 * math.erfc(-t / math.sqrt(2))
+    assert metrics.metric_value(histogram, "NTCP", structure="SpinalCord") == pytest.approx(expected, abs=0.1)
+    assert np.isnan(metrics.metric_value(histogram, "NTCP", structure="Target"))
+
+
+def test_homogeneity_and_conformity(dose, masks):
+    grid = utils.grid_histogram(dose)
+    for name, (values, histogram) in _histograms(dose, masks).items():
+        d2, d50, d98 = np.percentile(values, [98, 50, 2])
+        assert metrics.metric_value(histogram, "HI") == pytest.approx((d2 - d98) / d50, abs=3 * STEP / d50)
+        for level in (20, 45.5, 60):
+            covered, isodose = (values >= level).sum(), (dose >= level).sum()
+            expected = covered ** 2 / (len(values) * isodose) if isodose else 0.0
+            assert metrics.metric_value(histogram, f"CI{level:g}", grid=grid) == pytest.approx(expected, rel=1e-2)
+
+
+def test_volume_metrics_in_cc(dose, masks):
+    for name, (values, histogram) in _histograms(dose, masks).items():
+        hottest = np.sort(values)[::-1]
+        for cc in (0.03, 0.5, 2.0):
+            n_voxels = min(math.ceil(cc / VOXEL_CC), len(values))
+            assert metrics.metric_value(histogram, f"D{cc:g}cc", VOXEL_CC) == pytest.approx(hottest[n_voxels - 1],
+                                                                                             abs=STEP)
+        assert metrics.metric_value(histogram, "V20cc", VOXEL_CC) == pytest.approx((values >= 20).sum() * VOXEL_CC,
+                                                                                  abs=VOXEL_CC)
+    with pytest.raises(ValueError):
+        metrics.metric_value(histogram, "D2cc")
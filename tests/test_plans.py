@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+from benchmarks import legacy
+from benchmarks.phantoms import dose_phantom
+from src import utils
+
+from tests.conftest import SHAPE
+
+
+def _plans(dose):
+    return {"A": dose, "B": dose_phantom(SHAPE, seed=2), "C": dose_phantom(SHAPE, seed=3, prescription=66.0)}
+
+
+def test_summary_by_plan_matches_dose_summary(dose, masks, monkeypatch):
+    plans = _plans(dose)
+    metrics = ["D95", "D2", "V20", "D0.03cc", "gEUD", "HI", "CI60"]
+    expected = {plan: utils.dose_summary(dose_volume, masks, metrics, voxel_cc=0.01)
+                for plan, dose_volume in plans.items()}
+    # One batch of plans, then one plan per batch
+    for batch_values in (utils.PLAN_BATCH_VALUES, 1):
+        monkeypatch.setattr(utils, "PLAN_BATCH_VALUES", batch_values)
+        summaries = utils.summary_by_plan(plans, masks, metrics, voxel_cc=0.01)
+        assert list(summaries) == list(plans)
+        for plan, summary in summaries.items():
+            pd.testing.assert_frame_equal(summary, expected[plan], check_dtype=False, rtol=1e-9)
+
+
+def test_dvh_by_dose_matches_the_reference(dose, masks):
+    plans = _plans(dose)
+    df = utils.dvh_by_dose(plans, masks["Target"], "Target", bins=np.arange(0, 70, 0.1))
+    expected = legacy.dvh_by_dose(plans, masks["Target"], "Target")
+    pd.testing.assert_frame_equal(df[["Dose", "Structure"]], expected[["Dose", "Structure"]])
+    np.testing.assert_allclose(df["Volume"], expected["Volume"], rtol=1e-12, atol=1e-9)
+
+
+def test_dvh_by_plan_matches_dvh_by_structure(dose, masks):
+    plans = _plans(dose)
+    bins = utils.shared_bins(plans.values())
+    for plan, df in utils.dvh_by_plan(plans, masks, voxel_cc=0.01).items():
+        pd.testing.assert_frame_equal(df, utils.dvh_by_structure(plans[plan], masks, bins=bins, voxel_cc=0.01))
+
+
+def test_difference_dvh(dose, masks):
+    plans = _plans(dose)
+    df = utils.difference_dvh(plans, masks["Body"], "Body", reference="A")
+    curves = utils.dvh_by_dose(plans, masks["Body"], "Body").pivot(index="Dose", columns="Structure", values="Volume")
+    assert df["Structure"].unique().tolist() == ["Body_B", "Body_C"]
+    for name, curve in df.groupby("Structure"):
+        np.testing.assert_allclose(curve["Volume Difference"], (curves[name] - curves["Body_A"]).to_numpy())
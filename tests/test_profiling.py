@@ -0,0 +1,20 @@
+from src.parallel import thread_map
+from src.profiling import Profiler, stage
+
+
+def test_worker_stages_keep_their_parent():
+    with Profiler("case") as profiler:
+        with stage("outer"):
+            thread_map(lambda item: _inner(), range(4), workers=2)
+        with stage("after"):
+            pass
+    stages = {record["stage"]: record for record in profiler.report()["stages"]}
+    assert set(stages) == {"outer", "outer/inner", "after"}
+    assert stages["outer/inner"]["calls"] == 4
+    assert stages["outer"]["peak_mb"] is None
+
+
+def _inner():
+    with stage("inner"):
+        pass
+
@@ -0,0 +1,127 @@
+import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from src import service
+from src.service import DVHService
+
+
+@pytest.fixture
+def case(tmp_path):
+    # 20 x 20 x 10 grid of 2 mm voxels, dose rising along x, a target and an organ at risk
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    dose = np.broadcast_to(np.linspace(0, 60, 20, dtype=np.float32)[:, None, None], (20, 20, 10)).copy()
+    nib.save(nib.Nifti1Image(dose, affine), tmp_path / "dose.nii.gz")
+    target = np.zeros(dose.shape, dtype=np.uint8)
+    target[12:18, 5:15, 2:8] = 1
+    organ = np.zeros(dose.shape, dtype=np.uint8)
+    organ[2:8, 5:15, 2:8] = 1
+    (tmp_path / "masks").mkdir()
+    nib.save(nib.Nifti1Image(target, affine), tmp_path / "masks" / "Target.nii.gz")
+    nib.save(nib.Nifti1Image(organ, affine), tmp_path / "masks" / "Rectum.nii.gz")
+    return {"dose": str(tmp_path / "dose.nii.gz"), "masks": str(tmp_path / "masks")}
+
+
+async def _request(port, method, path, payload=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = b"" if payload is None else json.dumps(payload).encode()
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, data = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(data)
+
+
+def _serve(scenario, workers=2):
+    # Runs scenario(port) against a service listening on a free local port
+    async def run():
+        service = DVHService(workers, executor=ThreadPoolExecutor(workers))
+        server = await asyncio.start_server(service.handle, "127.0.0.1", 0)
+        try:
+            return await scenario(server.sockets[0].getsockname()[1])
+        finally:
+            server.close()
+            await server.wait_closed()
+            service.close()
+    return asyncio.run(run())
+
+
+async def _result(port, job):
+    for _ in range(200):
+        status, payload = await _request(port, "GET", f"/jobs/{job}/result")
+        if status != 202:
+            return status, payload
+        await asyncio.sleep(0.05)
+    raise TimeoutError(job)
+
+
+def test_job_result(case):
+    async def scenario(port):
+        status, payload = await _request(port, "POST", "/jobs", {**case, "metrics": ["D95", "V20"]})
+        assert status == 202
+        return await _result(port, payload["job"])
+
+    status, payload = _serve(scenario)
+    assert status == 200 and payload["status"] == "done"
+    summary = {row["Structure"]: row for row in payload["result"]["summary"]}
+    assert set(summary) == {"Target", "Rectum"}
+    assert summary["Target"]["Min Dose"] > summary["Rectum"]["Max Dose"]
+    # Of the six rectum columns x = 2..7 only x = 7 (22.1 Gy) gets 20 Gy
+    assert summary["Rectum"]["V20"] == pytest.approx(100 / 6)
+
+
+def test_duplicate_jobs_are_coalesced(case):
+    async def scenario(port):
+        first = await _request(port, "POST", "/jobs", case)
+        second = await _request(port, "POST", "/jobs", dict(case))
+        await _result(port, first[1]["job"])
+        third = await _request(port, "POST", "/jobs", case)
+        health = await _request(port, "GET", "/health")
+        return first, second, third, health
+
+    first, second, third, health = _serve(scenario)
+    assert first[0] == second[0] == third[0] == 202
+    assert first[1]["job"] == second[1]["job"] == third[1]["job"]
+    assert third[1]["status"] == "done"
+    assert health[1]["finished"] == 1
+
+
+def test_jobs_wait_for_a_free_worker(case, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(service, "compute_job", lambda spec: release.wait(10) and {"metrics": spec["metrics"]})
+
+    async def scenario(port):
+        jobs = [(await _request(port, "POST", "/jobs", {**case, "metrics": [metric]}))[1]["job"]
+                for metric in ["D95", "D50", "D5"]]
+        await asyncio.sleep(0.1)
+        health = (await _request(port, "GET", "/health"))[1]
+        statuses = [(await _request(port, "GET", f"/jobs/{job}"))[1]["status"] for job in jobs]
+        release.set()
+        results = [await _result(port, job) for job in jobs]
+        return health, statuses, results
+
+    health, statuses, results = _serve(scenario, workers=1)
+    assert (health["running"], health["queued"]) == (1, 2)
+    assert statuses == ["running", "queued", "queued"]
+    assert [status for status, _ in results] == [200, 200, 200]
+
+
+@pytest.mark.parametrize("change", [{"metrics": 7}, {"metrics": ["D95", 3]}, {"masks": [1, 2]}, {"dose": 5},
+                                    {"constraints": 1}, {"supersample": "3"}, {"metrics": ["NotAMetric"]},
+                                    {"dose": "missing.nii.gz"}])
+def test_bad_jobs_are_rejected(case, change):
+    status, payload = _serve(lambda port: _request(port, "POST", "/jobs", {**case, **change}))
+    assert status == 400 and payload["error"]
+
+
+def test_malformed_bodies_are_rejected():
+    async def scenario(port):
+        return [await _request(port, "POST", "/jobs", body) for body in ([], "x", {"dose": "a"})]
+
+    assert [status for status, _ in _serve(scenario)] == [400, 400, 400]
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+from src import utils
+from src.stream import is_lazy, stream_histograms
+from src.structure import CompactMask, fuse_masks
+
+
+def _lazy_case(case_files):
+    dose_file, mask_files = case_files
+    dose_volume, _ = utils.read_dose(dose_file, lazy=True)
+    return dose_volume, utils.read_masks(mask_files, lazy=True)
+
+
+def _loaded_case(case_files):
+    dose_file, mask_files = case_files
+    dose_volume, _ = utils.read_dose(dose_file)
+    return dose_volume, utils.read_masks(mask_files)
+
+
+def test_lazy_volumes_stay_in_the_file(case_files):
+    dose_volume, structure_masks = _lazy_case(case_files)
+    assert is_lazy(dose_volume) and all(is_lazy(mask) for mask in structure_masks.values())
+
+
+def test_streamed_dvh_matches_the_in_memory_one(case_files):
+    lazy_dose, lazy_masks = _lazy_case(case_files)
+    dose_volume, structure_masks = _loaded_case(case_files)
+    for name, mask in structure_masks.items():
+        bins, values = utils.compute_dvh(lazy_dose, lazy_masks[name], max_dose=65)
+        expected_bins, expected = utils.compute_dvh(dose_volume, mask, max_dose=65)
+        np.testing.assert_array_equal(bins, expected_bins)
+        np.testing.assert_allclose(values, expected, rtol=1e-12)
+    pd.testing.assert_frame_equal(utils.dvh_by_structure(lazy_dose, lazy_masks),
+                                  utils.dvh_by_structure(dose_volume, structure_masks))
+    # A lazy dose with masks already in memory, compact or fused, streams the same way
+    compact = {name: CompactMask.from_dense(mask) for name, mask in structure_masks.items()}
+    pd.testing.assert_frame_equal(utils.dvh_by_structure(lazy_dose, compact),
+                                  utils.dvh_by_structure(dose_volume, structure_masks))
+
+
+def test_streamed_summary_matches_the_in_memory_one(case_files):
+    lazy_dose, lazy_masks = _lazy_case(case_files)
+    dose_volume, structure_masks = _loaded_case(case_files)
+    metrics = ["D95", "D2", "V20", "CI60"]
+    expected = utils.dose_summary(dose_volume, structure_masks, metrics)
+    pd.testing.assert_frame_equal(utils.dose_summary(lazy_dose, lazy_masks, metrics), expected)
+    pd.testing.assert_frame_equal(utils.dose_summary(lazy_dose, fuse_masks(structure_masks), metrics), expected)
+
+
+def test_streamed_grid_histogram_matches_the_in_memory_one(case_files):
+    lazy_dose, _ = _lazy_case(case_files)
+    dose_volume, _ = _loaded_case(case_files)
+    streamed, loaded = utils.grid_histogram(lazy_dose), utils.grid_histogram(dose_volume)
+    np.testing.assert_array_equal(streamed.bins, loaded.bins)
+    np.testing.assert_array_equal(streamed.counts, loaded.counts)
+    assert (streamed.min, streamed.max, streamed.count) == (loaded.min, loaded.max, loaded.count)
+    assert np.isclose(streamed.sum, loaded.sum, rtol=1e-12)
+
+
+def test_slab_size_does_not_change_the_histograms(case_files):
+    lazy_dose, lazy_masks = _lazy_case(case_files)
+    bins = utils.stream_bins(lazy_dose)
+    whole = stream_histograms(lazy_dose, lazy_masks, bins, slab_size=lazy_dose.shape[2])
+    for name, histogram in stream_histograms(lazy_dose, lazy_masks, bins, slab_size=5).items():
+        np.testing.assert_array_equal(histogram.counts, whole[name].counts)